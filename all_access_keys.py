@@ -19,3 +19,19 @@ GOOGLE_APPLICATION_CREDENTIALS = ''  # Replace with your path
 # Database URL
 DATABASE_URL = ''
 
+# Call state store for in-progress calls ('' for in-process, or redis://host:6379/0)
+CALL_STATE_URL = ''
+
+# Who transcribes recordings as they arrive: 'inline' (worker threads in the
+# webhook server), 'sidecar' (transcription_pipeline.py --worker), or '' for
+# batch runs of transcription_pipeline.py only
+TRANSCRIPTION_WORKER = 'inline'
+
+# Fraction of each API quota (rate_limit.SERVICE_LIMITS) that each kind of
+# process may use. Limits are enforced per process, so a service's shares
+# across the processes running at once should add up to at most 1
+RATE_LIMIT_SHARES = {
+    'webhook': {'openai': 1.0},
+    'worker': {'speech': 0.6, 'gcs': 0.6},
+    'backfill': {'speech': 0.2, 'gcs': 0.2},
+}
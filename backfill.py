@@ -0,0 +1,174 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import clients
+import job_queue
+import metrics
+import rate_limit
+import transcription_pipeline
+
+# Bulk backfill of historical recordings. Untranscribed rows are read in
+# keyset-paginated batches, each batch is transcribed by a small pool of
+# workers at a capped rate, and its transcripts are written back with one
+# bulk UPDATE. A checkpoint file records the last row id written, so a
+# crashed or interrupted run resumes where it stopped. Only one batch is held
+# in memory at a time, however large the backlog. Backfilled transcripts are
+# stored in the database only, without the per-recording text files.
+# Each recording is claimed through the job queue before it is transcribed,
+# so the backfill and the queue workers never work on the same recording;
+# rows whose job is done, waiting for a retry or leased elsewhere are skipped
+# and left to the queue. Besides its own recordings-per-minute cap, the
+# backfill's API calls are held to its share of each quota (RATE_LIMIT_SHARES).
+
+BATCH_SIZE = 100
+WORKERS = 2                      # Kept low so live transcription keeps most of the Speech quota
+MAX_RECORDINGS_PER_MINUTE = 60   # 0 for no limit
+CHECKPOINT_FILE = "backfill_checkpoint.json"
+
+
+def recording_limiter(per_minute):
+    """Starts at most ``per_minute`` recordings a minute, evenly spaced, from any number of threads."""
+    return rate_limit.ServiceLimiter("backfill", rate=per_minute / 60.0, burst=1, failure_threshold=0)
+
+
+def new_progress():
+    return {"last_id": 0, "processed": 0, "transcribed": 0, "failed": 0, "skipped": 0}
+
+
+def load_checkpoint(path=CHECKPOINT_FILE):
+    try:
+        with open(path, "r") as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return new_progress()
+
+
+def save_checkpoint(progress, path=CHECKPOINT_FILE):
+    """Write the checkpoint atomically, so a crash mid-write never leaves it truncated."""
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as checkpoint_file:
+        json.dump(progress, checkpoint_file)
+    os.replace(temporary_path, path)
+
+
+def transcribe_row(row, limiter, worker_id, streaming=False):
+    """Claim and transcribe one candidate row; returns ``(job, transcript JSON or None)``.
+
+    The job is None when the recording could not be claimed, e.g. because a
+    queue worker holds it. While Speech or GCS has its circuit open the row
+    waits and is retried, rather than being counted as failed.
+    """
+    job = job_queue.claim_recording(row.recording_url, row.call_sid, worker_id)
+    if job is None:
+        return None, None
+    transcribe = (transcription_pipeline.transcribe_recording_streaming if streaming
+                  else transcription_pipeline.transcribe_recording)
+    while True:
+        try:
+            with metrics.timer("backfill_recording_seconds"):
+                return job, limiter.call(transcribe, row.recording_url)
+        except rate_limit.CircuitOpenError as e:
+            logging.warning(f"Pausing backfill of {row.recording_url}: {e}")
+            time.sleep(e.retry_in)
+        except Exception as e:
+            logging.error(f"Error backfilling {row.recording_url}: {e}")
+            return job, None
+
+
+def run_backfill(batch_size=BATCH_SIZE, workers=WORKERS, per_minute=MAX_RECORDINGS_PER_MINUTE,
+                 checkpoint_file=CHECKPOINT_FILE, restart=False, limit=None, streaming=False):
+    """Transcribe untranscribed recordings in batches, resuming from the checkpoint.
+
+    The checkpoint only moves past a batch once its UPDATE has committed, and
+    only then are the batch's jobs marked done. Recordings that failed go back
+    to the job queue, which retries them with backoff; ``restart=True`` scans
+    from the beginning and claims any that have failed for good again.
+    Returns the progress counters that were saved to the checkpoint.
+    """
+    progress = new_progress() if restart else load_checkpoint(checkpoint_file)
+    limiter = recording_limiter(per_minute)
+    worker_id = f"{job_queue.default_worker_id()}:backfill"
+    started_at = time.perf_counter()
+    processed_this_run = 0
+    logging.info(f"Backfill starting after row {progress['last_id']}: batches of {batch_size}, "
+                 f"{workers} workers, {per_minute or 'unlimited'} recordings/minute")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while limit is None or processed_this_run < limit:
+            size = batch_size if limit is None else min(batch_size, limit - processed_this_run)
+            batch = transcription_pipeline.get_unprocessed_batch(progress["last_id"], size)
+            if not batch:
+                break
+
+            documents = {}
+            done_jobs = []
+            failed_jobs = []
+            results = pool.map(lambda row: transcribe_row(row, limiter, worker_id, streaming), batch)
+            for row, (job, document) in zip(batch, results):
+                if job is None:
+                    continue
+                if document is not None:
+                    documents[row.id] = document
+                    done_jobs.append(job.id)
+                else:
+                    failed_jobs.append(job.id)
+            with metrics.timer("backfill_write_seconds"):
+                updated = transcription_pipeline.save_transcriptions_to_db(documents)
+            if updated is None:
+                for job_id in done_jobs + failed_jobs:
+                    job_queue.fail_job(job_id, "Backfill could not store the transcript")
+                logging.error(f"Stopping backfill; rows after {progress['last_id']} will be retried on the next run")
+                break
+            job_queue.complete_jobs(done_jobs)
+            for job_id in failed_jobs:
+                job_queue.fail_job(job_id, "Backfill transcription failed")
+
+            skipped = len(batch) - len(done_jobs) - len(failed_jobs)
+            processed_this_run += len(batch)
+            progress["last_id"] = batch[-1].id
+            progress["processed"] += len(batch)
+            progress["transcribed"] += len(documents)
+            progress["failed"] += len(failed_jobs)
+            progress["skipped"] = progress.get("skipped", 0) + skipped
+            save_checkpoint(progress, checkpoint_file)
+            metrics.inc("backfill_recordings_total", len(documents), result="transcribed")
+            metrics.inc("backfill_recordings_total", len(failed_jobs), result="failed")
+            metrics.inc("backfill_recordings_total", skipped, result="skipped")
+
+            elapsed = time.perf_counter() - started_at
+            logging.info(f"Backfilled through row {progress['last_id']}: {progress['transcribed']} transcribed, "
+                         f"{progress['failed']} failed, {progress['skipped']} skipped ({processed_this_run / elapsed * 60:.1f} recordings/minute)")
+    clients.close_finished_sessions()  # The pool's threads have exited
+
+    logging.info(f"Backfill finished: {progress}")
+    return progress
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcribe the backlog of historical recordings.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows read and written per batch")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Recordings transcribed concurrently")
+    parser.add_argument("--rate", type=float, default=MAX_RECORDINGS_PER_MINUTE,
+                        help="Most recordings started per minute (0 for no limit)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="Progress file used to resume")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the checkpoint and scan from the first row, retrying earlier failures")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many recordings")
+    parser.add_argument("--stream", action="store_true",
+                        help="Pipe downloads through ffmpeg in memory instead of using temp files")
+    parser.add_argument("--chunked", action="store_true",
+                        help="Recognize long recordings as parallel windows instead of via GCS")
+    parser.add_argument("--trim-silence", action="store_true",
+                        help="Compress long silences before sending audio to Speech")
+    parser.add_argument("--quota-share", type=float, default=None,
+                        help="Fraction of every API quota to use, instead of RATE_LIMIT_SHARES['backfill']")
+    args = parser.parse_args()
+    rate_limit.use_share("backfill", share=args.quota_share)
+    transcription_pipeline.CHUNKED_RECOGNITION = args.chunked
+    transcription_pipeline.TRIM_SILENCE = args.trim_silence
+    run_backfill(batch_size=args.batch_size, workers=args.workers, per_minute=args.rate,
+                 checkpoint_file=args.checkpoint, restart=args.restart, limit=args.limit, streaming=args.stream)
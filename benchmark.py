@@ -0,0 +1,1157 @@
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import all_access_keys
+import metrics
+from fake_services import (
+    FakeMediaStream, FakeOpenAIServer, FakeRecordingServer, FakeSpeechClient, FakeStorageClient, FAKE_GPT_REPLY,
+)
+
+# Offline benchmarks for the webhook server and the transcription pipeline.
+# Every external service is replaced by a local stand-in from fake_services,
+# and all state (databases, logs) lives in a temporary working directory.
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def report(name, latencies, elapsed, errors=0):
+    print(f"{name}: {len(latencies)} requests in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed if elapsed else 0:.1f} req/s), {errors} errors")
+    print(f"  p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms")
+
+
+def use_workdir():
+    """Run in a throwaway directory so SQLite files and logs don't touch the repo."""
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    os.chdir(workdir)
+    all_access_keys.DATABASE_URL = f"sqlite:///{os.path.join(workdir, 'calls.db')}"
+    return workdir
+
+
+def load_receiving_call():
+    import receiving_call
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    return receiving_call
+
+
+def serve_app(app):
+    """Serve a Flask app on a local port with the threaded development server."""
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def run_concurrently(fn, items, concurrency):
+    """Call ``fn(item)`` from ``concurrency`` threads; fn returns (ok, body).
+
+    Returns (latencies, errors, elapsed, bodies).
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            ok, body = fn(item)
+        except requests.RequestException as e:
+            ok, body = False, str(e)
+        with lock:
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors.append(body)
+        return body
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        bodies = list(pool.map(timed, items))
+    return latencies, errors, time.perf_counter() - start, bodies
+
+
+def post_form(url, form):
+    response = requests.post(url, data=form, timeout=60)
+    return response.status_code == 200, response.text
+
+
+def caller_name(call_sid):
+    """A first name unique to the call, so every prompt misses the GPT response cache and reaches OpenAI."""
+    return f"Caller{call_sid[2:]}"
+
+
+def bench_gpt_load(args):
+    """Fire many concurrent /start_gpt_conversation webhooks at a stubbed OpenAI."""
+    use_workdir()
+    receiving_call = load_receiving_call()
+    import openai
+
+    db_session = receiving_call.get_session()
+    call_sids = [f"CA{i:032d}" for i in range(args.requests)]
+    db_session.add_all(receiving_call.ResponseData(
+        call_sid=call_sid, first_name=caller_name(call_sid), last_name="Lovelace", age="36", residency="London"
+    ) for call_sid in call_sids)
+    db_session.commit()
+    db_session.close()
+
+    with FakeOpenAIServer(latency=args.openai_latency) as fake_openai:
+        openai.api_base = fake_openai.api_base
+        openai.api_key = "sk-benchmark"
+        server, base_url = serve_app(receiving_call.app)
+
+        def converse(call_sid):
+            # Follow the filler + /gpt_reply redirects until the reply is played; the
+            # reply can arrive in any of the responses, so keep them all
+            ok, body = post_form(f"{base_url}/start_gpt_conversation", {"CallSid": call_sid})
+            played = body
+            while ok and "/gpt_reply</Redirect>" in body:
+                ok, body = post_form(f"{base_url}/gpt_reply", {"CallSid": call_sid})
+                played += body
+            return ok, played
+
+        try:
+            latencies, errors, elapsed, bodies = run_concurrently(converse, call_sids, args.concurrency)
+        finally:
+            server.shutdown()
+
+    replied = sum(1 for body in bodies if FAKE_GPT_REPLY in body)
+    report("/start_gpt_conversation until reply", latencies, elapsed, len(errors))
+    print(f"  {replied}/{len(bodies)} callers heard the GPT reply; "
+          f"OpenAI latency {args.openai_latency * 1000:.0f}ms, concurrency {args.concurrency}")
+
+
+def bench_gpt_stream(args):
+    """Compare time-to-first-sentence with and without GPT streaming."""
+    use_workdir()
+    receiving_call = load_receiving_call()
+    import openai
+
+    with FakeOpenAIServer(latency=args.openai_latency, token_latency=args.token_latency) as fake_openai:
+        openai.api_base = fake_openai.api_base
+        openai.api_key = "sk-benchmark"
+        server, base_url = serve_app(receiving_call.app)
+        try:
+            for streaming in (False, True):
+                receiving_call.GPT_STREAMING_MODE = streaming
+                first_sentence = []
+                full_reply = []
+                lock = threading.Lock()
+
+                def converse(call_sid):
+                    # Answer the questionnaire, then time from the last answer to the reply
+                    form = {"CallSid": call_sid}
+                    for route, answer in (("process_first_name", caller_name(call_sid)), ("process_last_name", "Lovelace"),
+                                          ("process_age", "36")):
+                        post_form(f"{base_url}/{route}", dict(form, SpeechResult=answer))
+                    start = time.perf_counter()
+                    ok, body = post_form(f"{base_url}/process_residency", dict(form, SpeechResult="London"))
+                    ok, body = post_form(f"{base_url}/start_gpt_conversation", form)
+                    while ok:
+                        if "<Say>" in body and not first_sentence_seen[call_sid]:
+                            first_sentence_seen[call_sid] = True
+                            with lock:
+                                first_sentence.append(time.perf_counter() - start)
+                        if "/gpt_reply</Redirect>" not in body:
+                            break
+                        ok, body = post_form(f"{base_url}/gpt_reply", form)
+                    with lock:
+                        full_reply.append(time.perf_counter() - start)
+                    return ok, body
+
+                call_sids = [f"CA{streaming:d}{i:031d}" for i in range(args.requests)]
+                first_sentence_seen = dict.fromkeys(call_sids, False)
+                _, errors, elapsed, _ = run_concurrently(converse, call_sids, args.concurrency)
+                mode = "streaming" if streaming else "single reply"
+                report(f"{mode}: last answer to end of reply", full_reply, elapsed, len(errors))
+                report(f"{mode}: last answer to first sentence", first_sentence, elapsed)
+        finally:
+            server.shutdown()
+
+
+def bench_gpt_processes(args):
+    """GPT replies with each webhook of a call served by a different process sharing a Redis store.
+
+    Exits non-zero if a caller does not hear the reply or a call costs more than one OpenAI request.
+    """
+    use_workdir()
+    try:
+        import fakeredis
+    except ImportError:
+        print("gpt-processes needs the fakeredis package")
+        return 1
+    import importlib.util
+    import openai
+    from call_state import RedisCallStateStore
+
+    # Each copy of the module stands in for one webhook process, with its own background loop and caches
+    processes = [load_receiving_call()]
+    for index in range(1, args.processes):
+        spec = importlib.util.spec_from_file_location(f"receiving_call_{index}", processes[0].__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        processes.append(module)
+    redis_server = fakeredis.FakeServer()
+    for module in processes:
+        module.GPT_STREAMING_MODE = args.streaming
+        module.call_state = RedisCallStateStore(fakeredis.FakeRedis(server=redis_server),
+                                                on_abandon=module.flush_abandoned_call,
+                                                value_ttl=module.GPT_PREFETCH_TTL_SECONDS)
+
+    with FakeOpenAIServer(latency=args.openai_latency, token_latency=args.token_latency) as fake_openai:
+        openai.api_base = fake_openai.api_base
+        openai.api_key = "sk-benchmark"
+        servers = [serve_app(module.app) for module in processes]
+        try:
+            def converse(index_and_sid):
+                # Every request of the call lands on the next process round
+                index, call_sid = index_and_sid
+                base_urls = [base_url for _, base_url in servers]
+                step = [index]
+
+                def post(route, form):
+                    step[0] += 1
+                    return post_form(f"{base_urls[step[0] % len(base_urls)]}/{route}", form)
+
+                form = {"CallSid": call_sid}
+                for route, answer in (("process_first_name", caller_name(call_sid)), ("process_last_name", "Lovelace"),
+                                      ("process_age", "36"), ("process_residency", "London")):
+                    post(route, dict(form, SpeechResult=answer))
+                ok, body = post("start_gpt_conversation", form)
+                played = body
+                while ok and "/gpt_reply</Redirect>" in body:
+                    ok, body = post("gpt_reply", form)
+                    played += body
+                return ok, played
+
+            call_sids = [f"CA{index:032d}" for index in range(args.calls)]
+            latencies, errors, elapsed, bodies = run_concurrently(converse, list(enumerate(call_sids)),
+                                                                  args.concurrency)
+        finally:
+            for server, _ in servers:
+                server.shutdown()
+
+    replied = sum(1 for body in bodies if FAKE_GPT_REPLY.split(".")[0] in body)
+    report(f"{args.processes} processes, answers to end of reply", latencies, elapsed, len(errors))
+    print(f"  {replied}/{args.calls} callers heard the GPT reply; {fake_openai.requests} OpenAI requests")
+    return 0 if replied == args.calls and fake_openai.requests == args.calls else 1
+
+
+CALL_FLOW = (
+    ("voice", None),
+    ("process_first_name", caller_name),  # Called with the CallSid
+    ("process_last_name", "Lovelace"),
+    ("process_age", "36"),
+    ("process_residency", "London"),
+    ("start_gpt_conversation", None),
+)
+
+
+def bench_gpt_cache(args):
+    """Paraphrase GPT cache lookups: paraphrases must hit, prompts for a different caller must miss.
+
+    Exits non-zero if the paraphrase misses, or if a prompt differing in one
+    answer is served another caller's reply.
+    """
+    use_workdir()
+    from response_cache import ResponseCache
+    receiving_call = load_receiving_call()
+    profile = {"first_name": "Ada", "last_name": "Lovelace", "age": "36", "residency": "London"}
+    variants = {"first_name": ("Ada-Marie", "Adam"), "last_name": ("Byron",), "age": ("37", "63"),
+                "residency": ("New London", "London, UK", "Londonderry")}
+
+    cache = ResponseCache(maxsize=args.entries + 1, semantic=True)
+    messages = receiving_call.build_gpt_messages(profile)
+    cache.put(messages, "model", "Reply for Ada in London")
+    for index in range(args.entries):
+        cache.put(receiving_call.build_gpt_messages(dict(profile, first_name=f"Caller{index}")), "model", "other")
+
+    # Same answers, different filler wording around them
+    paraphrase = [messages[0], {"role": "user", "content": "my name is Ada Lovelace. I'm 36 years old and I live in London"}]
+    start = time.perf_counter()
+    paraphrase_hit = cache.get(paraphrase, "model") is not None
+    lookup_seconds = time.perf_counter() - start
+    print(f"Paraphrase of a cached prompt: {'hit' if paraphrase_hit else 'miss'} "
+          f"({lookup_seconds * 1000:.2f}ms against {args.entries + 1} entries)")
+
+    wrong = 0
+    for field, values in variants.items():
+        for value in values:
+            reply = cache.get(receiving_call.build_gpt_messages(dict(profile, **{field: value})), "model")
+            wrong += reply is not None
+            print(f"  {field}={value!r}: {'HIT, served ' + repr(reply) if reply else 'miss'}")
+    print(f"{wrong} one-answer variants were served a cached reply")
+    return 1 if wrong or not paraphrase_hit else 0
+
+
+def load_transcription_pipeline():
+    """Import the pipeline with Speech and Storage replaced by local fakes."""
+    from google.cloud import speech, storage
+    import clients
+    import transcription_pipeline
+    speech.SpeechClient = FakeSpeechClient
+    storage.Client = FakeStorageClient
+    clients.reset()
+    logging.getLogger().setLevel(logging.WARNING)
+    return transcription_pipeline
+
+
+def bench_end_to_end(args):
+    """Replay whole calls against the webhook app, then drain the pipeline."""
+    use_workdir()
+    receiving_call = load_receiving_call()
+    transcription_pipeline = load_transcription_pipeline()
+    import openai
+
+    FakeSpeechClient.latency = args.speech_latency
+    FakeStorageClient.latency = args.gcs_latency
+    receiving_call.TRANSCRIPTION_WORKER_MODE = ""  # Measure the batch pipeline on its own
+    route_latencies = {route: [] for route, _ in CALL_FLOW}
+    route_latencies["gpt_reply"] = []
+    route_latencies["handle-recording"] = []
+    lock = threading.Lock()
+
+    with FakeOpenAIServer(latency=args.openai_latency) as fake_openai, \
+            FakeRecordingServer(latency=args.download_latency, seconds=args.recording_seconds,
+                                sample_rate=args.sample_rate, silence=args.silence) as recordings:
+        openai.api_base = fake_openai.api_base
+        openai.api_key = "sk-benchmark"
+        server, base_url = serve_app(receiving_call.app)
+
+        def timed_post(route, form):
+            start = time.perf_counter()
+            ok, body = post_form(f"{base_url}/{route}", form)
+            with lock:
+                route_latencies[route].append(time.perf_counter() - start)
+            return ok, body
+
+        def call(index):
+            call_sid = f"CA{index:032d}"
+            for route, answer in CALL_FLOW:
+                form = {"CallSid": call_sid}
+                if callable(answer):
+                    answer = answer(call_sid)
+                if answer:
+                    form["SpeechResult"] = answer
+                ok, body = timed_post(route, form)
+                if not ok:
+                    return ok, body
+            while "/gpt_reply</Redirect>" in body:
+                ok, body = timed_post("gpt_reply", {"CallSid": call_sid})
+            recording_sid = f"RE{index:032d}"
+            return timed_post("handle-recording", {
+                "CallSid": call_sid,
+                "RecordingSid": recording_sid,
+                "RecordingUrl": recordings.recording_url(recording_sid),
+            })
+
+        try:
+            _, errors, elapsed, _ = run_concurrently(call, range(args.calls), args.concurrency)
+        finally:
+            server.shutdown()
+
+        print(f"Webhooks: {args.calls} calls in {elapsed:.2f}s ({args.calls / elapsed:.1f} calls/s), "
+              f"{len(errors)} failed")
+        for route, latencies in route_latencies.items():
+            if latencies:
+                report(f"  /{route}", latencies, elapsed)
+
+        transcription_pipeline.TRIM_SILENCE = args.trim_silence
+        start = time.perf_counter()
+        results = transcription_pipeline.process_all_recordings(max_workers=args.workers,
+                                                                streaming=args.streaming)
+        elapsed = time.perf_counter() - start
+
+    transcribed = sum(1 for transcription in results.values() if transcription)
+    print(f"Pipeline: {transcribed}/{len(results)} recordings transcribed in {elapsed:.2f}s "
+          f"({transcribed / elapsed * 60 if elapsed else 0:.1f} recordings/minute, "
+          f"{args.workers} workers, {'streaming' if args.streaming else 'file'} mode)")
+
+
+def bench_long_call(args):
+    """Compare GCS + long_running_recognize against chunked recognition on long recordings."""
+    use_workdir()
+    transcription_pipeline = load_transcription_pipeline()
+    import job_queue
+
+    FakeSpeechClient.latency = args.speech_latency
+    FakeSpeechClient.realtime_factor = args.realtime_factor
+    FakeStorageClient.latency = args.gcs_latency
+
+    transcription_pipeline.TRIM_SILENCE = args.trim_silence
+    with FakeRecordingServer(latency=args.download_latency, seconds=args.recording_seconds,
+                             silence=args.silence) as recordings:
+        for chunked in (False, True):
+            transcription_pipeline.CHUNKED_RECOGNITION = chunked
+            mode = "chunked" if chunked else "GCS + long-running"
+            for index in range(args.recordings):
+                recording_sid = f"RE{chunked:d}{index:031d}"
+                job_queue.enqueue(recordings.recording_url(recording_sid))
+            requests_before = FakeSpeechClient.requests
+            metrics.reset()
+            start = time.perf_counter()
+            results = transcription_pipeline.process_all_recordings(max_workers=args.workers,
+                                                                    streaming=args.streaming)
+            elapsed = time.perf_counter() - start
+            transcribed = sum(1 for transcription in results.values() if transcription)
+            per_recording = metrics.snapshot()["summaries"].get("pipeline_stage_seconds{stage=total}", {})
+            print(f"{mode}: {transcribed}/{len(results)} recordings of {args.recording_seconds:.0f}s "
+                  f"in {elapsed:.2f}s, {FakeSpeechClient.requests - requests_before} Speech requests")
+            print(f"  per recording p50={per_recording.get('p50', 0.0):.2f}s "
+                  f"max={per_recording.get('p99', 0.0):.2f}s")
+            counters = metrics.snapshot()["counters"]
+            if args.trim_silence:
+                print(f"  silence trimmed: {counters.get('pipeline_trim_removed_seconds_total', 0.0):.0f}s "
+                      f"of {counters.get('pipeline_trim_input_seconds_total', 0.0):.0f}s")
+
+
+def bench_recording_latency(args):
+    """Recording-complete to transcript-available latency: cron-style batch runs versus inline workers."""
+    use_workdir()
+    receiving_call = load_receiving_call()
+    transcription_pipeline = load_transcription_pipeline()
+    import job_queue
+    import transcription_worker
+
+    FakeSpeechClient.latency = args.speech_latency
+    with FakeRecordingServer(latency=args.download_latency, seconds=args.recording_seconds) as recordings:
+        server, base_url = serve_app(receiving_call.app)
+        try:
+            for mode in ("batch", "inline"):
+                receiving_call.TRANSCRIPTION_WORKER_MODE = "inline" if mode == "inline" else ""
+                metrics.reset()
+                done_before = job_queue.queue_counts().get(job_queue.DONE, 0)
+                webhook_latencies = []
+                stop_cron = threading.Event()
+
+                def cron():
+                    # Stands in for a crontab entry running the pipeline every --cron-seconds
+                    while not stop_cron.wait(args.cron_seconds):
+                        transcription_pipeline.process_all_recordings(max_workers=args.workers)
+
+                if mode == "batch":
+                    threading.Thread(target=cron, daemon=True).start()
+                for index in range(args.recordings):
+                    recording_sid = f"RE{mode[0]}{index:031d}"
+                    start = time.perf_counter()
+                    post_form(f"{base_url}/handle-recording", {
+                        "CallSid": f"CA{mode[0]}{index:031d}",
+                        "RecordingSid": recording_sid,
+                        "RecordingUrl": recordings.recording_url(recording_sid),
+                    })
+                    webhook_latencies.append(time.perf_counter() - start)
+                    time.sleep(args.arrival_interval)
+
+                deadline = time.monotonic() + args.cron_seconds * 3 + 60
+                while (job_queue.queue_counts().get(job_queue.DONE, 0) - done_before < args.recordings
+                       and time.monotonic() < deadline):
+                    time.sleep(0.1)
+                stop_cron.set()
+
+                latency = metrics.snapshot()["summaries"].get("pipeline_enqueue_to_transcript_seconds", {})
+                label = (f"every {args.cron_seconds:.0f}s" if mode == "batch"
+                         else f"{transcription_worker.WORKER_THREADS} worker threads")
+                print(f"{mode} ({label}): {latency.get('count', 0)}/{args.recordings} transcribed, "
+                      f"recording to transcript p50={latency.get('p50', 0.0):.2f}s "
+                      f"p95={latency.get('p95', 0.0):.2f}s")
+                print(f"  /handle-recording p50={percentile(webhook_latencies, 50) * 1000:.1f}ms "
+                      f"p95={percentile(webhook_latencies, 95) * 1000:.1f}ms")
+        finally:
+            server.shutdown()
+
+
+def bench_backfill(args):
+    """Backfill a large backlog: scan memory, page cost, resume after interruption and the rate cap."""
+    workdir = use_workdir()
+    transcription_pipeline = load_transcription_pipeline()
+    import tracemalloc
+    import backfill
+    import job_queue
+    from models import DONE, ResponseData, get_session
+
+    FakeSpeechClient.latency = args.speech_latency
+    with FakeRecordingServer(latency=args.download_latency, seconds=args.recording_seconds) as recordings:
+        # Every other row is already transcribed, as in a table that live traffic has been filling
+        db_session = get_session()
+        db_session.execute(ResponseData.__table__.insert(), [
+            {"call_sid": f"CA{index:032d}", "recording_url": recordings.recording_url(f"RE{index:032d}"),
+             "transcription": "Speaker 1: done" if index % 2 else None}
+            for index in range(args.rows * 2)
+        ])
+        db_session.commit()
+        db_session.close()
+
+        tracemalloc.start()
+        db_session = get_session()
+        everything = db_session.query(ResponseData).filter(
+            ResponseData.transcription == None, ResponseData.recording_url != None).all()
+        _, all_peak = tracemalloc.get_traced_memory()
+        count = len(everything)
+        del everything
+        db_session.close()
+        tracemalloc.reset_peak()
+        streamed = sum(1 for _ in transcription_pipeline.get_unprocessed_recordings())
+        _, streamed_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Scan of {count} untranscribed rows: .all() peak {all_peak / 1e6:.1f} MB, "
+              f"keyset batches ({streamed} rows) peak {streamed_peak / 1e6:.1f} MB")
+
+        page_seconds = {}
+        for label, after_id in (("first", 0), ("last", args.rows * 2 - backfill.BATCH_SIZE * 2)):
+            start = time.perf_counter()
+            for _ in range(20):
+                transcription_pipeline.get_unprocessed_batch(after_id, backfill.BATCH_SIZE)
+            page_seconds[label] = (time.perf_counter() - start) / 20
+        print(f"Page of {backfill.BATCH_SIZE}: first {page_seconds['first'] * 1000:.2f}ms, "
+              f"last {page_seconds['last'] * 1000:.2f}ms")
+
+        # A queue worker already holds the first two recordings; the backfill must leave them alone
+        held = [job_queue.claim_recording(row.recording_url, row.call_sid, "queue-worker")
+                for row in transcription_pipeline.get_unprocessed_batch(0, 2)]
+
+        metrics.reset()
+        checkpoint = os.path.join(workdir, "backfill_checkpoint.json")
+        half = args.recordings // 2
+        start = time.perf_counter()
+        first = backfill.run_backfill(workers=args.workers, per_minute=args.rate, checkpoint_file=checkpoint,
+                                      limit=half, streaming=args.streaming)
+        # A fresh run picks up from the checkpoint the interrupted one left behind
+        resumed = backfill.run_backfill(workers=args.workers, per_minute=args.rate, checkpoint_file=checkpoint,
+                                        limit=args.recordings - half, streaming=args.streaming)
+        elapsed = time.perf_counter() - start
+
+    db_session = get_session()
+    stored = db_session.query(ResponseData).filter(ResponseData.transcript_turns != None).count()
+    db_session.close()
+    jobs = job_queue.queue_counts()
+    expected = args.recordings - len(held)
+    writes = metrics.snapshot()["summaries"].get("backfill_write_seconds", {})
+    print(f"Backfill: {resumed['transcribed']}/{expected} transcribed in {elapsed:.2f}s "
+          f"({resumed['processed'] / elapsed * 60:.0f} recordings/minute, cap {args.rate:.0f}), "
+          f"{stored} rows stored, {resumed['skipped']} held by a queue worker skipped")
+    print(f"  interrupted after row {first['last_id']}, resumed to row {resumed['last_id']}; "
+          f"{writes.get('count', 0)} bulk UPDATEs, p50={writes.get('p50', 0.0) * 1000:.1f}ms; jobs {jobs}")
+    ok = stored == expected and resumed["transcribed"] == expected and resumed["skipped"] == len(held)
+    return 0 if ok and jobs.get(DONE) == expected else 1
+
+
+def bench_live_stream(args):
+    """End-of-utterance to transcript-in-the-database latency for live calls over Media Streams."""
+    use_workdir()
+    load_transcription_pipeline()
+    import media_stream
+    from models import ResponseData, get_session
+
+    frame = bytes(range(160))
+    second = bytes(range(256)) * 32
+    for label, table in (("numpy", None), ("per byte", "python")):
+        if table:
+            media_stream.np = None
+        media_stream.decode_mulaw(frame)  # Builds the table (and imports numpy) outside the timing
+        for size, payload in (("20 ms frame", frame), ("1 s of audio", second)):
+            start = time.perf_counter()
+            for _ in range(2000):
+                media_stream.decode_mulaw(payload)
+            print(f"decode {label:<8} {size:<12} {(time.perf_counter() - start) / 2000 * 1e6:8.1f}us")
+    media_stream._ulaw_table = None  # Back to the numpy table for the calls
+
+    FakeSpeechClient.streaming_latency = args.speech_latency
+    streams = [FakeMediaStream(f"CA{index:032d}", utterances=args.utterances, speech_seconds=args.speech_seconds,
+                               pause_seconds=args.pause_seconds, seed=index) for index in range(args.calls)]
+    finals_seen = {stream.call_sid: 0 for stream in streams}
+    latencies = []
+    done = threading.Event()
+
+    def watch_database():
+        # Independent of the transcriber's own metric: when does each final line show up in the row?
+        while not done.is_set():
+            db_session = get_session()
+            rows = db_session.query(ResponseData.call_sid, ResponseData.live_transcript).filter(
+                ResponseData.live_transcript != None).all()
+            db_session.close()
+            now = time.monotonic()
+            for call_sid, live_transcript in rows:
+                lines = len(live_transcript.splitlines())
+                stream = next(stream for stream in streams if stream.call_sid == call_sid)
+                for index in range(finals_seen[call_sid], min(lines, len(stream.utterance_ends))):
+                    latencies.append(now - stream.utterance_ends[index])
+                finals_seen[call_sid] = max(finals_seen[call_sid], lines)
+            time.sleep(0.01)
+
+    metrics.reset()
+    watcher = threading.Thread(target=watch_database, daemon=True)
+    watcher.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.calls) as pool:
+        transcribers = list(pool.map(media_stream.handle_media_stream, streams))
+    for transcriber in transcribers:
+        transcriber.join(30)
+    time.sleep(0.1)
+    done.set()
+    watcher.join()
+    elapsed = time.perf_counter() - start
+
+    expected = args.calls * args.utterances
+    internal = metrics.snapshot()["summaries"].get("live_transcript_latency_seconds", {})
+    counters = metrics.snapshot()["counters"]
+    print(f"Live calls: {args.calls} calls of {args.utterances} utterances in {elapsed:.1f}s, "
+          f"{sum(finals_seen.values())}/{expected} final lines stored, "
+          f"{counters.get('live_transcript_results_total{kind=interim}', 0):.0f} interim results")
+    print(f"  end of utterance to transcript in the database (polled every 10ms): "
+          f"p50={percentile(latencies, 50) * 1000:.0f}ms p95={percentile(latencies, 95) * 1000:.0f}ms")
+    print(f"  transcriber's own measure: p50={internal.get('p50', 0.0) * 1000:.0f}ms "
+          f"p95={internal.get('p95', 0.0) * 1000:.0f}ms "
+          f"(endpointing {FakeSpeechClient.endpoint_seconds * 1000:.0f}ms + recognizer {args.speech_latency * 1000:.0f}ms)")
+    ok = sum(finals_seen.values()) == expected
+
+    # /voice is re-entered when the caller is silent or starts over; the call keeps its one stream
+    receiving_call = load_receiving_call()
+    receiving_call.LIVE_TRANSCRIPTION = True
+    receiving_call.sock = receiving_call.sock or object()  # Only checked for, not used by /voice
+    client = receiving_call.app.test_client()
+    stream_starts = sum("<Stream" in client.post("/voice", data={"CallSid": "CAvoice"}).get_data(as_text=True)
+                        for _ in range(3))
+    # A stream that reconnects carries on with the call's transcript rather than replacing it
+    call_sid = f"CR{0:032d}"
+    for seed in range(2):
+        media_stream.handle_media_stream(FakeMediaStream(
+            call_sid, utterances=args.utterances, speech_seconds=args.speech_seconds,
+            pause_seconds=args.pause_seconds, seed=seed)).join(30)
+    db_session = get_session()
+    reconnected = db_session.query(ResponseData.live_transcript).filter_by(call_sid=call_sid).scalar() or ""
+    db_session.close()
+    print(f"/voice three times: {stream_starts} stream started; stream reconnected: "
+          f"{len(reconnected.splitlines())}/{args.utterances * 2} final lines kept")
+    ok = ok and stream_starts == 1 and len(reconnected.splitlines()) == args.utterances * 2
+
+    # Streams breaking mid-call: reopened with the unfinalized audio sent again while restarts last,
+    # then audio is dropped instead of queued. Short utterances break before their first final result.
+    media_stream.STREAM_RESTART_DELAY = 0.05
+    timings = (("", args.speech_seconds, args.pause_seconds), (", short utterances", 1.0, 0.5))
+    for case, (timing, speech_seconds, pause_seconds) in enumerate(timings):
+        for label, broken in (("once", 1), ("every time", media_stream.MAX_STREAM_RESTARTS + 1)):
+            FakeSpeechClient.broken_streams = args.calls * broken
+            metrics.reset()
+            streams = [FakeMediaStream(f"CB{case}{broken}{index:030d}", utterances=args.utterances,
+                                       speech_seconds=speech_seconds, pause_seconds=pause_seconds, seed=index)
+                       for index in range(args.calls)]
+            with ThreadPoolExecutor(max_workers=args.calls) as pool:
+                transcribers = list(pool.map(media_stream.handle_media_stream, streams))
+            for transcriber in transcribers:
+                transcriber.join(30)
+            counters = metrics.snapshot()["counters"]
+            finals = sum(len(transcriber.finals) for transcriber in transcribers)
+            failed = sum(transcriber.failed for transcriber in transcribers)
+            queued = sum(transcriber._audio.qsize() for transcriber in transcribers)
+            print(f"Streams failing {label}{timing}: "
+                  f"{counters.get('live_transcript_streams_total{result=restarted}', 0):.0f} reopened, "
+                  f"{failed}/{args.calls} calls gave up, {finals}/{expected} final lines, "
+                  f"{queued} audio chunks left queued")
+            if broken == 1:
+                ok = ok and not failed and finals == expected
+            else:
+                ok = ok and failed == args.calls and queued == 0
+    FakeSpeechClient.broken_streams = 0
+    return 0 if ok else 1
+
+
+def bench_rate_limit(args):
+    """OpenAI over its quota and a Speech outage, with the shared limiter off and on."""
+    use_workdir()
+    receiving_call = load_receiving_call()
+    transcription_pipeline = load_transcription_pipeline()
+    import openai
+    import job_queue
+    import rate_limit
+
+    # One process with every quota to itself, as the modes below compare against the full quotas
+    rate_limit.use_share(share=1.0)
+    # Without the limiter: no client-side rate, no retries, no breaker, as before
+    unlimited = {"rate": 0, "max_concurrency": None, "max_retries": 0, "max_wait": None, "failure_threshold": 0}
+    speech_limits = dict(rate_limit.SERVICE_LIMITS["speech"])
+
+    db_session = receiving_call.get_session()
+    call_sids = {mode: [f"CA{mode[:3]}{index:029d}" for index in range(args.requests)] for mode in ("off", "on")}
+    # Distinct names so every prompt misses the response cache and reaches OpenAI
+    db_session.add_all(receiving_call.ResponseData(
+        call_sid=call_sid, first_name=f"Caller{call_sid[-6:]}{mode}", last_name="Lovelace", age="36",
+        residency="London") for mode, sids in call_sids.items() for call_sid in sids)
+    db_session.commit()
+    db_session.close()
+
+    with FakeOpenAIServer(latency=args.openai_latency, max_per_second=args.openai_limit) as fake_openai:
+        openai.api_base = fake_openai.api_base
+        openai.api_key = "sk-benchmark"
+        server, base_url = serve_app(receiving_call.app)
+
+        def converse(call_sid):
+            ok, body = post_form(f"{base_url}/start_gpt_conversation", {"CallSid": call_sid})
+            played = body
+            while ok and "/gpt_reply</Redirect>" in body:
+                ok, body = post_form(f"{base_url}/gpt_reply", {"CallSid": call_sid})
+                played += body
+            return ok, played
+
+        try:
+            for mode in ("off", "on"):
+                if mode == "off":
+                    rate_limit.configure("openai", **unlimited)
+                else:
+                    # Stay just under the quota, in a smooth stream rather than bursts
+                    rate_limit.configure("openai", rate=args.openai_limit * 0.9, burst=max(1, args.openai_limit // 10),
+                                         max_concurrency=None, max_retries=2, max_wait=args.max_wait,
+                                         failure_threshold=rate_limit.FAILURE_THRESHOLD)
+                metrics.reset()
+                time.sleep(1.0)  # Let the previous mode's requests leave the quota window
+                requests_before, throttled_before = fake_openai.requests, fake_openai.throttled
+                _, errors, elapsed, bodies = run_concurrently(converse, call_sids[mode], args.concurrency)
+                replied = sum(1 for body in bodies if FAKE_GPT_REPLY in body)
+                counters = metrics.snapshot()["counters"]
+                print(f"OpenAI, limiter {mode}: {replied}/{args.requests} callers heard the reply in {elapsed:.1f}s "
+                      f"({replied / elapsed:.1f} replies/s, quota {args.openai_limit}/s); "
+                      f"{fake_openai.requests - requests_before} requests, "
+                      f"{fake_openai.throttled - throttled_before} got 429, "
+                      f"{counters.get('rate_limit_retries_total{service=openai}', 0):.0f} retries")
+        finally:
+            server.shutdown()
+
+    FakeSpeechClient.latency = args.speech_latency
+    rate_limit.BACKOFF_BASE_SECONDS = 0.1
+    with FakeRecordingServer(latency=0.05, seconds=10.0) as recordings:
+        for mode in ("off", "on"):
+            if mode == "off":
+                rate_limit.configure("speech", **unlimited)
+            else:
+                rate_limit.configure("speech", **dict(speech_limits, failure_threshold=rate_limit.FAILURE_THRESHOLD,
+                                                      reset_seconds=args.reset_seconds))
+            for index in range(args.recordings):
+                job_queue.enqueue(recordings.recording_url(f"RE{mode[:3]}{index:029d}"))
+            metrics.reset()
+            FakeSpeechClient.outage = True
+            requests_before = FakeSpeechClient.requests
+            start = time.perf_counter()
+            transcription_pipeline.process_all_recordings(max_workers=args.workers)
+            outage_elapsed = time.perf_counter() - start
+            outage_requests = FakeSpeechClient.requests - requests_before
+            counters = metrics.snapshot()["counters"]
+            failed = counters.get("pipeline_recordings_total{result=failed}", 0)
+            deferred = counters.get("pipeline_recordings_total{result=deferred}", 0)
+            print(f"Speech outage, limiter {mode}: {args.recordings} recordings handled in {outage_elapsed:.1f}s "
+                  f"with {outage_requests} Speech requests; {failed:.0f} failed an attempt, {deferred:.0f} deferred")
+
+            # Recovery: failed jobs wait for their retry backoff, deferred ones only for the circuit to close
+            FakeSpeechClient.outage = False
+            start = time.perf_counter()
+            deadline = time.monotonic() + job_queue.RETRY_DELAY_SECONDS * 2
+            while (job_queue.queue_counts().get(job_queue.DONE, 0) < args.recordings
+                   and time.monotonic() < deadline):
+                transcription_pipeline.process_all_recordings(max_workers=args.workers)
+                time.sleep(0.2)
+            print(f"  after the outage ends: all transcribed {time.perf_counter() - start:.1f}s later; "
+                  f"queue {job_queue.queue_counts()}")
+            db_session = receiving_call.get_session()
+            db_session.query(job_queue.Job).delete()
+            db_session.commit()
+            db_session.close()
+
+    # Limits are per process, so the processes sharing a quota must not be granted more than all of it
+    rates = {}
+    for entry_point in rate_limit.DEFAULT_SHARES:
+        rate_limit.use_share(entry_point)
+        for service in rate_limit.SERVICE_LIMITS:
+            rates.setdefault(service, {})[entry_point] = rate_limit.limiter(service).bucket.rate
+    rate_limit.use_share(share=1.0)
+    over = []
+    for service, by_entry_point in rates.items():
+        print(f"Quota shares of {service} ({rate_limit.SERVICE_LIMITS[service]['rate']:.0f}/s): " + ", ".join(
+            f"{entry_point} {rate:.1f}/s" for entry_point, rate in by_entry_point.items()))
+        # Entry points that don't use a service keep its full quota; only those with a share count
+        shared = sum(by_entry_point[entry_point] for entry_point, shares in rate_limit.DEFAULT_SHARES.items()
+                     if service in shares)
+        if shared > rate_limit.SERVICE_LIMITS[service]["rate"] + 1e-9:
+            over.append(service)
+    return 1 if over else 0
+
+
+SEARCH_WORDS = (
+    "the I you a to and is it my that of in for have on this with be can was so do we what just about "
+    "yes no okay right well call number account bill payment policy claim phone address today week help "
+    "thank thanks please sure time need want know think get going said told back again still there "
+    "home car house insurance card email name date month year service order delivery problem question"
+).split()
+SEARCH_PHRASES = {"water damage in the kitchen": 0.001, "cancel my policy": 0.01}  # Share of calls saying each
+SEARCH_NAMES = ("Ada", "Grace", "Alan", "Linus", "Margaret", "Dennis", "Barbara", "Ken", "Frances", "Edsger")
+SEARCH_PLACES = ("London", "Paris", "Lagos", "Austin", "Osaka", "Lima", "Oslo", "Pune", "Accra", "Perth")
+
+
+def synthetic_transcript(rng, turns, words_per_turn):
+    """Turns of Zipf-distributed words from a small vocabulary plus rare made-up words, like call audio."""
+    weights = [1.0 / rank for rank in range(1, len(SEARCH_WORDS) + 1)]
+    result = []
+    for index in range(turns):
+        words = rng.choices(SEARCH_WORDS, weights, k=words_per_turn)
+        words[rng.randrange(words_per_turn)] = f"term{rng.randrange(50000)}"
+        result.append(words)
+    for phrase, share in SEARCH_PHRASES.items():
+        if rng.random() < share:
+            result[rng.randrange(turns)].extend(phrase.split())
+    return [{"speaker": index % 2 + 1, "start": index * 4.0, "end": index * 4.0 + 3.5, "confidence": 0.9,
+             "text": " ".join(words)} for index, words in enumerate(result)]
+
+
+def bench_search(args):
+    """Transcript search over a large synthetic corpus: index upkeep on pipeline writes and query latency."""
+    import random
+    use_workdir()
+    transcription_pipeline = load_transcription_pipeline()
+    import search_index
+    from diarized_transcript import turns_to_json
+    from models import ResponseData, get_session
+    from sqlalchemy import text
+
+    rng = random.Random(args.seed)
+    total = args.transcripts + args.unindexed
+    db_session = get_session()
+    db_session.execute(ResponseData.__table__.insert(), [
+        {"call_sid": f"CA{index:032d}", "recording_url": f"RE{index:032d}",
+         "first_name": rng.choice(SEARCH_NAMES), "residency": rng.choice(SEARCH_PLACES)}
+        for index in range(total)
+    ])
+    db_session.commit()
+    row_ids = [row_id for (row_id,) in db_session.execute(text("SELECT id FROM responses ORDER BY id"))]
+    db_session.close()
+
+    def write(ids):
+        # Through the pipeline's bulk write, as the backfill stores transcripts
+        start = time.perf_counter()
+        for offset in range(0, len(ids), args.batch_size):
+            batch = ids[offset:offset + args.batch_size]
+            transcription_pipeline.save_transcriptions_to_db(
+                {row_id: turns_to_json(synthetic_transcript(rng, args.turns, args.words_per_turn))
+                 for row_id in batch})
+        return time.perf_counter() - start
+
+    indexed_seconds = write(row_ids[:args.transcripts])
+    update_index = search_index.update_index
+    search_index.update_index = lambda db_session, condition: 0
+    unindexed_seconds = write(row_ids[args.transcripts:])
+    search_index.update_index = update_index
+    print(f"Stored {args.transcripts} transcripts ({args.turns} turns each) with the index kept up to date: "
+          f"{indexed_seconds / args.transcripts * 1000:.2f}ms each; "
+          f"without the index {unindexed_seconds / max(args.unindexed, 1) * 1000:.2f}ms each")
+
+    start = time.perf_counter()
+    rebuilt = search_index.rebuild_index()
+    print(f"Full rebuild of {rebuilt} transcripts: {time.perf_counter() - start:.1f}s")
+    db_session = get_session()
+    sizes = dict(db_session.execute(text(
+        "SELECT name LIKE 'transcript_search%', SUM(pgsize) FROM dbstat GROUP BY name LIKE 'transcript_search%'")).all())
+    db_session.close()
+    print(f"Database {sum(sizes.values()) / 1e6:.0f} MB, of which the search index {sizes.get(1, 0) / 1e6:.0f} MB")
+
+    phrase = next(iter(SEARCH_PHRASES))
+    common = list(SEARCH_PHRASES)[1]
+    cases = (
+        ("rare phrase", {"query": phrase}, "transcription LIKE :a", {"a": f"%{phrase}%"}),
+        ("common phrase", {"query": common}, "transcription LIKE :a", {"a": f"%{common}%"}),
+        ("words, any order", {"query": "kitchen damage", "phrase": False},
+         "transcription LIKE :a AND transcription LIKE :b", {"a": "%kitchen%", "b": "%damage%"}),
+        ("phrase + first name", {"query": common, "first_name": "ada"},
+         "transcription LIKE :a AND first_name LIKE :b", {"a": f"%{common}%", "b": "ada"}),
+        # LIKE can't tell which speaker said it, so it finds every call with the phrase
+        ("phrase by speaker 2", {"query": common, "speaker": 2}, "transcription LIKE :a", {"a": f"%{common}%"}),
+        ("first name only", {"first_name": "grace"}, "first_name LIKE :a", {"a": "grace"}),
+    )
+    for label, search_args, where, like_args in cases:
+        like_seconds, search_seconds = [], []
+        for _ in range(args.repeat):
+            db_session = get_session()
+            start = time.perf_counter()
+            matches = db_session.execute(text(f"SELECT call_sid FROM responses WHERE {where}"), like_args).all()
+            like_seconds.append(time.perf_counter() - start)
+            db_session.close()
+            start = time.perf_counter()
+            results = search_index.search(limit=args.limit, **search_args)
+            search_seconds.append(time.perf_counter() - start)
+        print(f"{label:<20} LIKE scan p50={percentile(like_seconds, 50) * 1000:7.1f}ms ({len(matches)} calls)  "
+              f"search p50={percentile(search_seconds, 50) * 1000:6.1f}ms "
+              f"({'top' if 'query' in search_args else 'newest'} {len(results)})")
+
+
+def bench_clients(args):
+    """Measure connection and client setup saved by the shared client registry."""
+    use_workdir()
+    transcription_pipeline = load_transcription_pipeline()
+    import clients
+    import job_queue
+
+    FakeSpeechClient.latency = args.speech_latency
+    FakeSpeechClient.setup_latency = args.client_setup_latency
+    FakeStorageClient.setup_latency = args.client_setup_latency
+    shared = (clients.http_session, clients.speech_client, clients.storage_client)
+    fresh = (clients.build_http_session, FakeSpeechClient, FakeStorageClient)
+
+    with FakeRecordingServer(latency=args.download_latency, seconds=args.recording_seconds,
+                             connect_latency=args.connect_latency) as recordings:
+        for reuse in (False, True):
+            # Without reuse every download gets a new session and every recording new clients
+            clients.http_session, clients.speech_client, clients.storage_client = shared if reuse else fresh
+            clients.reset()
+            for index in range(args.recordings):
+                job_queue.enqueue(recordings.recording_url(f"RE{reuse:d}{index:031d}"))
+            connections_before = recordings.connections
+            created_before = FakeSpeechClient.created
+            start = time.perf_counter()
+            results = transcription_pipeline.process_all_recordings(max_workers=args.workers,
+                                                                    streaming=args.streaming)
+            elapsed = time.perf_counter() - start
+            transcribed = sum(1 for transcription in results.values() if transcription)
+            mode = "shared clients" if reuse else "new client per use"
+            print(f"{mode}: {transcribed}/{len(results)} recordings in {elapsed:.2f}s, "
+                  f"{recordings.connections - connections_before} download connections, "
+                  f"{FakeSpeechClient.created - created_before} Speech clients created")
+
+        # A long-lived worker runs the pipeline over and over, each time with a new pool
+        for run in range(args.runs):
+            for index in range(args.workers):
+                job_queue.enqueue(recordings.recording_url(f"RR{run:03d}{index:029d}"))
+            transcription_pipeline.process_all_recordings(max_workers=args.workers, streaming=args.streaming)
+        held = len(clients._sessions)
+        print(f"after {args.runs} more pipeline runs: {held} HTTP sessions still held")
+    clients.http_session, clients.speech_client, clients.storage_client = shared
+    return 1 if held else 0
+
+
+# Modules whose import time is tracked, with a budget for their own code on top
+# of the frameworks they cannot avoid (measured in the same run, so the gate
+# does not depend on how fast the machine is) and the SDKs that must not be
+# loaded until first use
+IMPORT_BUDGETS_MS = {
+    "receiving_call": 150,
+    "transcription_pipeline": 150,
+}
+BASELINE_IMPORTS = {
+    "receiving_call": ("flask", "sqlalchemy", "sqlalchemy.orm", "twilio.twiml.voice_response",
+                       "twilio.request_validator"),
+    "transcription_pipeline": ("sqlalchemy", "sqlalchemy.orm"),
+}
+DEFERRED_IMPORTS = {
+    "receiving_call": ("openai", "twilio.rest", "numpy", "requests"),
+    "transcription_pipeline": ("google.cloud.speech", "google.cloud.storage", "numpy", "requests"),
+}
+
+
+def measure_import(modules, workdir):
+    """Import ``modules`` (in order) in a fresh interpreter with ``-X importtime``.
+
+    Returns (seconds spent in top-level imports, {imported module: cumulative seconds}).
+    """
+    code = "import all_access_keys; all_access_keys.DATABASE_URL = 'sqlite:///calls.db'"
+    for module in modules:
+        code += f"; import {module}"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True)
+    imported, top_level = {}, 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        imported[name.strip()] = int(cumulative) / 1e6
+        if not name.startswith("  ") and name.strip() != "all_access_keys":  # Nested imports are indented
+            top_level += int(cumulative) / 1e6
+    return top_level, imported
+
+
+def bench_import_time(args):
+    """Cold import time of both entry points over their framework baseline; fails if over
+    budget, if importing creates directories, or if an SDK loads eagerly."""
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    _, startup = measure_import((), workdir)  # Loaded by the interpreter itself, not by us
+    failed = False
+    for module, budget_ms in IMPORT_BUDGETS_MS.items():
+        baseline = min(measure_import(BASELINE_IMPORTS[module], workdir)[0] for _ in range(args.repeat))
+        runs = [measure_import((module,), workdir) for _ in range(args.repeat)]
+        best, imported = min(runs, key=lambda run: run[0])
+        own = best - baseline
+        eager = [name for name in DEFERRED_IMPORTS[module] if name in imported]
+        over = own * 1000 > budget_ms * args.budget_scale
+        created = sorted(name for name in os.listdir(workdir) if os.path.isdir(os.path.join(workdir, name)))
+        failed = failed or over or bool(eager) or bool(created)
+        print(f"{module}: {best * 1000:.0f}ms (best of {args.repeat}), {own * 1000:.0f}ms over the "
+              f"{baseline * 1000:.0f}ms framework baseline, budget {budget_ms * args.budget_scale:.0f}ms"
+              f"{' OVER BUDGET' if over else ''}")
+        heaviest = sorted(((seconds, name) for name, seconds in imported.items()
+                           if name != module and name not in startup and "." not in name), reverse=True)[:args.top]
+        print("  heaviest: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for seconds, name in heaviest))
+        if eager:
+            print(f"  imported eagerly: {', '.join(eager)}")
+        if created:
+            print(f"  import created directories: {', '.join(created)}")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks with local service stand-ins.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    gpt_load = subparsers.add_parser("gpt-load", help="Concurrent calls to /start_gpt_conversation")
+    gpt_load.add_argument("--requests", type=int, default=500)
+    gpt_load.add_argument("--concurrency", type=int, default=200)
+    gpt_load.add_argument("--openai-latency", type=float, default=1.0, help="Seconds per completion")
+    gpt_load.set_defaults(func=bench_gpt_load)
+
+    gpt_stream = subparsers.add_parser("gpt-stream", help="Time-to-first-sentence with GPT streaming on and off")
+    gpt_stream.add_argument("--requests", type=int, default=50)
+    gpt_stream.add_argument("--concurrency", type=int, default=25)
+    gpt_stream.add_argument("--openai-latency", type=float, default=0.5, help="Seconds to the first token")
+    gpt_stream.add_argument("--token-latency", type=float, default=0.05, help="Seconds between tokens")
+    gpt_stream.set_defaults(func=bench_gpt_stream)
+
+    gpt_cache = subparsers.add_parser("gpt-cache", help="Check paraphrases hit the GPT cache and other callers' prompts miss")
+    gpt_cache.add_argument("--entries", type=int, default=1000, help="Other callers' prompts in the cache")
+    gpt_cache.set_defaults(func=bench_gpt_cache)
+
+    gpt_processes = subparsers.add_parser("gpt-processes",
+                                          help="Calls whose webhooks land on different processes sharing Redis")
+    gpt_processes.add_argument("--processes", type=int, default=3)
+    gpt_processes.add_argument("--calls", type=int, default=50)
+    gpt_processes.add_argument("--concurrency", type=int, default=25)
+    gpt_processes.add_argument("--streaming", action="store_true", help="Play the reply sentence by sentence")
+    gpt_processes.add_argument("--openai-latency", type=float, default=1.0, help="Seconds to the first token")
+    gpt_processes.add_argument("--token-latency", type=float, default=0.05, help="Seconds between tokens")
+    gpt_processes.set_defaults(func=bench_gpt_processes)
+
+    end_to_end = subparsers.add_parser("e2e", help="Whole calls through the webhooks, then the pipeline")
+    end_to_end.add_argument("--calls", type=int, default=100)
+    end_to_end.add_argument("--concurrency", type=int, default=50)
+    end_to_end.add_argument("--workers", type=int, default=8, help="Pipeline workers")
+    end_to_end.add_argument("--streaming", action="store_true", help="Use the in-memory pipeline path")
+    end_to_end.add_argument("--openai-latency", type=float, default=1.0)
+    end_to_end.add_argument("--download-latency", type=float, default=0.1)
+    end_to_end.add_argument("--speech-latency", type=float, default=1.0)
+    end_to_end.add_argument("--gcs-latency", type=float, default=0.5)
+    end_to_end.add_argument("--recording-seconds", type=float, default=30.0)
+    end_to_end.add_argument("--sample-rate", type=int, default=16000,
+                            help="Anything but 16000 makes the pipeline transcode with ffmpeg")
+    end_to_end.add_argument("--silence", type=float, default=0.0,
+                            help="Fraction of each recording that is dead air")
+    end_to_end.add_argument("--trim-silence", action="store_true", help="Enable the silence-trimming stage")
+    end_to_end.set_defaults(func=bench_end_to_end)
+
+    long_call = subparsers.add_parser("long-call", help="Long recordings via GCS versus chunked recognition")
+    long_call.add_argument("--recordings", type=int, default=4)
+    long_call.add_argument("--recording-seconds", type=float, default=600.0)
+    long_call.add_argument("--workers", type=int, default=4, help="Pipeline workers")
+    long_call.add_argument("--streaming", action="store_true", help="Use the in-memory pipeline path")
+    long_call.add_argument("--download-latency", type=float, default=0.1)
+    long_call.add_argument("--speech-latency", type=float, default=1.0, help="Seconds per Speech request")
+    long_call.add_argument("--realtime-factor", type=float, default=0.02,
+                           help="Extra Speech seconds per second of audio")
+    long_call.add_argument("--gcs-latency", type=float, default=0.5)
+    long_call.add_argument("--silence", type=float, default=0.0,
+                           help="Fraction of each recording that is dead air")
+    long_call.add_argument("--trim-silence", action="store_true", help="Enable the silence-trimming stage")
+    long_call.set_defaults(func=bench_long_call)
+
+    client_reuse = subparsers.add_parser("clients", help="Connection and client reuse in the pipeline")
+    client_reuse.add_argument("--recordings", type=int, default=50)
+    client_reuse.add_argument("--recording-seconds", type=float, default=20.0)
+    client_reuse.add_argument("--workers", type=int, default=4, help="Pipeline workers")
+    client_reuse.add_argument("--streaming", action="store_true", help="Use the in-memory pipeline path")
+    client_reuse.add_argument("--download-latency", type=float, default=0.05)
+    client_reuse.add_argument("--connect-latency", type=float, default=0.15,
+                              help="Seconds per new download connection, standing in for TLS setup")
+    client_reuse.add_argument("--speech-latency", type=float, default=0.5)
+    client_reuse.add_argument("--client-setup-latency", type=float, default=0.3,
+                              help="Seconds to create a Speech or Storage client (channel setup)")
+    client_reuse.add_argument("--runs", type=int, default=5,
+                              help="Extra pipeline runs, each with a new pool, to check for leaked sessions")
+    client_reuse.set_defaults(func=bench_clients)
+
+    recording_latency = subparsers.add_parser("recording-latency",
+                                              help="Recording to transcript latency, batch runs versus inline workers")
+    recording_latency.add_argument("--recordings", type=int, default=20)
+    recording_latency.add_argument("--arrival-interval", type=float, default=0.5,
+                                   help="Seconds between recording webhooks")
+    recording_latency.add_argument("--cron-seconds", type=float, default=30.0,
+                                   help="Interval between batch pipeline runs")
+    recording_latency.add_argument("--workers", type=int, default=4, help="Batch pipeline workers")
+    recording_latency.add_argument("--recording-seconds", type=float, default=20.0)
+    recording_latency.add_argument("--download-latency", type=float, default=0.1)
+    recording_latency.add_argument("--speech-latency", type=float, default=1.0)
+    recording_latency.set_defaults(func=bench_recording_latency)
+
+    backfill = subparsers.add_parser("backfill", help="Bulk backfill of a large backlog of old recordings")
+    backfill.add_argument("--rows", type=int, default=100000, help="Untranscribed rows in the table")
+    backfill.add_argument("--recordings", type=int, default=200, help="How many of them to backfill")
+    backfill.add_argument("--rate", type=float, default=600.0, help="Recordings per minute cap")
+    backfill.add_argument("--workers", type=int, default=4)
+    backfill.add_argument("--streaming", action="store_true", help="Use the in-memory pipeline path")
+    backfill.add_argument("--recording-seconds", type=float, default=5.0)
+    backfill.add_argument("--download-latency", type=float, default=0.05)
+    backfill.add_argument("--speech-latency", type=float, default=0.2)
+    backfill.set_defaults(func=bench_backfill)
+
+    live_stream = subparsers.add_parser("live-stream", help="Live transcription latency over Media Streams")
+    live_stream.add_argument("--calls", type=int, default=10, help="Concurrent calls")
+    live_stream.add_argument("--utterances", type=int, default=3, help="Utterances per call")
+    live_stream.add_argument("--speech-seconds", type=float, default=2.0)
+    live_stream.add_argument("--pause-seconds", type=float, default=1.0)
+    live_stream.add_argument("--speech-latency", type=float, default=0.1,
+                             help="Recognizer seconds from detecting the end of an utterance to its final result")
+    live_stream.set_defaults(func=bench_live_stream)
+
+    limits = subparsers.add_parser("rate-limit", help="OpenAI over quota and a Speech outage, limiter off and on")
+    limits.add_argument("--requests", type=int, default=150, help="GPT conversations per mode")
+    limits.add_argument("--concurrency", type=int, default=50)
+    limits.add_argument("--openai-latency", type=float, default=0.5)
+    limits.add_argument("--openai-limit", type=int, default=20, help="Requests per second before OpenAI returns 429")
+    limits.add_argument("--max-wait", type=float, default=10.0, help="Longest a GPT request queues for its turn")
+    limits.add_argument("--recordings", type=int, default=30, help="Recordings per mode in the Speech outage")
+    limits.add_argument("--workers", type=int, default=8, help="Pipeline workers")
+    limits.add_argument("--speech-latency", type=float, default=0.2)
+    limits.add_argument("--reset-seconds", type=float, default=5.0, help="How long an open circuit fails fast")
+    limits.set_defaults(func=bench_rate_limit)
+
+    search = subparsers.add_parser("search", help="Transcript search index upkeep and queries over a large corpus")
+    search.add_argument("--transcripts", type=int, default=100000)
+    search.add_argument("--unindexed", type=int, default=5000,
+                        help="Further transcripts stored with index upkeep off, for comparison")
+    search.add_argument("--turns", type=int, default=8, help="Speaker turns per transcript")
+    search.add_argument("--words-per-turn", type=int, default=12)
+    search.add_argument("--batch-size", type=int, default=500, help="Transcripts per bulk write")
+    search.add_argument("--limit", type=int, default=20, help="Calls returned per search")
+    search.add_argument("--repeat", type=int, default=5)
+    search.add_argument("--seed", type=int, default=7)
+    search.set_defaults(func=bench_search)
+
+    import_time = subparsers.add_parser("import-time", help="Cold import time of both entry points")
+    import_time.add_argument("--repeat", type=int, default=5)
+    import_time.add_argument("--top", type=int, default=5, help="How many of the heaviest imports to list")
+    import_time.add_argument("--budget-scale", type=float, default=1.0,
+                             help="Multiply the budgets, e.g. on slow CI machines")
+    import_time.set_defaults(func=bench_import_time)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import json
+import logging
+import threading
+import time
+
+from ttl_cache import TTLCache
+
+# Per-call conversation state. Answers from each Gather step accumulate here
+# and are written to the database once, when the call finishes or is abandoned,
+# instead of one SELECT+UPDATE+COMMIT per step. The stores also hold short-lived
+# named values that every webhook process must see, such as a GPT reply being
+# generated by one process and played by whichever one Twilio calls next.
+
+CALL_STATE_TTL_SECONDS = 900   # A call idle this long is treated as abandoned
+CALL_STATE_MAX_CALLS = 10000
+VALUE_TTL_SECONDS = 300        # How long a named value lives after it was last set
+EXPIRE_INTERVAL_SECONDS = 60   # How often the expiry thread looks for abandoned calls
+
+
+class InMemoryCallStateStore:
+    """In-process LRU store with TTL. Only suitable for a single webhook process."""
+
+    def __init__(self, ttl=CALL_STATE_TTL_SECONDS, maxsize=CALL_STATE_MAX_CALLS, on_abandon=None,
+                 value_ttl=VALUE_TTL_SECONDS):
+        self.on_abandon = on_abandon
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, on_evict=self._abandoned)
+        self._values = TTLCache(maxsize=maxsize, ttl=value_ttl)
+        self._lock = threading.Lock()
+
+    def _abandoned(self, call_sid, state):
+        if self.on_abandon:
+            self.on_abandon(call_sid, state)
+
+    def get(self, call_sid):
+        return self._cache.get(call_sid)
+
+    def update(self, call_sid, **fields):
+        """Merge answers into the call's state and refresh its TTL; returns the new state."""
+        with self._lock:
+            state = dict(self._cache.get(call_sid) or {})
+            state.update(fields)
+            self._cache.set(call_sid, state)
+        return state
+
+    def pop(self, call_sid):
+        return self._cache.pop(call_sid)
+
+    def expire(self):
+        """Hand every idle call to ``on_abandon``; returns how many there were."""
+        return len(self._cache.expire())
+
+    def drain(self):
+        """Remove and return every call's state, e.g. to flush it before the process exits."""
+        return self._cache.drain()
+
+    def get_value(self, name):
+        return self._values.get(name)
+
+    def set_value(self, name, value, only_if_new=False):
+        """Store a JSON-serializable value; returns False if ``only_if_new`` and it already exists."""
+        with self._lock:
+            if only_if_new and self._values.get(name) is not None:
+                return False
+            # Stored as JSON, like the Redis store, so later changes by the caller don't leak in
+            self._values.set(name, json.loads(json.dumps(value)))
+        return True
+
+    def delete_value(self, name):
+        self._values.pop(name)
+
+
+class RedisCallStateStore:
+    """Shared store on any Redis-compatible server, for multiple webhook processes.
+
+    Each call is a JSON value under ``call_state:<CallSid>``; a sorted set of
+    last-update times lets ``expire`` find abandoned calls, since Redis key
+    expiry alone cannot tell us which calls to flush.
+    """
+
+    KEY_PREFIX = "call_state:"
+    VALUE_PREFIX = "call_value:"
+    TOUCHED_KEY = "call_state:touched"
+    SWEEP_INTERVAL = 60  # Seconds between abandoned-call sweeps triggered by update()
+
+    def __init__(self, client, ttl=CALL_STATE_TTL_SECONDS, on_abandon=None, value_ttl=VALUE_TTL_SECONDS):
+        self.client = client
+        self.ttl = ttl
+        self.on_abandon = on_abandon
+        self.value_ttl = value_ttl
+        self._next_sweep = 0.0
+
+    def _key(self, call_sid):
+        return f"{self.KEY_PREFIX}{call_sid}"
+
+    def get(self, call_sid):
+        value = self.client.get(self._key(call_sid))
+        return json.loads(value) if value else None
+
+    def update(self, call_sid, **fields):
+        key = self._key(call_sid)
+        state = self.get(call_sid) or {}
+        state.update(fields)
+        pipe = self.client.pipeline()
+        # The key outlives the TTL so expire() can still flush it
+        pipe.set(key, json.dumps(state), ex=max(1, int(self.ttl * 2)))
+        pipe.zadd(self.TOUCHED_KEY, {call_sid: time.time()})
+        pipe.execute()
+        if time.time() >= self._next_sweep:
+            self._next_sweep = time.time() + self.SWEEP_INTERVAL
+            self.expire()
+        return state
+
+    def pop(self, call_sid):
+        key = self._key(call_sid)
+        pipe = self.client.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        pipe.zrem(self.TOUCHED_KEY, call_sid)
+        value, _, removed = pipe.execute()
+        # zrem tells us whether we won the race against another process popping the same call
+        return json.loads(value) if value and removed else None
+
+    def expire(self):
+        """Hand every idle call to ``on_abandon``; safe to run from several processes."""
+        abandoned = 0
+        for call_sid in self.client.zrangebyscore(self.TOUCHED_KEY, "-inf", time.time() - self.ttl):
+            if isinstance(call_sid, bytes):
+                call_sid = call_sid.decode("utf-8")
+            state = self.pop(call_sid)
+            if state is not None:
+                abandoned += 1
+                if self.on_abandon:
+                    self.on_abandon(call_sid, state)
+        return abandoned
+
+    def drain(self):
+        """Nothing to hand over: the state outlives this process, and the others expire it."""
+        return []
+
+    def get_value(self, name):
+        value = self.client.get(f"{self.VALUE_PREFIX}{name}")
+        return json.loads(value) if value else None
+
+    def set_value(self, name, value, only_if_new=False):
+        """Store a JSON-serializable value; returns False if ``only_if_new`` and it already exists."""
+        return bool(self.client.set(f"{self.VALUE_PREFIX}{name}", json.dumps(value),
+                                    ex=max(1, int(self.value_ttl)), nx=only_if_new))
+
+    def delete_value(self, name):
+        self.client.delete(f"{self.VALUE_PREFIX}{name}")
+
+
+def start_expiry_thread(store, interval=EXPIRE_INTERVAL_SECONDS):
+    """Run ``store.expire()`` every ``interval`` seconds on a daemon thread.
+
+    Otherwise abandoned calls are only noticed when another call's state is
+    updated, and never once the phone goes quiet.
+    """
+    def sweep():
+        while True:
+            time.sleep(interval)
+            try:
+                store.expire()
+            except Exception as e:
+                logging.error(f"Error expiring abandoned calls: {e}")
+
+    thread = threading.Thread(target=sweep, name="call-state-expiry", daemon=True)
+    thread.start()
+    return thread
+
+
+def create_call_state_store(url="", on_abandon=None, value_ttl=VALUE_TTL_SECONDS):
+    """Build the store named by ``url``: empty for in-process, ``redis://...`` for Redis."""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError:
+            logging.error("The redis package is required for a Redis call state store; using in-process store")
+        else:
+            return RedisCallStateStore(redis.Redis.from_url(url), on_abandon=on_abandon, value_ttl=value_ttl)
+    return InMemoryCallStateStore(on_abandon=on_abandon, value_ttl=value_ttl)
@@ -0,0 +1,136 @@
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from diarized_transcript import extract_words
+
+try:
+    import numpy as np
+except ImportError:  # Without numpy windows are cut at fixed offsets
+    np = None
+
+# Long recordings are split into overlapping windows that fit the synchronous
+# Recognize call, recognized in parallel, and stitched back together. Windows
+# end at the quietest point near their nominal end so words are not cut in
+# half; the overlap before each cut is recognized twice and used to match the
+# next window's speaker tags to the ones already assigned.
+
+WINDOW_SECONDS = 55          # Synchronous recognition accepts at most 60 s
+OVERLAP_SECONDS = 4          # Audio shared by neighbouring windows
+SILENCE_SEARCH_SECONDS = 8   # How far before the nominal end to look for a pause
+FRAME_SECONDS = 0.02         # Energy is compared over frames this long
+MAX_WINDOW_WORKERS = 8       # Concurrent Recognize calls per recording
+SAME_WORD_TOLERANCE = 0.3    # Seconds between the midpoints of one word seen twice
+
+
+def quietest_point(samples, start, end, frame):
+    """Sample index in the middle of the lowest-energy frame of ``samples[start:end]``."""
+    usable = (end - start) // frame * frame
+    if usable <= 0:
+        return end
+    frames = samples[start:start + usable].astype(np.float32).reshape(-1, frame)
+    energy = np.einsum("ij,ij->i", frames, frames)
+    return start + int(np.argmin(energy)) * frame + frame // 2
+
+
+def plan_windows(pcm, sample_rate, window_seconds=WINDOW_SECONDS, overlap_seconds=OVERLAP_SECONDS):
+    """Split mono PCM16 into ``(start, end)`` sample ranges of at most ``window_seconds``.
+
+    Each window after the first starts ``overlap_seconds`` before the end of
+    the previous one.
+    """
+    total = len(pcm) // 2
+    window = int(window_seconds * sample_rate)
+    overlap = int(overlap_seconds * sample_rate)
+    search = int(SILENCE_SEARCH_SECONDS * sample_rate)
+    frame = max(1, int(FRAME_SECONDS * sample_rate))
+    if window <= overlap + frame:
+        raise ValueError("Windows must be longer than their overlap")
+    samples = np.frombuffer(pcm, dtype="<i2", count=total) if np is not None else None
+
+    windows = []
+    start = 0
+    while start + window < total:
+        end = start + window
+        if samples is not None:
+            # Never cut so early that the next window would not move forward
+            end = quietest_point(samples, max(start + overlap + frame, end - search), end, frame)
+        windows.append((start, end))
+        start = end - overlap
+    windows.append((start, total))
+    return windows
+
+
+def _midpoint(word):
+    return (word["start"] + word["end"]) / 2
+
+
+def match_speakers(previous, current, known_tags, local_tags):
+    """Map a window's ``local_tags`` onto the speaker tags already in use.
+
+    ``previous`` and ``current`` are the words both windows recognized in their
+    overlap. Each word heard by both votes for pairing its two tags; tags with
+    no votes take the lowest unused known tag, or a new one.
+    """
+    votes = Counter()
+    for word in current:
+        middle = _midpoint(word)
+        closest = min(previous, key=lambda seen: abs(_midpoint(seen) - middle), default=None)
+        if closest is not None and abs(_midpoint(closest) - middle) <= SAME_WORD_TOLERANCE:
+            votes[word["speaker"], closest["speaker"]] += 2 if closest["word"] == word["word"] else 1
+
+    mapping = {}
+    for (local, known), _ in votes.most_common():
+        if local not in mapping and known not in mapping.values():
+            mapping[local] = known
+    spare = sorted(set(known_tags) - set(mapping.values()))
+    next_tag = max(known_tags, default=0) + 1
+    for local in sorted(set(local_tags) - set(mapping)):
+        if spare:
+            mapping[local] = spare.pop(0)
+        else:
+            mapping[local] = next_tag
+            next_tag += 1
+    return mapping
+
+
+def stitch_words(window_words, windows, sample_rate):
+    """Merge per-window word lists (already in absolute time) into one transcript.
+
+    In each overlap the earlier window's words are kept, since that window
+    ends at a pause while the later one starts mid-speech.
+    """
+    stitched = []
+    known_tags = set()
+    for index, words in enumerate(window_words):
+        if index > 0:
+            overlap_start = windows[index][0] / float(sample_rate)
+            cut = windows[index - 1][1] / float(sample_rate)
+            previous = []
+            for word in reversed(stitched):
+                if word["end"] < overlap_start:
+                    break
+                previous.append(word)
+            overlapping = [word for word in words if _midpoint(word) < cut]
+            if not previous and overlapping:
+                logging.warning(f"No words to match speakers on around {cut:.1f}s; tags may not line up")
+            mapping = match_speakers(previous, overlapping, known_tags, {word["speaker"] for word in words})
+            words = [dict(word, speaker=mapping[word["speaker"]]) for word in words if _midpoint(word) >= cut]
+        stitched.extend(words)
+        known_tags.update(word["speaker"] for word in words)
+    return stitched
+
+
+def recognize_in_windows(recognize, pcm, sample_rate, max_workers=MAX_WINDOW_WORKERS):
+    """Recognize long PCM16 audio as parallel windows and return the stitched words.
+
+    ``recognize(window_pcm)`` must return a diarized Speech response. An
+    exception from any window propagates to the caller.
+    """
+    windows = plan_windows(pcm, sample_rate)
+    logging.info(f"Recognizing {len(pcm) / 2.0 / sample_rate:.1f}s of audio as {len(windows)} windows")
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(windows))) as executor:
+        responses = list(executor.map(lambda window: recognize(pcm[window[0] * 2:window[1] * 2]), windows))
+    window_words = [extract_words(response, start / float(sample_rate))
+                    for response, (start, _) in zip(responses, windows)]
+    return stitch_words(window_words, windows, sample_rate)
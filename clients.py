@@ -0,0 +1,103 @@
+import logging
+import threading
+
+# Shared clients for the pipeline's outbound services, created on first use
+# and reused so each recording does not pay for a fresh TLS handshake or gRPC
+# channel. Speech and Storage clients are thread-safe and shared by every
+# worker; requests sessions are not guaranteed to be, so each thread gets its
+# own, and it keeps its connections alive between recordings. A session is
+# closed once its thread has exited, so worker pools that come and go do not
+# leave sockets behind. The SDKs are imported on first use to keep startup fast.
+
+HTTP_POOL_SIZE = 16               # Connections kept per host
+HTTP_RETRIES = 3                  # Retries for connection errors and retryable statuses
+HTTP_BACKOFF_FACTOR = 0.5         # Sleeps 0.5 s, 1 s, 2 s between retries
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_TIMEOUT_SECONDS = (10, 60)   # Connect and read timeouts for downloads
+
+_lock = threading.Lock()
+_clients = {}
+_local = threading.local()
+_sessions = {}  # Thread -> its session, until the thread exits or reset() runs
+_generation = 0  # Bumped by reset() so every thread drops its old session
+
+
+def _shared(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                logging.info(f"Creating shared {name} client")
+                client = _clients[name] = factory()
+    return client
+
+
+def build_http_session():
+    """A requests session with keep-alive pooling and retries with exponential backoff."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def http_session():
+    """This thread's pooled requests session."""
+    session = getattr(_local, "session", None)
+    if session is None or _local.generation != _generation:
+        session = build_http_session()
+        with _lock:
+            finished = _pop_finished_sessions()
+            _sessions[threading.current_thread()] = session
+            _local.session, _local.generation = session, _generation
+        for old in finished:
+            old.close()
+    return session
+
+
+def _pop_finished_sessions():
+    """Remove and return the sessions of threads that have exited. Caller holds _lock."""
+    threads = [thread for thread in _sessions if not thread.is_alive()]
+    return [_sessions.pop(thread) for thread in threads]
+
+
+def close_finished_sessions():
+    """Close the sessions of threads that have exited, e.g. after a worker pool shuts down."""
+    with _lock:
+        finished = _pop_finished_sessions()
+    for session in finished:
+        session.close()
+    return len(finished)
+
+
+def speech_client():
+    from google.cloud import speech
+    return _shared("speech", speech.SpeechClient)
+
+
+def storage_client():
+    from google.cloud import storage
+    return _shared("storage", storage.Client)
+
+
+def reset():
+    """Close and forget every client, e.g. after changing credentials or in a forked worker."""
+    global _generation
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+        _clients.clear()
+        _generation += 1
+    for session in sessions:
+        session.close()
@@ -0,0 +1,80 @@
+import json
+
+# Diarized transcripts as speaker turns. Recognition responses are reduced to
+# word timings, consecutive words by the same speaker are grouped into turns,
+# and turns are stored as compact columnar JSON next to a rendered text view.
+
+TRANSCRIPT_FORMAT_VERSION = 1
+
+
+def extract_words(response, offset=0.0):
+    """Word timings from a diarized Speech response, shifted by ``offset`` seconds.
+
+    With diarization enabled the last result repeats every word of the audio
+    with its speaker tag, so that is the only result read.
+    """
+    for result in reversed(response.results):
+        if result.alternatives and result.alternatives[0].words:
+            return [
+                {
+                    "word": word_info.word,
+                    "speaker": word_info.speaker_tag,
+                    "start": offset + word_info.start_time.total_seconds(),
+                    "end": offset + word_info.end_time.total_seconds(),
+                    "confidence": word_info.confidence,
+                }
+                for word_info in result.alternatives[0].words
+            ]
+    return []
+
+
+def build_turns(words):
+    """Group consecutive words by speaker into turns, in a single pass.
+
+    Each turn has speaker, start, end, confidence (the mean over its words)
+    and text.
+    """
+    turns = []
+    turn_words = []
+    confidence_sum = 0.0
+    for word in words:
+        if turn_words and word["speaker"] != turns[-1]["speaker"]:
+            turns[-1].update(text=" ".join(turn_words), confidence=confidence_sum / len(turn_words))
+            turn_words = []
+            confidence_sum = 0.0
+        if not turn_words:
+            turns.append({"speaker": word["speaker"], "start": word["start"]})
+        turns[-1]["end"] = word["end"]
+        turn_words.append(word["word"])
+        confidence_sum += word["confidence"]
+    if turn_words:
+        turns[-1].update(text=" ".join(turn_words), confidence=confidence_sum / len(turn_words))
+    return turns
+
+
+def render_turns(turns):
+    """Text view of a transcript: one ``Speaker N: ...`` line per turn."""
+    return "\n".join(f"Speaker {turn['speaker']}: {turn['text']}" for turn in turns)
+
+
+def turns_to_json(turns):
+    """Serialize turns column by column, with times rounded to milliseconds."""
+    return json.dumps({
+        "version": TRANSCRIPT_FORMAT_VERSION,
+        "speaker": [turn["speaker"] for turn in turns],
+        "start": [round(turn["start"], 3) for turn in turns],
+        "end": [round(turn["end"], 3) for turn in turns],
+        "confidence": [round(turn["confidence"], 3) for turn in turns],
+        "text": [turn["text"] for turn in turns],
+    }, separators=(",", ":"))
+
+
+def turns_from_json(document):
+    """Inverse of ``turns_to_json``."""
+    columns = json.loads(document)
+    return [
+        {"speaker": speaker, "start": start, "end": end, "confidence": confidence, "text": text}
+        for speaker, start, end, confidence, text in zip(
+            columns["speaker"], columns["start"], columns["end"], columns["confidence"], columns["text"]
+        )
+    ]
@@ -0,0 +1,495 @@
+import base64
+import json
+import re
+import threading
+import time
+from array import array
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the external services, used by benchmark.py.
+# Each server listens on 127.0.0.1 with an OS-assigned port and adds a
+# configurable latency to every request, and optionally to every new
+# connection to stand in for a TLS handshake.
+
+FAKE_GPT_REPLY = (
+    "Thanks for calling, it was lovely to hear from you today. "
+    "London is a wonderful place to live, with plenty of parks and museums to explore. "
+    "At your age there is a lot to enjoy there, from the theatre to the river walks. "
+    "Is there anything else you would like to talk about?"
+)
+
+
+class FakeServer:
+    """Run a ThreadingHTTPServer in a background thread; use as a context manager."""
+
+    handler_class = BaseHTTPRequestHandler
+
+    def __init__(self, latency=0.0, connect_latency=0.0, max_per_second=0):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.max_per_second = max_per_second  # Requests over this in any second get a 429 (0 for no limit)
+        self.requests = 0
+        self.connections = 0
+        self.throttled = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 1024
+        self.httpd.fake = self
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def over_limit(self):
+        """Whether this request is over ``max_per_second``; counted in ``throttled`` if so."""
+        if not self.max_per_second:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and self._recent[0] <= now - 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_per_second:
+                self.throttled += 1
+                return True
+            self._recent.append(now)
+            return False
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        fake = self.server.fake
+        fake.count_connection()
+        time.sleep(fake.connect_latency)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+
+class FakeOpenAIHandler(QuietHandler):
+    def do_POST(self):
+        fake = self.server.fake
+        fake.count_request()
+        payload = self.read_json()
+        if fake.over_limit():
+            self.send_json({"error": {"message": "Rate limit reached for requests", "type": "requests"}}, status=429)
+            return
+        time.sleep(fake.latency)
+        if not self.path.endswith("/chat/completions"):
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+            return
+        if payload.get("stream"):
+            self.stream_completion(payload)
+            return
+        time.sleep(fake.token_latency * len(re.findall(r"\S+\s*", fake.reply)))
+        self.send_json({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": fake.reply},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    def stream_completion(self, payload):
+        """Send the reply word by word as server-sent events, like ``stream=True``."""
+        fake = self.server.fake
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in re.findall(r"\S+\s*", fake.reply):
+            self.send_event({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            })
+            time.sleep(fake.token_latency)
+        self.send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_event(self, data):
+        line = data if isinstance(data, str) else json.dumps(data)
+        event = f"data: {line}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOpenAIServer(FakeServer):
+    """Speaks enough of the OpenAI chat completions API for ``openai.api_base``.
+
+    ``latency`` is the time to the first token and ``token_latency`` the gap
+    between tokens, so a non-streamed reply takes the sum of both.
+    """
+
+    handler_class = FakeOpenAIHandler
+
+    def __init__(self, latency=0.0, reply=FAKE_GPT_REPLY, token_latency=0.0, max_per_second=0):
+        super().__init__(latency, max_per_second=max_per_second)
+        self.reply = reply
+        self.token_latency = token_latency
+
+    @property
+    def api_base(self):
+        return f"{self.url}/v1"
+
+
+def make_wav(seconds, sample_rate=16000, seed=0, silence=0.0):
+    """Return a mono PCM16 WAV file of random noise as bytes.
+
+    ``silence`` is the fraction of every ten seconds that is dead air instead.
+    """
+    import io
+    import random
+    import wave
+    rng = random.Random(seed)
+    frames = bytearray(rng.randbytes(int(seconds * sample_rate) * 2))
+    block = 10 * sample_rate * 2
+    quiet = int(silence * 10 * sample_rate) * 2
+    for end in range(block, len(frames) + block, block):
+        frames[max(0, end - quiet):end] = bytes(len(frames[max(0, end - quiet):end]))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(frames)
+    return buffer.getvalue()
+
+
+class FakeRecordingHandler(QuietHandler):
+    def do_GET(self):
+        fake = self.server.fake
+        fake.count_request()
+        time.sleep(fake.latency)
+        body = fake.recording(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/x-wav")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeRecordingServer(FakeServer):
+    """Serves a distinct WAV recording for every path, like Twilio's RecordingUrl."""
+
+    handler_class = FakeRecordingHandler
+
+    def __init__(self, latency=0.0, seconds=10.0, sample_rate=16000, silence=0.0, connect_latency=0.0):
+        super().__init__(latency, connect_latency)
+        self.seconds = seconds
+        self.sample_rate = sample_rate
+        self.silence = silence
+        self._recordings = {}
+
+    def recording(self, path):
+        with self._lock:
+            body = self._recordings.get(path)
+        if body is None:
+            body = make_wav(self.seconds, self.sample_rate, seed=path, silence=self.silence)
+            with self._lock:
+                self._recordings[path] = body
+        return body
+
+    def recording_url(self, recording_sid):
+        return f"{self.url}/2010-04-01/Accounts/ACfake/Recordings/{recording_sid}"
+
+
+def encode_mulaw(pcm):
+    """Linear PCM16 bytes to G.711 μ-law, as Twilio sends call audio."""
+    import numpy as np
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.int32)
+    sign = (samples < 0).astype(np.int32) << 7
+    magnitude = np.minimum(np.abs(samples), 32635) + 0x84
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+
+class FakeMediaStream:
+    """A Twilio Media Stream for one call, replayed into ``handle_media_stream``.
+
+    Stands in for flask-sock's WebSocket: ``receive()`` returns Twilio's
+    connected, start, media and stop messages in order, pacing the 20 ms media
+    frames in real time. The audio is ``utterances`` bursts of noise of
+    ``speech_seconds`` each followed by ``pause_seconds`` of silence;
+    ``utterance_ends`` records when the last frame of each burst was handed over.
+    """
+
+    def __init__(self, call_sid, utterances=3, speech_seconds=2.0, pause_seconds=1.0, seed=0):
+        import random
+        rng = random.Random(seed)
+        self.call_sid = call_sid
+        self.utterance_ends = []
+        self._frames = []  # (payload, ends_utterance)
+        frame_samples = 160
+        silence = encode_mulaw(bytes(frame_samples * 2))
+        for _ in range(utterances):
+            speech_frames = int(speech_seconds * 50)
+            for index in range(speech_frames):
+                pcm = array("h", (rng.randint(-8000, 8000) for _ in range(frame_samples))).tobytes()
+                self._frames.append((encode_mulaw(pcm), index == speech_frames - 1))
+            self._frames.extend((silence, False) for _ in range(int(pause_seconds * 50)))
+        self._messages = self._script()
+
+    def _script(self):
+        stream_sid = f"MZ{self.call_sid[2:]}"
+        yield {"event": "connected", "protocol": "Call", "version": "1.0.0"}
+        yield {"event": "start", "streamSid": stream_sid, "start": {
+            "callSid": self.call_sid, "streamSid": stream_sid, "tracks": ["inbound"],
+            "mediaFormat": {"encoding": "audio/x-mulaw", "sampleRate": 8000, "channels": 1}}}
+        started_at = time.monotonic()
+        for index, (payload, ends_utterance) in enumerate(self._frames):
+            # Twilio sends each frame once its 20 ms of audio has been captured
+            time.sleep(max(0.0, started_at + (index + 1) * 0.02 - time.monotonic()))
+            if ends_utterance:
+                self.utterance_ends.append(time.monotonic())
+            yield {"event": "media", "streamSid": stream_sid, "media": {
+                "track": "inbound", "chunk": str(index + 1), "timestamp": str(index * 20),
+                "payload": base64.b64encode(payload).decode("ascii")}}
+        yield {"event": "stop", "streamSid": stream_sid, "stop": {"callSid": self.call_sid}}
+
+    def receive(self, timeout=None):
+        message = next(self._messages, None)
+        return json.dumps(message) if message is not None else None
+
+    def send(self, data):
+        pass
+
+
+# Speech and Storage stand-ins. They replace the google.cloud client classes
+# in-process; latencies are class attributes because the pipeline builds its
+# clients without arguments. ``setup_latency`` is paid by every new client,
+# like opening a gRPC channel, and ``created`` counts them.
+
+class _Obj:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+FAKE_TRANSCRIPT = [
+    (1, "Hello thanks for calling how can I help you today"),
+    (2, "Hi I wanted to ask about my account please"),
+    (1, "Of course let me pull that up for you"),
+]
+
+
+def fake_recognize_response(seconds):
+    """Build a diarized Speech response whose words are spread over ``seconds``."""
+    from datetime import timedelta
+    words = [(tag, word) for tag, sentence in FAKE_TRANSCRIPT for word in sentence.split()]
+    step = seconds / len(words)
+    word_infos = [
+        _Obj(word=word, speaker_tag=tag, confidence=0.9,
+             start_time=timedelta(seconds=i * step), end_time=timedelta(seconds=(i + 1) * step))
+        for i, (tag, word) in enumerate(words)
+    ]
+    transcript = " ".join(word for _, word in words)
+    # With diarization the last result carries every word, as the real API does
+    return _Obj(results=[
+        _Obj(alternatives=[_Obj(transcript=transcript, confidence=0.9, words=[])]),
+        _Obj(alternatives=[_Obj(transcript="", confidence=0.9, words=word_infos)]),
+    ])
+
+
+class FakeOperation:
+    def __init__(self, response, latency):
+        self._response = response
+        self._latency = latency
+
+    def result(self, timeout=None):
+        time.sleep(self._latency)
+        return self._response
+
+
+# Sizes of everything "uploaded" to FakeStorageClient, by gs:// URI, so the
+# fake recognizer knows how long audio referenced by URI is
+uploaded_sizes = {}
+
+
+class FakeApiError(Exception):
+    """Stands in for google.api_core's errors, whose ``code`` is the HTTP status."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeSpeechClient:
+    """``latency`` is per request; ``realtime_factor`` adds seconds per second of audio.
+
+    Requests beyond ``max_per_second`` fail with a 429, and every request fails
+    with a 503 while ``outage`` is set. The next ``broken_streams`` streaming
+    sessions fail with a 503 after their first second of audio.
+    """
+
+    latency = 0.5
+    realtime_factor = 0.0
+    setup_latency = 0.0
+    streaming_latency = 0.1    # From the end of an utterance being detected to its final result
+    endpoint_seconds = 0.5     # Silence that ends an utterance in streaming recognition
+    interim_seconds = 0.3      # Speech between interim results
+    max_per_second = 0
+    outage = False
+    broken_streams = 0
+    requests = 0
+    throttled = 0
+    created = 0
+    _recent = deque()
+    _lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        FakeSpeechClient.created += 1
+        time.sleep(self.setup_latency)
+
+    @staticmethod
+    def _seconds(config, audio):
+        if audio.content:
+            return len(audio.content) / float(config.sample_rate_hertz * 2)
+        if audio.uri in uploaded_sizes:
+            return uploaded_sizes[audio.uri] / float(config.sample_rate_hertz * 2)
+        return 120.0
+
+    def _latency(self, seconds):
+        return self.latency + self.realtime_factor * seconds
+
+    def _admit(self):
+        now = time.monotonic()
+        with FakeSpeechClient._lock:
+            FakeSpeechClient.requests += 1
+            if self.outage:
+                raise FakeApiError(503, "The service is currently unavailable.")
+            recent = FakeSpeechClient._recent
+            while recent and recent[0] <= now - 1.0:
+                recent.popleft()
+            if self.max_per_second and len(recent) >= self.max_per_second:
+                FakeSpeechClient.throttled += 1
+                raise FakeApiError(429, "Quota exceeded for requests per second.")
+            recent.append(now)
+
+    def recognize(self, config=None, audio=None, **kwargs):
+        self._admit()
+        seconds = self._seconds(config, audio)
+        time.sleep(self._latency(seconds))
+        return fake_recognize_response(seconds)
+
+    def long_running_recognize(self, config=None, audio=None, **kwargs):
+        self._admit()
+        seconds = self._seconds(config, audio)
+        return FakeOperation(fake_recognize_response(seconds), self._latency(seconds))
+
+    def streaming_recognize(self, config=None, requests=None, **kwargs):
+        """Yield interim results while loud audio arrives and a final one after each pause.
+
+        Utterances are read as the lines of FAKE_TRANSCRIPT in turn.
+        """
+        from datetime import timedelta
+        FakeSpeechClient.requests += 1
+        sample_rate = config.config.sample_rate_hertz
+        frame = sample_rate // 50
+        position = 0          # Samples seen so far
+        speech_end = None     # Sample at which the current utterance's last loud frame ended
+        spoken = 0            # Samples of speech in the current utterance
+        last_interim = 0
+        utterance = 0
+        with FakeSpeechClient._lock:
+            breaks = FakeSpeechClient.broken_streams > 0
+            FakeSpeechClient.broken_streams -= breaks
+        for request in requests:
+            if breaks and position >= sample_rate:
+                raise FakeApiError(503, "The service is currently unavailable.")
+            samples = array("h", request.audio_content)
+            for start in range(0, len(samples), frame):
+                loud = max(map(abs, samples[start:start + frame]), default=0) > 500
+                position += len(samples[start:start + frame])
+                if loud:
+                    speech_end = position
+                    spoken += frame
+                    if spoken - last_interim >= self.interim_seconds * sample_rate:
+                        last_interim = spoken
+                        words = FAKE_TRANSCRIPT[utterance % len(FAKE_TRANSCRIPT)][1].split()
+                        partial = " ".join(words[:max(1, len(words) * spoken // (2 * sample_rate))])
+                        yield _Obj(results=[_Obj(alternatives=[_Obj(transcript=partial, confidence=0.0)],
+                                                 is_final=False, result_end_time=timedelta(0))])
+                elif speech_end is not None and position - speech_end >= self.endpoint_seconds * sample_rate:
+                    time.sleep(self.streaming_latency)
+                    text = FAKE_TRANSCRIPT[utterance % len(FAKE_TRANSCRIPT)][1]
+                    yield _Obj(results=[_Obj(alternatives=[_Obj(transcript=text, confidence=0.9)], is_final=True,
+                                             result_end_time=timedelta(seconds=speech_end / sample_rate))])
+                    utterance += 1
+                    speech_end = None
+                    spoken = last_interim = 0
+
+
+class FakeBlob:
+    def __init__(self, latency, uri):
+        self.latency = latency
+        self.uri = uri
+
+    def upload_from_filename(self, file_path, **kwargs):
+        import os
+        uploaded_sizes[self.uri] = os.path.getsize(file_path)
+        time.sleep(self.latency)
+
+    def upload_from_string(self, data, **kwargs):
+        uploaded_sizes[self.uri] = len(data)
+        time.sleep(self.latency)
+
+
+class FakeStorageClient:
+    latency = 0.2
+    setup_latency = 0.0
+    created = 0
+
+    def __init__(self, *args, **kwargs):
+        FakeStorageClient.created += 1
+        time.sleep(self.setup_latency)
+
+    def bucket(self, name):
+        return _Obj(blob=lambda blob_name: FakeBlob(self.latency, f"gs://{name}/{blob_name}"))
@@ -0,0 +1,204 @@
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from models import Job, get_session, PENDING, CLAIMED, DONE, FAILED
+
+# Durable transcription job queue shared by the webhook and pipeline workers.
+# Jobs move pending -> claimed -> done, or back to pending on a retryable
+# failure until MAX_ATTEMPTS is reached, after which they are marked failed.
+
+LEASE_SECONDS = 1800       # Long enough for a 900 s long_running_recognize
+MAX_ATTEMPTS = 3
+RETRY_DELAY_SECONDS = 30   # Doubled after every failed attempt
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def recording_sid_from_url(recording_url):
+    """Twilio recording URLs end with the RecordingSid."""
+    return recording_url.rstrip("/").split("/")[-1]
+
+
+def enqueue(recording_url, call_sid=None, recording_sid=None):
+    """Add a recording to the queue unless it is already there.
+
+    Enqueueing is idempotent on the recording SID, so webhook retries and
+    repeated pipeline runs never create duplicate work.
+    Returns True if a new job was created.
+    """
+    recording_sid = recording_sid or recording_sid_from_url(recording_url)
+    db_session = get_session()
+    try:
+        if db_session.query(Job.id).filter_by(recording_sid=recording_sid).first():
+            return False
+        db_session.add(Job(recording_sid=recording_sid, recording_url=recording_url, call_sid=call_sid))
+        db_session.commit()
+        logging.info(f"Enqueued recording {recording_sid}")
+        return True
+    except IntegrityError:
+        # Another writer enqueued the same recording between our check and insert
+        db_session.rollback()
+        return False
+    finally:
+        db_session.close()
+
+
+def claim_jobs(worker_id=None, limit=1, lease_seconds=LEASE_SECONDS):
+    """Claim up to ``limit`` runnable jobs for this worker.
+
+    A job is runnable when it is pending and due, or when a previous worker's
+    lease has expired. Each claim is a conditional UPDATE, so two workers
+    racing for the same row cannot both win it.
+    """
+    worker_id = worker_id or default_worker_id()
+    now = datetime.utcnow()
+    runnable = or_(
+        and_(Job.state == PENDING, Job.available_at <= now),
+        and_(Job.state == CLAIMED, Job.lease_expires_at < now),
+    )
+    db_session = get_session()
+    try:
+        # Expired leases that already used up their attempts will never succeed
+        db_session.query(Job).filter(
+            Job.state == CLAIMED, Job.lease_expires_at < now, Job.attempts >= MAX_ATTEMPTS
+        ).update({Job.state: FAILED, Job.last_error: "Lease expired"}, synchronize_session=False)
+        db_session.commit()
+
+        candidate_ids = [row.id for row in db_session.query(Job.id).filter(runnable).order_by(Job.id).limit(limit)]
+        claimed = []
+        for job_id in candidate_ids:
+            updated = db_session.query(Job).filter(Job.id == job_id, runnable).update({
+                Job.state: CLAIMED,
+                Job.claimed_by: worker_id,
+                Job.lease_expires_at: now + timedelta(seconds=lease_seconds),
+                Job.attempts: Job.attempts + 1,
+            }, synchronize_session=False)
+            db_session.commit()
+            if updated:
+                claimed.append(db_session.get(Job, job_id))
+        return claimed
+    except Exception as e:
+        logging.error(f"Error claiming jobs: {e}")
+        db_session.rollback()
+        return []
+    finally:
+        db_session.close()
+
+
+def claim_recording(recording_url, call_sid=None, worker_id=None, lease_seconds=LEASE_SECONDS):
+    """Claim one particular recording's job, enqueueing it first if it has none.
+
+    For callers that pick their own recordings, like the backfill, so a
+    recording is never transcribed by them and a queue worker at once.
+    Failed jobs can be claimed again; jobs that are done, waiting for a
+    retry or leased to another worker cannot. Returns the Job, or None.
+    """
+    recording_sid = recording_sid_from_url(recording_url)
+    enqueue(recording_url, call_sid, recording_sid)
+    worker_id = worker_id or default_worker_id()
+    now = datetime.utcnow()
+    claimable = and_(Job.recording_sid == recording_sid, or_(
+        and_(Job.state == PENDING, Job.available_at <= now),
+        and_(Job.state == CLAIMED, Job.lease_expires_at < now),
+        Job.state == FAILED,
+    ))
+    db_session = get_session()
+    try:
+        updated = db_session.query(Job).filter(claimable).update({
+            Job.state: CLAIMED,
+            Job.claimed_by: worker_id,
+            Job.lease_expires_at: now + timedelta(seconds=lease_seconds),
+            Job.attempts: Job.attempts + 1,
+        }, synchronize_session=False)
+        db_session.commit()
+        if not updated:
+            return None
+        return db_session.query(Job).filter_by(recording_sid=recording_sid).first()
+    except Exception as e:
+        logging.error(f"Error claiming recording {recording_sid}: {e}")
+        db_session.rollback()
+        return None
+    finally:
+        db_session.close()
+
+
+def complete_job(job_id):
+    _set_state([job_id], DONE)
+
+
+def complete_jobs(job_ids):
+    """Mark many jobs done with one UPDATE."""
+    if job_ids:
+        _set_state(job_ids, DONE)
+
+
+def fail_job(job_id, error=None):
+    """Record a failed attempt; the job is retried with backoff until MAX_ATTEMPTS."""
+    db_session = get_session()
+    try:
+        job = db_session.get(Job, job_id)
+        if not job:
+            return
+        job.last_error = str(error) if error else None
+        job.lease_expires_at = None
+        if job.attempts >= MAX_ATTEMPTS:
+            job.state = FAILED
+            logging.error(f"Job for recording {job.recording_sid} failed after {job.attempts} attempts")
+        else:
+            job.state = PENDING
+            job.available_at = datetime.utcnow() + timedelta(seconds=RETRY_DELAY_SECONDS * 2 ** (job.attempts - 1))
+            logging.warning(f"Job for recording {job.recording_sid} will be retried (attempt {job.attempts})")
+        db_session.commit()
+    except Exception as e:
+        logging.error(f"Error failing job {job_id}: {e}")
+        db_session.rollback()
+    finally:
+        db_session.close()
+
+
+def defer_job(job_id, delay_seconds, error=None):
+    """Put a job back without counting the attempt, e.g. while a provider's circuit is open."""
+    db_session = get_session()
+    try:
+        db_session.query(Job).filter_by(id=job_id).update({
+            Job.state: PENDING,
+            Job.attempts: Job.attempts - 1,
+            Job.available_at: datetime.utcnow() + timedelta(seconds=delay_seconds),
+            Job.lease_expires_at: None,
+            Job.last_error: str(error) if error else None,
+        }, synchronize_session=False)
+        db_session.commit()
+        logging.warning(f"Job {job_id} deferred for {delay_seconds:.0f}s")
+    except Exception as e:
+        logging.error(f"Error deferring job {job_id}: {e}")
+        db_session.rollback()
+    finally:
+        db_session.close()
+
+
+def _set_state(job_ids, state):
+    db_session = get_session()
+    try:
+        db_session.query(Job).filter(Job.id.in_(job_ids)).update(
+            {Job.state: state, Job.lease_expires_at: None}, synchronize_session=False
+        )
+        db_session.commit()
+    except Exception as e:
+        logging.error(f"Error updating jobs {job_ids} to {state}: {e}")
+        db_session.rollback()
+    finally:
+        db_session.close()
+
+
+def queue_counts():
+    """Return the number of jobs in each state."""
+    db_session = get_session()
+    try:
+        return dict(db_session.query(Job.state, func.count(Job.id)).group_by(Job.state).all())
+    finally:
+        db_session.close()
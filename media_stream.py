@@ -0,0 +1,321 @@
+import base64
+import bisect
+import json
+import logging
+import queue
+import threading
+import time
+from array import array
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+import clients
+import metrics
+from models import ResponseData, get_session
+from ttl_cache import TTLCache
+
+# Live transcription through Twilio Media Streams. Twilio sends each call's
+# inbound audio over a WebSocket as 20 ms frames of base64 μ-law at 8 kHz.
+# Frames are decoded to PCM16 with a lookup table and fed to one streaming
+# recognizer session per call. Final results are appended to the call's
+# live_transcript, one line each; the current interim hypothesis is kept in
+# live_transcript_interim until its final replaces it. The recording is still
+# transcribed with diarization after the call; this is the early view. A
+# stream that fails is reopened up to MAX_STREAM_RESTARTS times per call;
+# after that the call has no live transcript and its audio is dropped. Audio
+# sent since the last final result is kept and sent again first whenever a
+# stream is reopened, so an utterance cut off by a failure or by the stream
+# time limit is still recognized.
+# The final lines are kept per call rather than per WebSocket, so a call whose
+# stream reconnects carries on with the transcript it already has.
+
+MULAW_SAMPLE_RATE = 8000
+LANGUAGE_CODE = "en-US"
+STREAM_LIMIT_SECONDS = 290     # Speech ends a stream after about 5 minutes of audio; reopen before then
+MAX_REQUEST_SECONDS = 0.1      # Queued frames are sent together, up to this much audio per request
+INTERIM_WRITE_SECONDS = 0.5    # Interim results are written at most this often; finals always are
+MAX_STREAM_RESTARTS = 2        # Failed streams reopened per call before live transcription gives up
+STREAM_RESTART_DELAY = 0.5     # Seconds before reopening a failed stream
+MAX_REPLAY_SECONDS = 30.0      # Most unfinalized audio kept for sending again (e.g. through a long silence)
+LIVE_CALL_TTL_SECONDS = 4 * 3600  # How long a call's final lines are kept for a reconnecting stream
+LIVE_CALL_MAX_CALLS = 10000
+
+np = None  # numpy, imported with the decode table on the first frame
+_ulaw_table = None
+_ulaw_table_lock = threading.Lock()
+_call_finals = TTLCache(maxsize=LIVE_CALL_MAX_CALLS, ttl=LIVE_CALL_TTL_SECONDS)
+_call_finals_lock = threading.Lock()
+
+
+def _ulaw_to_linear(code):
+    """G.711 μ-law expansion of one code."""
+    code = ~code & 0xFF
+    magnitude = ((((code & 0x0F) << 3) + 0x84) << ((code >> 4) & 0x07)) - 0x84
+    return -magnitude if code & 0x80 else magnitude
+
+
+def ulaw_table():
+    """Decode table for all 256 μ-law codes, as a numpy array when numpy is installed."""
+    global np, _ulaw_table
+    if _ulaw_table is None:
+        with _ulaw_table_lock:
+            if _ulaw_table is None:
+                table = [_ulaw_to_linear(code) for code in range(256)]
+                try:
+                    import numpy
+                    np = numpy
+                    _ulaw_table = np.array(table, dtype="<i2")
+                except ImportError:  # Decoded a byte at a time instead
+                    _ulaw_table = array("h", table)
+    return _ulaw_table
+
+
+def decode_mulaw(payload):
+    """μ-law bytes to little-endian PCM16 bytes."""
+    table = ulaw_table()
+    if np is not None:
+        return table[np.frombuffer(payload, dtype=np.uint8)].tobytes()
+    return array("h", [table[code] for code in payload]).tobytes()
+
+
+def call_finals(call_sid):
+    """The call's list of final lines, shared by every stream the call opens."""
+    with _call_finals_lock:
+        finals = _call_finals.get(call_sid)
+        if finals is None:
+            finals = []
+            _call_finals.set(call_sid, finals)
+        return finals
+
+
+def save_live_transcript(call_sid, final_text, interim_text, retry=True):
+    """Write the call's live transcript so far, creating its row if the call has none yet."""
+    db_session = get_session()
+    try:
+        with metrics.timer("live_transcript_db_seconds"):
+            updated = db_session.execute(
+                update(ResponseData).where(ResponseData.call_sid == call_sid).values(
+                    live_transcript=final_text, live_transcript_interim=interim_text)
+            ).rowcount
+            if not updated:
+                db_session.add(ResponseData(call_sid=call_sid, live_transcript=final_text,
+                                            live_transcript_interim=interim_text))
+            db_session.commit()
+        return True
+    except IntegrityError as e:
+        db_session.rollback()
+        if retry:
+            # The webhooks created the row between our UPDATE and INSERT; it is there to update now
+            return save_live_transcript(call_sid, final_text, interim_text, retry=False)
+        logging.error(f"Error saving live transcript for CallSid={call_sid}: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Error saving live transcript for CallSid={call_sid}: {e}")
+        db_session.rollback()
+        return False
+    finally:
+        db_session.close()
+
+
+class StreamingTranscriber:
+    """One call's streaming recognition session, run on its own thread.
+
+    ``add_audio`` takes PCM16 at 8 kHz from the WebSocket thread; ``close``
+    ends the session once the audio already queued has been sent. ``failed``
+    is set once recognition has given up, after which audio is dropped.
+    """
+
+    def __init__(self, call_sid):
+        self.call_sid = call_sid
+        self.finals = call_finals(call_sid)
+        self.interim = ""
+        self._audio = queue.Queue()
+        self._finished = False      # The call's last audio has been sent
+        self._received_seconds = 0.0
+        self._sent_seconds = 0.0
+        self._arrival_seconds = []  # Audio time at the end of each chunk...
+        self._arrival_times = []    # ...and when that chunk arrived
+        self._stream_offset = 0.0   # Audio time at which the current stream started
+        self._unfinalized = []      # (audio time, PCM) of each request sent since the last final result
+        self._unfinalized_lock = threading.Lock()
+        self._last_write = 0.0
+        self._dirty = False
+        self.failed = False
+        self._thread = threading.Thread(target=self._run, name=f"live-{call_sid}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add_audio(self, pcm):
+        """Queue audio for recognition; returns False, dropping it, once recognition has failed."""
+        if self.failed:
+            return False
+        self._received_seconds += len(pcm) / 2.0 / MULAW_SAMPLE_RATE
+        self._arrival_seconds.append(self._received_seconds)
+        self._arrival_times.append(time.monotonic())
+        self._audio.put(pcm)
+        return True
+
+    def close(self):
+        if not self.failed:
+            self._audio.put(None)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _sent(self, start, pcm):
+        with self._unfinalized_lock:
+            self._unfinalized.append((start, pcm))
+            while self._unfinalized and start - self._unfinalized[0][0] > MAX_REPLAY_SECONDS:
+                self._unfinalized.pop(0)
+
+    def _requests(self, speech, replay):
+        """Audio requests for one stream: ``replay`` first, then new audio until
+        ``STREAM_LIMIT_SECONDS`` or the call closes."""
+        stream_seconds = 0.0
+        for start, pcm in replay:
+            self._sent(start, pcm)
+            stream_seconds += len(pcm) / 2.0 / MULAW_SAMPLE_RATE
+            yield speech.StreamingRecognizeRequest(audio_content=pcm)
+        max_bytes = int(MAX_REQUEST_SECONDS * MULAW_SAMPLE_RATE) * 2
+        while not self._finished and stream_seconds < STREAM_LIMIT_SECONDS:
+            chunk = self._audio.get()
+            if chunk is None:
+                self._finished = True
+                return
+            chunks = [chunk]
+            size = len(chunk)
+            while size < max_bytes:
+                try:
+                    chunk = self._audio.get_nowait()
+                except queue.Empty:
+                    break
+                if chunk is None:
+                    self._audio.put(None)  # Seen again by the next get, after this request is sent
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            pcm = b"".join(chunks)
+            self._sent(self._sent_seconds, pcm)
+            stream_seconds += size / 2.0 / MULAW_SAMPLE_RATE
+            self._sent_seconds += size / 2.0 / MULAW_SAMPLE_RATE
+            yield speech.StreamingRecognizeRequest(audio_content=pcm)
+
+    def _run(self):
+        from google.cloud import speech
+        streaming_config = speech.StreamingRecognitionConfig(
+            config=speech.RecognitionConfig(
+                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+                sample_rate_hertz=MULAW_SAMPLE_RATE,
+                language_code=LANGUAGE_CODE,
+                enable_automatic_punctuation=True,
+            ),
+            interim_results=True,
+        )
+        restarts = 0
+        while True:
+            # After a stream hits its time limit or fails, the next one starts with the audio not yet finalized
+            with self._unfinalized_lock:
+                replay, self._unfinalized = self._unfinalized, []
+            self._stream_offset = replay[0][0] if replay else self._sent_seconds
+            try:
+                responses = clients.speech_client().streaming_recognize(streaming_config,
+                                                                        self._requests(speech, replay))
+                for response in responses:
+                    for result in response.results:
+                        self._handle_result(result)
+                if self._finished:
+                    break
+            except Exception as e:
+                if self._finished and not self._unfinalized:
+                    break
+                if restarts >= MAX_STREAM_RESTARTS:
+                    logging.error(f"Streaming recognition failed for CallSid={self.call_sid}; "
+                                  f"no more live transcript for this call: {e}")
+                    metrics.inc("live_transcript_streams_total", result="failed")
+                    self._give_up()
+                    break
+                restarts += 1
+                logging.warning(f"Streaming recognition failed for CallSid={self.call_sid}, "
+                                f"reopening ({restarts}/{MAX_STREAM_RESTARTS}): {e}")
+                metrics.inc("live_transcript_streams_total", result="restarted")
+                time.sleep(STREAM_RESTART_DELAY)
+        if self._dirty:
+            self._write()
+
+    def _give_up(self):
+        """Stop taking audio and free what is already queued."""
+        self.failed = True
+        with self._unfinalized_lock:
+            self._unfinalized = []
+        while True:
+            try:
+                self._audio.get_nowait()
+            except queue.Empty:
+                return
+
+    def _handle_result(self, result):
+        if not result.alternatives:
+            return
+        text = result.alternatives[0].transcript.strip()
+        if result.is_final:
+            if text:
+                self.finals.append(text)
+            self.interim = ""
+            self._write()
+            metrics.inc("live_transcript_results_total", kind="final")
+            end = self._stream_offset + result.result_end_time.total_seconds()
+            with self._unfinalized_lock:
+                # Requests wholly before the end of this result never need sending again
+                self._unfinalized = [(start, pcm) for start, pcm in self._unfinalized
+                                     if start + len(pcm) / 2.0 / MULAW_SAMPLE_RATE > end]
+            metrics.observe("live_transcript_latency_seconds", time.monotonic() - self._arrival_time(end))
+        else:
+            self.interim = text
+            self._dirty = True
+            metrics.inc("live_transcript_results_total", kind="interim")
+            if time.monotonic() - self._last_write >= INTERIM_WRITE_SECONDS:
+                self._write()
+
+    def _arrival_time(self, audio_seconds):
+        """When the audio up to ``audio_seconds`` had arrived from Twilio."""
+        index = min(bisect.bisect_left(self._arrival_seconds, audio_seconds), len(self._arrival_times) - 1)
+        return self._arrival_times[index]
+
+    def _write(self):
+        self._last_write = time.monotonic()
+        self._dirty = False
+        save_live_transcript(self.call_sid, "\n".join(self.finals), self.interim or None)
+
+
+def handle_media_stream(ws):
+    """Serve one Twilio Media Stream connection until the call's stream stops.
+
+    ``ws`` needs ``receive()``, returning each text message or None once the
+    socket is closed (as flask-sock's WebSocket does).
+    """
+    transcriber = None
+    try:
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            event = json.loads(message)
+            kind = event.get("event")
+            if kind == "start":
+                call_sid = event["start"]["callSid"]
+                logging.info(f"Media stream started for CallSid={call_sid}")
+                transcriber = StreamingTranscriber(call_sid).start()
+            elif kind == "media" and transcriber is not None and not transcriber.failed:
+                transcriber.add_audio(decode_mulaw(base64.b64decode(event["media"]["payload"])))
+            elif kind == "stop":
+                break
+    except Exception as e:
+        logging.error(f"Media stream error: {e}")
+    finally:
+        if transcriber is not None:
+            transcriber.close()
+            logging.info(f"Media stream stopped for CallSid={transcriber.call_sid}")
+    return transcriber
@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Minimal in-process metrics shared by the webhook server and the pipeline.
+# Counters only go up; gauges hold the latest value set; summaries keep a
+# count, a sum and a window of recent observations for percentiles. All
+# accept labels, e.g.
+# ``observe("pipeline_stage_seconds", 1.2, stage="download")``.
+
+SUMMARY_WINDOW = 1000
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_summaries = {}
+
+
+class Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=SUMMARY_WINDOW)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def quantile(self, q):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def set_gauge(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = float(value)
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.get(key)
+        if summary is None:
+            summary = _summaries[key] = Summary()
+        summary.observe(value)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the wall time of the ``with`` block in seconds, even if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _summaries.clear()
+
+
+def _display_name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{label}={value}" for label, value in labels) + "}"
+
+
+def snapshot():
+    """Return all counters, gauges and summary statistics as plain dicts."""
+    with _lock:
+        return {
+            "counters": {_display_name(*key): value for key, value in _counters.items()},
+            "gauges": {_display_name(*key): value for key, value in _gauges.items()},
+            "summaries": {
+                _display_name(*key): {
+                    "count": summary.count,
+                    "sum": summary.total,
+                    "p50": summary.quantile(0.50),
+                    "p95": summary.quantile(0.95),
+                    "p99": summary.quantile(0.99),
+                }
+                for key, summary in _summaries.items()
+            },
+        }
+
+
+def _prometheus_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus():
+    """Render every metric in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        summaries = sorted((key, (summary.count, summary.total, [summary.quantile(q) for q in QUANTILES]))
+                           for key, summary in _summaries.items())
+
+    lines = []
+    declared = set()
+    for (name, labels), value in counters:
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+    for (name, labels), (count, total, quantiles) in summaries:
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} summary")
+        for q, value in zip(QUANTILES, quantiles):
+            lines.append(f"{name}{_prometheus_labels(labels, [('quantile', q)])} {value}")
+        lines.append(f"{name}_sum{_prometheus_labels(labels)} {total}")
+        lines.append(f"{name}_count{_prometheus_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
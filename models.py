@@ -0,0 +1,211 @@
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, inspect, text, Column, String, Integer, DateTime, Text, Index
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+import all_access_keys
+
+# The one database shared by the webhook server, the transcription pipeline
+# and the job queue. The schema is created and upgraded by the migrations at
+# the bottom of this file, on first use rather than at import.
+
+DATABASE_URL = all_access_keys.DATABASE_URL or "sqlite:///transcriptions.db"
+
+# Connection pool settings (ignored by SQLite in-memory databases)
+POOL_SIZE = 10
+MAX_OVERFLOW = 20
+POOL_TIMEOUT_SECONDS = 30
+POOL_RECYCLE_SECONDS = 1800
+SQLITE_BUSY_TIMEOUT_SECONDS = 30  # How long a writer waits for another writer's lock
+
+# Job states
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+Base = declarative_base()
+
+
+class ResponseData(Base):
+    """One call: the caller's answers from the webhooks and the recording's transcript."""
+
+    __tablename__ = 'responses'
+    id = Column(Integer, primary_key=True)
+    call_sid = Column(String, unique=True, index=True)
+    first_name = Column(String)
+    last_name = Column(String)
+    age = Column(String)
+    residency = Column(String)
+    recording_url = Column(String, nullable=True, index=True)
+    transcription = Column(String, nullable=True)
+    transcript_turns = Column(Text, nullable=True)  # Columnar JSON from diarized_transcript
+    live_transcript = Column(Text, nullable=True)  # Final results from media_stream, one per line
+    live_transcript_interim = Column(Text, nullable=True)  # The hypothesis not yet final
+
+    __table_args__ = (
+        # Only rows still waiting for a transcript, and covering the pipeline's scan of them
+        Index(
+            "ix_responses_untranscribed", "recording_url", "call_sid",
+            sqlite_where=text("transcription IS NULL AND recording_url IS NOT NULL"),
+            postgresql_where=text("transcription IS NULL AND recording_url IS NOT NULL"),
+        ),
+    )
+
+
+class Job(Base):
+    """A recording waiting for, or going through, the transcription pipeline."""
+
+    __tablename__ = 'transcription_jobs'
+    id = Column(Integer, primary_key=True)
+    recording_sid = Column(String, unique=True, nullable=False, index=True)
+    recording_url = Column(String, nullable=False)
+    call_sid = Column(String, nullable=True)
+    state = Column(String, nullable=False, default=PENDING, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    lease_expires_at = Column(DateTime, nullable=True)
+    claimed_by = Column(String, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_transcription_jobs_runnable", "state", "available_at"),
+    )
+
+
+def create_db_engine(url=DATABASE_URL, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW):
+    """Engine with pool sizing; SQLite files also get WAL mode so readers don't block the writer."""
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_timeout=POOL_TIMEOUT_SECONDS,
+                             pool_recycle=POOL_RECYCLE_SECONDS, pool_pre_ping=True)
+
+    in_memory = url in ("sqlite://", "sqlite:///:memory:")
+    options = {} if in_memory else {"pool_size": pool_size, "max_overflow": max_overflow,
+                                    "pool_timeout": POOL_TIMEOUT_SECONDS}
+    sqlite_engine = create_engine(url, connect_args={"check_same_thread": False,
+                                                     "timeout": SQLITE_BUSY_TIMEOUT_SECONDS}, **options)
+
+    @event.listens_for(sqlite_engine, "connect")
+    def configure_sqlite(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL; commits don't wait for fsync
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_SECONDS * 1000}")
+        cursor.close()
+
+    return sqlite_engine
+
+
+engine = create_db_engine()
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+### Migrations ###
+# Each migration runs once per database, in order, and is recorded in
+# schema_migrations. They are written to be safe on any of the schemas the
+# webhook server and the pipeline used to create separately.
+
+def _add_columns(connection, table, columns):
+    existing = {column["name"] for column in inspect(connection).get_columns(table)}
+    for name, column_type in columns.items():
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}"))
+
+
+def _create_indexes(connection, table):
+    for index in table.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _create_tables(connection):
+    Base.metadata.create_all(connection)
+
+
+def _merge_response_columns(connection):
+    # Webhook databases lacked the transcript columns, pipeline ones the answers
+    _add_columns(connection, "responses", {
+        "first_name": "VARCHAR", "last_name": "VARCHAR", "age": "VARCHAR", "residency": "VARCHAR",
+        "recording_url": "VARCHAR", "transcription": "VARCHAR", "transcript_turns": "TEXT",
+    })
+
+
+def _add_indexes(connection):
+    _create_indexes(connection, ResponseData.__table__)
+    _create_indexes(connection, Job.__table__)
+
+
+def _add_live_transcript_columns(connection):
+    _add_columns(connection, "responses", {"live_transcript": "TEXT", "live_transcript_interim": "TEXT"})
+
+
+def _add_search_index(connection):
+    # Transcript search filters calls by the caller's answers, case-insensitively. Expression
+    # indexes can't be reflected for checkfirst, so they are created here rather than on the model.
+    for column in ("first_name", "residency"):
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_responses_{column}_lower ON responses (lower({column}))"))
+    # Imported here because search_index builds on these models
+    import search_index
+    search_index.create(connection)
+
+
+MIGRATIONS = [
+    (1, "create tables", _create_tables),
+    (2, "merge webhook and pipeline response columns", _merge_response_columns),
+    (3, "add lookup and untranscribed indexes", _add_indexes),
+    (4, "add live transcript columns", _add_live_transcript_columns),
+    (5, "add transcript search index", _add_search_index),
+]
+
+
+def migrate(bind=None):
+    """Apply every pending migration; returns the versions applied."""
+    bind = bind or engine
+    with bind.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations "
+            "(version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)"
+        ))
+        applied = {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+    newly_applied = []
+    for version, name, upgrade in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with bind.begin() as connection:
+                upgrade(connection)
+                connection.execute(
+                    text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :now)"),
+                    {"version": version, "name": name, "now": datetime.utcnow()},
+                )
+        except IntegrityError:
+            # Another process applied this migration first
+            continue
+        logging.info(f"Applied migration {version}: {name}")
+        newly_applied.append(version)
+    return newly_applied
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def init_db():
+    """Bring the schema up to date once per process, on first database use."""
+    global _schema_ready
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                migrate()
+                _schema_ready = True
+
+
+def get_session():
+    init_db()
+    return SessionLocal()
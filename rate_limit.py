@@ -0,0 +1,431 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import all_access_keys
+import metrics
+
+# Client-side limits for the external APIs (OpenAI, Speech, Cloud Storage).
+# Each service has one ServiceLimiter per process, combining:
+# - a token bucket that spaces requests to the provider's rate, so bursts
+#   queue up on our side instead of coming back as 429s;
+# - a cap on requests in flight;
+# - retries of transient errors (429, 5xx, timeouts) with jittered
+#   exponential backoff, each retry taking a token like any other request, so
+#   failed requests never come back as a synchronized herd;
+# - a circuit breaker that, after repeated server errors or timeouts, fails
+#   calls immediately for a while instead of piling more load on a degraded
+#   provider. A 429 means the provider is healthy but we are too fast, so it
+#   empties the bucket to slow everyone down instead of tripping the breaker.
+# Tokens, waiting callers, requests in flight and breaker state are exported
+# as gauges, and calls, retries and rejections as counters.
+#
+# Limits are kept in memory, so they only hold within one process. Every
+# process calling a provider gets a share of its quota instead: each entry
+# point (the webhook server, the transcription worker, the backfill) calls
+# use_share() with its name, and the rates, bursts and concurrency caps of
+# SERVICE_LIMITS are scaled by its share of each service. The shares come
+# from RATE_LIMIT_SHARES in all_access_keys.py (DEFAULT_SHARES otherwise);
+# a service's shares should add up to at most 1 across the processes running
+# at once, so two workers would each need half of the worker share.
+
+SERVICE_LIMITS = {
+    # rate: requests per second (0 for no limit), e.g. the project's RPM quota / 60; burst: bucket size;
+    # max_wait: longest a request queues for its turn before failing with RateLimitExceeded
+    "openai": {"rate": 50.0, "burst": 50, "max_concurrency": 100, "max_retries": 2, "max_wait": 5.0},
+    "speech": {"rate": 15.0, "burst": 30, "max_concurrency": 32, "max_retries": 3, "max_wait": 120.0},
+    "gcs": {"rate": 50.0, "burst": 50, "max_concurrency": 32, "max_retries": 3, "max_wait": 120.0},
+}
+DEFAULT_SHARES = {
+    # Entry point: {service: fraction of its quota}; services not listed are left at the full quota
+    "webhook": {"openai": 1.0},
+    "worker": {"speech": 0.6, "gcs": 0.6},  # Leaves Speech headroom for live call transcripts
+    "backfill": {"speech": 0.2, "gcs": 0.2},
+}
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+FAILURE_THRESHOLD = 5        # Consecutive transient failures that open the circuit (0 never opens it)
+CIRCUIT_RESET_SECONDS = 30.0  # How long an open circuit fails fast before letting a probe through
+PROBE_WAIT_SECONDS = 1.0     # How long to hold off while a half-open circuit's probe is out
+
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_ERROR_NAMES = ("APIConnectionError", "Timeout", "ServiceUnavailableError", "TryAgain")
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class RateLimitExceeded(Exception):
+    """A request would have waited longer than its service's ``max_wait`` for a turn."""
+
+
+class CircuitOpenError(Exception):
+    """The service's circuit is open; the request was not sent."""
+
+    def __init__(self, service, retry_in):
+        super().__init__(f"{service} is failing; not calling it for another {retry_in:.0f}s")
+        self.service = service
+        self.retry_in = retry_in
+
+
+def _status(error):
+    return getattr(error, "http_status", None) or getattr(error, "code", None)
+
+
+def is_retryable(error):
+    """Whether an error from any of the SDKs is worth retrying.
+
+    Covers timeouts and connection errors, openai's errors (``http_status``)
+    and google.api_core's (``code``, the HTTP status).
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    return _status(error) in RETRYABLE_STATUSES
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """Full-jitter exponential backoff: uniform over [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Refills ``rate`` tokens per second up to ``burst``.
+
+    ``reserve`` hands out tokens in arrival order, going into debt when the
+    bucket is empty, and returns how long the caller must wait for its token.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def reserve(self, max_wait=None):
+        """Take a token; returns the seconds to wait before using it, or None
+        (taking nothing) if that would be longer than ``max_wait``. Not thread-safe."""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if max_wait is not None and wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures; after ``reset_seconds``
+    lets one probe through (half-open), which closes it on success. Not thread-safe."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def retry_in(self):
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def allow(self):
+        if self.state == OPEN and not self.retry_in():
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return self.state != OPEN
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or (self.failure_threshold and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class ServiceLimiter:
+    """Rate limit, concurrency cap, retries and circuit breaker for one service."""
+
+    def __init__(self, service, rate=0.0, burst=1, max_concurrency=None, max_retries=0, max_wait=None,
+                 failure_threshold=FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.service = service
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.in_flight = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._slot_free = threading.Condition(self._lock)
+
+    def _publish(self):
+        # Called with the lock held
+        metrics.set_gauge("rate_limit_in_flight", self.in_flight, service=self.service)
+        metrics.set_gauge("rate_limit_waiting", self.waiting, service=self.service)
+        metrics.set_gauge("rate_limit_tokens", self.bucket.tokens, service=self.service)
+        metrics.set_gauge("rate_limit_circuit_state", _STATE_VALUES[self.breaker.state], service=self.service)
+
+    def _admit(self):
+        """Check the breaker and take a token; returns the seconds to wait for it."""
+        with self._lock:
+            if not self.breaker.allow():
+                metrics.inc("rate_limit_calls_total", service=self.service, result="circuit_open")
+                # While a half-open probe is out, come back once it has had time to finish
+                raise CircuitOpenError(self.service, self.breaker.retry_in() or PROBE_WAIT_SECONDS)
+            wait = self.bucket.reserve(self.max_wait)
+            if wait is None:
+                self.breaker.probing = False  # A half-open probe that never went out
+            self._publish()
+        if wait is None:
+            metrics.inc("rate_limit_calls_total", service=self.service, result="rejected")
+            raise RateLimitExceeded(f"{self.service} is over its rate limit")
+        metrics.observe("rate_limit_wait_seconds", wait, service=self.service)
+        return wait
+
+    def _has_slot(self):
+        return self.max_concurrency is None or self.in_flight < self.max_concurrency
+
+    def _acquire_slot(self):
+        with self._lock:
+            self.waiting += 1
+            self._publish()
+            try:
+                if not self._slot_free.wait_for(self._has_slot, timeout=self.max_wait):
+                    metrics.inc("rate_limit_calls_total", service=self.service, result="rejected")
+                    raise RateLimitExceeded(f"{self.service} has {self.in_flight} requests in flight")
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+                self._publish()
+
+    async def _acquire_slot_async(self):
+        # Polled rather than awaited on a condition, so callers on any event loop can share the cap
+        deadline = None if self.max_wait is None else time.monotonic() + self.max_wait
+        self._count_waiting(1)
+        try:
+            while True:
+                with self._lock:
+                    if self._has_slot():
+                        self.in_flight += 1
+                        return
+                if deadline is not None and time.monotonic() > deadline:
+                    metrics.inc("rate_limit_calls_total", service=self.service, result="rejected")
+                    raise RateLimitExceeded(f"{self.service} has {self.in_flight} requests in flight")
+                await asyncio.sleep(0.01)
+        finally:
+            self._count_waiting(-1)
+
+    def _count_waiting(self, delta):
+        with self._lock:
+            self.waiting += delta
+            self._publish()
+
+    def _wait_for_token(self, wait):
+        if wait:
+            self._count_waiting(1)
+            try:
+                time.sleep(wait)
+            finally:
+                self._count_waiting(-1)
+
+    async def _wait_for_token_async(self, wait):
+        if wait:
+            self._count_waiting(1)
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._count_waiting(-1)
+
+    def _release_slot(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._slot_free.notify()
+            self._publish()
+
+    def _record(self, error):
+        """Update the breaker with an attempt's outcome; returns True if it should be retried."""
+        retryable = error is not None and is_retryable(error)
+        with self._lock:
+            if retryable and _status(error) == 429:
+                self.bucket.tokens = min(self.bucket.tokens, 0.0)
+                metrics.inc("rate_limit_throttled_total", service=self.service)
+            elif retryable:
+                self.breaker.record_failure()
+            else:
+                # Errors the provider is not to blame for (e.g. a bad request) don't trip the breaker
+                self.breaker.record_success()
+            self._publish()
+        if error is None:
+            metrics.inc("rate_limit_calls_total", service=self.service, result="ok")
+        elif not retryable:
+            metrics.inc("rate_limit_calls_total", service=self.service, result="error")
+        return retryable
+
+    def _give_up(self, attempt, error):
+        metrics.inc("rate_limit_calls_total", service=self.service, result="failed")
+        logging.warning(f"{self.service} request failed after {attempt + 1} attempts: {error!r}")
+
+    def call(self, fn, *args, **kwargs):
+        """Call ``fn(*args, **kwargs)`` within the service's limits, retrying transient errors."""
+        attempt = 0
+        while True:
+            self._acquire_slot()
+            try:
+                self._wait_for_token(self._admit())
+                result = fn(*args, **kwargs)
+            except (CircuitOpenError, RateLimitExceeded):
+                raise
+            except Exception as e:
+                if not self._record(e) or attempt >= self.max_retries:
+                    if is_retryable(e):
+                        self._give_up(attempt, e)
+                    raise
+                error = e
+            else:
+                self._record(None)
+                return result
+            finally:
+                self._release_slot()
+            metrics.inc("rate_limit_retries_total", service=self.service)
+            logging.info(f"Retrying {self.service} request after {error!r}")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    async def call_async(self, fn, *args, **kwargs):
+        """Async ``call``: ``fn(*args, **kwargs)`` returns an awaitable, created anew for each attempt."""
+        attempt = 0
+        while True:
+            await self._acquire_slot_async()
+            try:
+                await self._wait_for_token_async(self._admit())
+                result = await fn(*args, **kwargs)
+            except (CircuitOpenError, RateLimitExceeded):
+                raise
+            except Exception as e:
+                if not self._record(e) or attempt >= self.max_retries:
+                    if is_retryable(e):
+                        self._give_up(attempt, e)
+                    raise
+                error = e
+            else:
+                self._record(None)
+                return result
+            finally:
+                self._release_slot()
+            metrics.inc("rate_limit_retries_total", service=self.service)
+            logging.info(f"Retrying {self.service} request after {error!r}")
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tokens": round(self.bucket.tokens, 2),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "circuit": self.breaker.state,
+                "retry_in": round(self.breaker.retry_in(), 1) if self.breaker.state == OPEN else 0.0,
+                "rate": self.bucket.rate,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_shares = {}
+_default_share = 1.0
+
+
+def _build(service):
+    """A limiter with ``service``'s SERVICE_LIMITS scaled to this process's share of its quota."""
+    settings = dict(SERVICE_LIMITS.get(service, {}))
+    share = _shares.get(service, _default_share)
+    if share != 1.0:
+        if settings.get("rate"):
+            settings["rate"] *= share
+        if "burst" in settings:
+            settings["burst"] = max(1, round(settings["burst"] * share))
+        if settings.get("max_concurrency"):
+            settings["max_concurrency"] = max(1, round(settings["max_concurrency"] * share))
+    return ServiceLimiter(service, **settings)
+
+
+def use_share(*entry_points, share=None):
+    """Limit this process to the quota shares of the entry points it runs; returns them.
+
+    A process running several entry points (the webhook server with inline
+    transcription workers) gets their shares added up. ``share``, e.g. from a
+    command-line flag, replaces them with one fraction for every service.
+    Called once at startup, before any request goes out.
+    """
+    global _shares, _default_share
+    shares = {}
+    if share is None:
+        configured = dict(DEFAULT_SHARES, **getattr(all_access_keys, "RATE_LIMIT_SHARES", {}))
+        for entry_point in entry_points:
+            for service, fraction in configured[entry_point].items():
+                shares[service] = min(1.0, shares.get(service, 0.0) + fraction)
+    elif not 0 < share <= 1:
+        raise ValueError(f"Quota share must be above 0 and at most 1, not {share}")
+    with _limiters_lock:
+        _shares = shares
+        _default_share = 1.0 if share is None else share
+        _limiters.clear()
+    logging.info(f"API quota shares for {'+'.join(entry_points) or 'this process'}: "
+                 f"{shares or f'{_default_share:.0%} of every service'}")
+    return shares or {service: _default_share for service in SERVICE_LIMITS}
+
+
+def limiter(service):
+    """The process-wide limiter for ``service``, built from SERVICE_LIMITS on first use."""
+    service_limiter = _limiters.get(service)
+    if service_limiter is None:
+        with _limiters_lock:
+            service_limiter = _limiters.get(service)
+            if service_limiter is None:
+                service_limiter = _limiters[service] = _build(service)
+    return service_limiter
+
+
+def configure(service, **settings):
+    """Replace a service's limiter, e.g. with the quota of a particular project."""
+    with _limiters_lock:
+        SERVICE_LIMITS[service] = dict(SERVICE_LIMITS.get(service, {}), **settings)
+        _limiters[service] = _build(service)
+    return _limiters[service]
+
+
+def circuit_open(*services):
+    """Seconds to hold off before calling ``services`` again, or 0 if any of them may be called.
+
+    An open circuit whose reset time has passed counts as callable, so that
+    the next call can go out as its probe.
+    """
+    waits = []
+    for service in services:
+        breaker = limiter(service).breaker
+        if breaker.state == OPEN:
+            waits.append(breaker.retry_in())
+        elif breaker.state == HALF_OPEN and breaker.probing:
+            waits.append(PROBE_WAIT_SECONDS)
+    return max(waits, default=0.0)
+
+
+def stats():
+    return {service: service_limiter.stats() for service, service_limiter in list(_limiters.items())}
@@ -1,15 +1,24 @@
-from flask import Flask, request, Response
+from flask import Flask, request, Response, jsonify, g
 
-from twilio.rest import Client
-from twilio.twiml.voice_response import VoiceResponse, Gather
+from twilio.twiml.voice_response import VoiceResponse, Gather, Start
 import os
-from sqlalchemy import create_engine, Column, String, Integer
-from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker
 from twilio.request_validator import RequestValidator
 import all_access_keys  # Your config file with credentials
-import openai
+import job_queue
+import media_stream
+from transcription_worker import TranscriptionWorker
+from models import ResponseData, get_session
+from call_state import create_call_state_store, start_expiry_thread
+from response_cache import ResponseCache, prompt_key
+import metrics
+import rate_limit
+import asyncio
+import atexit
 import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -22,60 +31,433 @@ logging.basicConfig(
 )
 
 
-# OpenAI API key
-openai.api_key = all_access_keys.OPENAI_API_KEY
+# The OpenAI and Twilio REST SDKs are slow to import and most requests never
+# touch them, so they are loaded on first use (see get_openai/get_twilio_client)
+OPENAI_MODEL = "gpt-4"
+OPENAI_TIMEOUT_SECONDS = 12  # Stay inside Twilio's 15 second webhook timeout
+
+# GPT prefetch: the reply is generated while the caller is still answering
+GPT_FIRST_WAIT_SECONDS = 1.0  # How long /start_gpt_conversation waits before playing a filler
+GPT_POLL_WAIT_SECONDS = 5.0   # How long each /gpt_reply poll waits for the reply
+GPT_PREFETCH_TTL_SECONDS = 300
+GPT_GIVE_UP_SECONDS = 60      # A reply unfinished this long after it started is abandoned (e.g. its process stopped)
+GPT_FILLER = "Thank you. Give me just a moment."
+
+# Streaming mode plays the reply sentence by sentence while the rest is generated
+GPT_STREAMING_MODE = False
+MIN_SENTENCE_CHARS = 20  # Shorter sentences are merged with the next one
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+")
+
+# Replies are cached by normalized prompt; similar-prompt lookups are opt-in
+GPT_CACHE_SEMANTIC = False
+gpt_response_cache = ResponseCache(semantic=GPT_CACHE_SEMANTIC)
 
 # Flask app setup
 app = Flask(__name__)
-# conversation for multi-turn interactions
-conversation_history = {}
+
+try:
+    from flask_sock import Sock
+except ImportError:  # Live transcription needs flask-sock for its WebSocket route
+    Sock = None
+sock = Sock(app) if Sock is not None else None
 
 app.secret_key = all_access_keys.SECRET_KEY
 
 # Base URL for webhooks
 BASE_URL = all_access_keys.BASE_URL
 
+# Live transcription streams each call's audio to /media-stream while it is in progress
+LIVE_TRANSCRIPTION = False
+MEDIA_STREAM_URL = BASE_URL.replace("https://", "wss://").replace("http://", "ws://") + "/media-stream"
+
 # Twilio credentials
 ACCOUNT_SID = all_access_keys.ACCOUNT_SID
 AUTH_TOKEN = all_access_keys.AUTH_TOKEN
 TWILIO_PHONE_NUMBER = all_access_keys.TWILIO_PHONE_NUMBER
 
-# Initialize the Twilio client
-client = Client(ACCOUNT_SID, AUTH_TOKEN)
+_sdk_lock = threading.Lock()
+_openai = None
+_twilio_client = None
+_transcription_worker = None
+
+
+def get_openai():
+    """The openai module, imported and given our API key on first use."""
+    global _openai
+    if _openai is None:
+        with _sdk_lock:
+            if _openai is None:
+                import openai
+                openai.api_key = all_access_keys.OPENAI_API_KEY or openai.api_key
+                _openai = openai
+    return _openai
+
+
+def get_twilio_client():
+    """Twilio REST client, created on first use."""
+    global _twilio_client
+    if _twilio_client is None:
+        with _sdk_lock:
+            if _twilio_client is None:
+                from twilio.rest import Client
+                _twilio_client = Client(ACCOUNT_SID, AUTH_TOKEN)
+    return _twilio_client
+
+
+def get_transcription_worker():
+    """In-process transcription worker, started on the first recording; None unless inline."""
+    global _transcription_worker
+    if TRANSCRIPTION_WORKER_MODE != "inline":
+        return None
+    if _transcription_worker is None:
+        with _sdk_lock:
+            if _transcription_worker is None:
+                _transcription_worker = TranscriptionWorker().start()
+    return _transcription_worker
+
 
 # Google Cloud credentials
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = all_access_keys.GOOGLE_APPLICATION_CREDENTIALS
 
-# Database setup
-DATABASE_URL = all_access_keys.DATABASE_URL
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-Base = declarative_base()
-
-# Database Model
-class ResponseData(Base):
-    __tablename__ = 'responses'
-    id = Column(Integer, primary_key=True)
-    call_sid = Column(String, unique=True)
-    first_name = Column(String)
-    last_name = Column(String)
-    age = Column(String)
-    residency = Column(String)
-    recording_url = Column(String)
-
-Base.metadata.create_all(engine)
-SessionLocal = sessionmaker(bind=engine)
+# Answers collected during a call, flushed to the database as a single row
+PROFILE_FIELDS = ("first_name", "last_name", "age", "residency")
+CALL_STATE_URL = getattr(all_access_keys, "CALL_STATE_URL", "")
+
+# Recordings are transcribed as they arrive by 'inline' worker threads or a
+# 'sidecar' worker process; '' leaves them to batch pipeline runs
+TRANSCRIPTION_WORKER_MODE = getattr(all_access_keys, "TRANSCRIPTION_WORKER", "inline")
+# Inline workers transcribe with this process's quota, so it takes the worker share too
+rate_limit.use_share(*(("webhook", "worker") if TRANSCRIPTION_WORKER_MODE == "inline" else ("webhook",)))
+flush_executor = ThreadPoolExecutor(max_workers=2)
+
+### Database helpers ###
+# These are blocking; async views run them with asyncio.to_thread so the
+# event loop keeps serving other calls while SQLite/Postgres works.
+
+
+def get_response_data(call_sid):
+    db_session = get_session()
+    try:
+        with metrics.timer("webhook_db_seconds", operation="get_response_data"):
+            return db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
+    finally:
+        db_session.close()
+
+
+def save_answer(call_sid, field, value, create=False):
+    """Store one answer on the caller's row.
+
+    Returns False if there is no row for the call (and ``create`` is False)
+    or the write failed.
+    """
+    db_session = get_session()
+    try:
+        with metrics.timer("webhook_db_seconds", operation="save_answer"):
+            response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
+            if not response_data:
+                if not create:
+                    return False
+                response_data = ResponseData(call_sid=call_sid)
+                db_session.add(response_data)
+            setattr(response_data, field, value)
+            db_session.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Database error for CallSid={call_sid}: {e}")
+        db_session.rollback()
+        return False
+    finally:
+        db_session.close()
+
+
+def flush_call_state(call_sid, state):
+    """Write a call's accumulated answers to its row in one round-trip."""
+    if not any(state.get(field) is not None for field in PROFILE_FIELDS):
+        return  # Nothing answered yet, e.g. a call that hung up during the greeting
+    db_session = get_session()
+    try:
+        with metrics.timer("webhook_db_seconds", operation="flush_call_state"):
+            response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
+            if not response_data:
+                response_data = ResponseData(call_sid=call_sid)
+                db_session.add(response_data)
+            for field in PROFILE_FIELDS:
+                if state.get(field) is not None:
+                    setattr(response_data, field, state[field])
+            db_session.commit()
+        logging.info(f"Call state flushed to database for CallSid={call_sid}")
+    except Exception as e:
+        logging.error(f"Database error flushing CallSid={call_sid}: {e}")
+        db_session.rollback()
+    finally:
+        db_session.close()
+
+
+def flush_abandoned_call(call_sid, state):
+    """Callers who hang up mid-questionnaire still get their partial answers saved."""
+    logging.info(f"Call state for CallSid={call_sid} expired; flushing partial answers")
+    flush_executor.submit(flush_call_state, call_sid, state)
+
+
+def flush_remaining_calls():
+    """At exit, write the answers of calls still held in this process, which would otherwise be lost."""
+    for call_sid, state in call_state.drain():
+        flush_call_state(call_sid, state)
+
+
+call_state = create_call_state_store(CALL_STATE_URL, on_abandon=flush_abandoned_call,
+                                     value_ttl=GPT_PREFETCH_TTL_SECONDS)
+start_expiry_thread(call_state)
+atexit.register(flush_remaining_calls)
+
+
+def profile_complete(profile):
+    """True once the caller has answered every question, so the profile can be flushed and prompted with."""
+    return bool(profile) and all(profile.get(field) for field in PROFILE_FIELDS)
+
+
+def build_gpt_messages(profile):
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": f"My name is {profile.get('first_name')} {profile.get('last_name')}. I am {profile.get('age')} years old and live in {profile.get('residency')}."}
+    ]
+
+
+async def generate_gpt_reply(messages):
+    """Ask OpenAI for a reply without blocking the event loop."""
+    with metrics.timer("openai_seconds", mode="complete"):
+        response = await rate_limit.limiter("openai").call_async(lambda: asyncio.wait_for(
+            get_openai().ChatCompletion.acreate(model=OPENAI_MODEL, messages=messages),
+            timeout=OPENAI_TIMEOUT_SECONDS,
+        ))
+    return response['choices'][0]['message']['content']
+
+
+def split_sentences(text):
+    """Split off complete sentences; returns (sentences, unfinished remainder)."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        if match.end() - start >= MIN_SENTENCE_CHARS:
+            sentences.append(text[start:match.end()].strip())
+            start = match.end()
+    return sentences, text[start:]
+
+
+async def stream_gpt_reply(messages, on_sentence):
+    """Stream a completion, calling ``on_sentence`` for each sentence as it completes.
+
+    The timeout applies to the first token and to every gap between tokens
+    rather than to the whole reply. Only opening the stream is retried, so a
+    sentence is never played twice. Returns the full reply.
+    """
+    started_at = time.perf_counter()
+    stream = await rate_limit.limiter("openai").call_async(lambda: asyncio.wait_for(
+        get_openai().ChatCompletion.acreate(model=OPENAI_MODEL, messages=messages, stream=True),
+        timeout=OPENAI_TIMEOUT_SECONDS,
+    ))
+    parts = []
+    buffer = ""
+    chunks = stream.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=OPENAI_TIMEOUT_SECONDS)
+        except StopAsyncIteration:
+            break
+        delta = chunk['choices'][0].get('delta', {}).get('content') or ""
+        if not parts:
+            metrics.observe("openai_first_token_seconds", time.perf_counter() - started_at)
+        parts.append(delta)
+        sentences, buffer = split_sentences(buffer + delta)
+        for sentence in sentences:
+            on_sentence(sentence)
+    if buffer.strip():
+        on_sentence(buffer.strip())
+    metrics.observe("openai_seconds", time.perf_counter() - started_at, mode="stream")
+    return "".join(parts)
+
+
+### GPT prefetch ###
+# Async views run on a short-lived event loop per request, so completions that
+# must outlive the request run on one long-lived background loop instead.
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="gpt-prefetch", daemon=True).start()
+        return _background_loop
+
+
+class GptPrefetch:
+    """A reply being generated in the background for one call.
+
+    Its sentences so far, and whether it has finished, are published to the
+    call state store under ``name``, so whichever webhook process Twilio's
+    next request reaches can play them.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sentences = []
+        self.started_at = time.time()
+
+    def record(self, done=False, error=None):
+        return {"sentences": self.sentences, "done": done, "error": error, "started_at": self.started_at}
+
+    def add_sentence(self, sentence):
+        if not self.sentences:
+            metrics.observe("gpt_time_to_first_sentence_seconds", time.time() - self.started_at)
+        self.sentences.append(sentence)
+        call_state.set_value(self.name, self.record())
+
+    def finish(self, error=None):
+        call_state.set_value(self.name, self.record(done=True, error=error))
+
+
+async def _generate_into(prefetch, messages):
+    cached_reply = gpt_response_cache.get(messages, OPENAI_MODEL)
+    if cached_reply is not None:
+        prefetch.add_sentence(cached_reply)
+        return cached_reply
+
+    started_at = time.monotonic()
+    if GPT_STREAMING_MODE:
+        gpt_reply = await stream_gpt_reply(messages, prefetch.add_sentence)
+    else:
+        gpt_reply = await generate_gpt_reply(messages)
+        if gpt_reply.strip():
+            prefetch.add_sentence(gpt_reply)
+    if gpt_reply.strip():
+        gpt_response_cache.put(messages, OPENAI_MODEL, gpt_reply, latency=time.monotonic() - started_at)
+    return gpt_reply
+
+
+async def _run_prefetch(prefetch, messages):
+    try:
+        gpt_reply = await _generate_into(prefetch, messages)
+    except Exception as e:
+        logging.error(f"Error with OpenAI API: {e!r}")
+        metrics.inc("gpt_errors_total")
+        prefetch.finish(error=repr(e))
+        return
+    logging.info(f"GPT reply: {gpt_reply}")
+    prefetch.finish()
+
+
+def _playback_name(call_sid):
+    return f"gpt_playback:{call_sid}"
+
+
+def start_gpt_prefetch(call_sid, profile):
+    """Start generating the GPT reply in the background, once per call and prompt across all processes.
+
+    Also points the call's playback at this reply, from its first sentence.
+    A repeated answer changes the prompt, and so starts a new reply.
+    """
+    messages = build_gpt_messages(profile)
+    name = f"gpt_reply:{call_sid}:{prompt_key(messages, OPENAI_MODEL)[:16]}"
+    prefetch = GptPrefetch(name)
+    if call_state.set_value(name, prefetch.record(), only_if_new=True):
+        logging.debug(f"Conversation history: {messages}")
+        asyncio.run_coroutine_threadsafe(_run_prefetch(prefetch, messages), get_background_loop())
+    call_state.set_value(_playback_name(call_sid), {"reply": name, "played": 0})
+    return name
+
+
+def reply_ready(record, played):
+    return record["done"] or len(record["sentences"]) > played
+
+
+async def wait_for_reply(name, played, timeout):
+    """Wait up to ``timeout`` seconds for something to play after the first ``played``
+    sentences (a sentence, the end of the reply, or its error); returns the reply's
+    record, or None if it is gone."""
+    # Polled, as the reply may be generated by another process
+    deadline = time.monotonic() + timeout
+    while True:
+        record = call_state.get_value(name)
+        if record is None or reply_ready(record, played):
+            return record
+        if time.time() - record["started_at"] > GPT_GIVE_UP_SECONDS:
+            logging.error(f"GPT reply {name} unfinished after {GPT_GIVE_UP_SECONDS}s; giving up")
+            return dict(record, done=True, error="unfinished")
+        if time.monotonic() >= deadline:
+            return record
+        await asyncio.sleep(0.02)
+
+
+def say_gpt_reply(vr, call_sid, name, record, played):
+    """Add every sentence not yet played to the TwiML.
+
+    While generation continues the response ends with a redirect back to
+    /gpt_reply, so Twilio fetches the next sentences after playing these.
+    """
+    sentences = record["sentences"][played:]
+    if sentences and played == 0:
+        # Measured from the caller's last answer to the reply starting to play
+        metrics.observe("gpt_time_to_first_audio_seconds", time.time() - record["started_at"])
+    played += len(sentences)
+    for sentence in sentences:
+        vr.say(sentence)
+
+    if not record["done"]:
+        call_state.set_value(_playback_name(call_sid), {"reply": name, "played": played})
+        vr.redirect(f"{BASE_URL}/gpt_reply")
+        return
+
+    call_state.delete_value(_playback_name(call_sid))
+    call_state.delete_value(name)
+    if record["error"]:
+        if not played:
+            vr.say("I'm sorry, I couldn't process your request right now. Please try again later.")
+        return
+    if not played:
+        vr.say("I'm sorry, I didn't understand that. Can you please try again?")
 
 ### Routes ###
 
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop("request_started", None)
+    if started is not None and request.endpoint != "prometheus_metrics":
+        route = request.endpoint or "unknown"
+        metrics.observe("webhook_request_seconds", time.perf_counter() - started, route=route)
+        metrics.inc("webhook_requests_total", route=route, status=response.status_code)
+    return response
+
+
 
 @app.route("/voice", methods=["POST"])
-def voice():
+async def voice():
     """Start the call and ask the first question."""
     logging.info(f"POST data received at /voice: {request.form}")
+    call_sid = request.form.get("CallSid")
 
     vr = VoiceResponse()
 
+    if LIVE_TRANSCRIPTION:
+        if sock is None:
+            logging.warning("LIVE_TRANSCRIPTION is on but flask-sock is not installed; not streaming")
+        elif not (call_state.get(call_sid) or {}).get("stream_started"):
+            # /voice is re-entered when the caller stays silent or has to start over;
+            # the call's stream keeps running, and Twilio allows only a few per call
+            call_state.update(call_sid, stream_started=True)
+            start = Start()
+            start.stream(url=MEDIA_STREAM_URL, track="inbound_track")
+            vr.append(start)
+
     # Ask the first question
     gather = Gather(
         input="speech",
@@ -93,47 +475,64 @@ def voice():
     return Response(str(vr), mimetype="application/xml")
 
 @app.route("/start_gpt_conversation", methods=["POST"])
-def start_gpt_conversation():
+async def start_gpt_conversation():
     """Start a dynamic OpenAI conversation."""
     call_sid = request.form.get("CallSid")
     vr = VoiceResponse()
 
-    # Retrieve all collected data
-    db_session = SessionLocal()
     try:
-        response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
-        if not response_data:
+        # Retrieve all collected data; once the questionnaire is complete, persist it.
+        # Partial answers stay in the call state, to be flushed when the call ends.
+        profile = call_state.get(call_sid)
+        if profile_complete(profile):
+            call_state.pop(call_sid)
+            await asyncio.to_thread(flush_call_state, call_sid, profile)
+        elif profile is None:
+            # Already flushed (e.g. Twilio retried this webhook)
+            response_data = await asyncio.to_thread(get_response_data, call_sid)
+            if response_data:
+                profile = {field: getattr(response_data, field) for field in PROFILE_FIELDS}
+        if not profile_complete(profile):
             vr.say("I couldn't find your information. Please try again later.")
             return Response(str(vr), mimetype="application/xml")
 
-        # Prepare conversation history for GPT
-        conversation_history = [
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": f"My name is {response_data.first_name} {response_data.last_name}. I am {response_data.age} years old and live in {response_data.residency}."}
-        ]
+        # Normally already started by /process_residency, possibly in another process
+        name = start_gpt_prefetch(call_sid, profile)
+        record = await wait_for_reply(name, 0, GPT_FIRST_WAIT_SECONDS)
+    except Exception as e:
+        logging.error(f"Error starting GPT conversation for CallSid={call_sid}: {e!r}")
+        vr.say("I'm sorry, I couldn't process your request right now. Please try again later.")
+        return Response(str(vr), mimetype="application/xml")
 
-        # Generate GPT response using the updated API syntax
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=conversation_history,
-        )
+    if record is None:
+        vr.say("I'm sorry, I couldn't process your request right now. Please try again later.")
+    elif reply_ready(record, 0):
+        metrics.inc("gpt_prefetch_ready_total")
+        say_gpt_reply(vr, call_sid, name, record, 0)
+    else:
+        # Keep the caller company while the reply finishes
+        metrics.inc("gpt_prefetch_pending_total")
+        vr.say(GPT_FILLER, voice="alice")
+        vr.redirect(f"{BASE_URL}/gpt_reply")
 
-        # Extract GPT reply
-        gpt_reply = response['choices'][0]['message']['content']
-        logging.info(f"GPT reply: {gpt_reply}")
-        logging.debug(f"Conversation history: {conversation_history}")
+    return Response(str(vr), mimetype="application/xml")
 
-        # Handle GPT reply
-        if not gpt_reply.strip():
-            vr.say("I'm sorry, I didn't understand that. Can you please try again?")
-        else:
-            vr.say(gpt_reply)
 
-    except Exception as e:
-        logging.error(f"Error with OpenAI API: {e}")
+@app.route("/gpt_reply", methods=["POST"])
+async def gpt_reply():
+    """Poll for a prefetched GPT reply, playing it (or its next sentences) once ready."""
+    call_sid = request.form.get("CallSid")
+    vr = VoiceResponse()
+
+    playback = call_state.get_value(_playback_name(call_sid))
+    record = playback and await wait_for_reply(playback["reply"], playback["played"], GPT_POLL_WAIT_SECONDS)
+    if not record:
         vr.say("I'm sorry, I couldn't process your request right now. Please try again later.")
-    finally:
-        db_session.close()
+    elif reply_ready(record, playback["played"]):
+        say_gpt_reply(vr, call_sid, playback["reply"], record, playback["played"])
+    else:
+        vr.pause(length=1)
+        vr.redirect(f"{BASE_URL}/gpt_reply")
 
     return Response(str(vr), mimetype="application/xml")
 
@@ -141,7 +540,7 @@ def start_gpt_conversation():
 
 
 @app.route("/process_first_name", methods=["POST"])
-def process_first_name():
+async def process_first_name():
     """Handle the user's first name and ask the next question."""
     call_sid = request.form.get("CallSid")
     first_name = request.form.get("SpeechResult")
@@ -150,21 +549,8 @@ def process_first_name():
     response = VoiceResponse()
 
     if first_name:
-        # Save first name to database
-        db_session = SessionLocal()
-        try:
-            response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
-            if not response_data:
-                response_data = ResponseData(call_sid=call_sid, first_name=first_name)
-                db_session.add(response_data)
-            else:
-                response_data.first_name = first_name
-            db_session.commit()
-        except Exception as e:
-            logging.error(f"Database error: {e}")
-            db_session.rollback()
-        finally:
-            db_session.close()
+        # Remember the first name until the call is finished
+        call_state.update(call_sid, first_name=first_name)
 
         # Ask the next question (last name)
         gather = Gather(
@@ -187,26 +573,16 @@ def process_first_name():
 
 
 @app.route("/process_last_name", methods=["POST"])
-def process_last_name():
+async def process_last_name():
     call_sid = request.form.get("CallSid")
     last_name = request.form.get("SpeechResult")
-    print(f"DEBUG: Received /process_last_name for CallSid={call_sid}, LastName={last_name}")
+    logging.debug(f"Received /process_last_name for CallSid={call_sid}, LastName={last_name}")
 
     response = VoiceResponse()
 
     if last_name:
-        # Save last name to database
-        db_session = SessionLocal()
-        try:
-            response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
-            if response_data:
-                response_data.last_name = last_name
-                db_session.commit()
-        except Exception as e:
-            print(f"Database error: {e}")
-            db_session.rollback()
-        finally:
-            db_session.close()
+        # Remember the last name until the call is finished
+        call_state.update(call_sid, last_name=last_name)
 
         # Proceed to the next question
         gather = Gather(
@@ -225,7 +601,7 @@ def process_last_name():
     return Response(str(response), mimetype="application/xml")
 
 @app.route("/process_age", methods=["POST"])
-def process_age():
+async def process_age():
     call_sid = request.form.get("CallSid")
     age = request.form.get("SpeechResult")
     logging.debug(f"Received /process_age for CallSid={call_sid}, Age={age}")
@@ -233,24 +609,15 @@ def process_age():
     response = VoiceResponse()
 
     if age:
-        # Save age to database
-        db_session = SessionLocal()
-        try:
-            response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
-            if response_data:
-                response_data.age = age
-                db_session.commit()
-                print(f"DEBUG: Age saved for CallSid={call_sid}: {age}")
-            else:
-                print(f"ERROR: No record found for CallSid={call_sid}")
-                response.say("An error occurred. Please start over.", voice="alice")
-                response.redirect(f"{BASE_URL}/voice")
-                return Response(str(response), mimetype="application/xml")
-        except Exception as e:
-            print(f"Database error: {e}")
-            db_session.rollback()
-        finally:
-            db_session.close()
+        # Remember the age until the call is finished
+        if call_state.get(call_sid) is not None:
+            call_state.update(call_sid, age=age)
+            logging.debug(f"Age saved for CallSid={call_sid}: {age}")
+        else:
+            logging.error(f"No record found for CallSid={call_sid}")
+            response.say("An error occurred. Please start over.", voice="alice")
+            response.redirect(f"{BASE_URL}/voice")
+            return Response(str(response), mimetype="application/xml")
 
         # Proceed to the next step
         gather = Gather(
@@ -263,17 +630,17 @@ def process_age():
         gather.say("Thank you. Please state your residency.", voice="alice")
         response.append(gather)
     else:
-        print(f"DEBUG: Age input not received for CallSid={call_sid}")
+        logging.debug(f"Age input not received for CallSid={call_sid}")
         response.say("Sorry, I didn't catch that. Please say your age again.", voice="alice")
         response.redirect(f"{BASE_URL}/process_age")
 
     return Response(str(response), mimetype="application/xml")
 
 @app.route("/process_residency", methods=["POST"])
-def process_residency():
+async def process_residency():
     call_sid = request.form.get("CallSid")
     residency = request.form.get("SpeechResult")
-    logging.debug(f"DEBUG: Received /process_residency for CallSid={call_sid}, Residency={residency}")
+    logging.debug(f"Received /process_residency for CallSid={call_sid}, Residency={residency}")
 
     response = VoiceResponse()
 
@@ -284,20 +651,17 @@ def process_residency():
         response.redirect(f"{BASE_URL}/voice")
         return Response(str(response), mimetype="application/xml")
 
-    db_session = SessionLocal()
-    try:
-        # Save residency in the database
-        response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
-        if response_data:
-            response_data.residency = residency
-            db_session.commit()
-        else:
-            logging.warning(f"No record found for CallSid={call_sid}.")
-    except Exception as e:
-        logging.error(f"Database error for CallSid={call_sid}: {e}")
-        db_session.rollback()
-    finally:
-        db_session.close()
+    # Remember the residency; the row is written when the conversation starts
+    if call_state.get(call_sid) is None:
+        logging.error(f"No record found for CallSid={call_sid}")
+        response.say("An error occurred. Please start over.", voice="alice")
+        response.redirect(f"{BASE_URL}/voice")
+        return Response(str(response), mimetype="application/xml")
+    profile = call_state.update(call_sid, residency=residency)
+
+    # Once the prompt is complete, start on the reply while Twilio follows the redirect
+    if profile_complete(profile):
+        start_gpt_prefetch(call_sid, profile)
 
     # Thank the caller and end the call
     response.redirect(f"{BASE_URL}/start_gpt_conversation")
@@ -306,44 +670,69 @@ def process_residency():
 
 
 @app.route("/handle-recording", methods=["POST"])
-def handle_recording():
+async def handle_recording():
     """Handle the recording completion and save the recording URL."""
     recording_url = request.form.get("RecordingUrl")  # URL of the recording from Twilio
     call_sid = request.form.get("CallSid")  # Unique Call SID from Twilio
 
     if recording_url and call_sid:
         # Save to the database
-        db_session = SessionLocal()
-        try:
-            # Check if the record for this CallSid exists
-            response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
-            if not response_data:
-                # Create a new record if it doesn't exist
-                response_data = ResponseData(call_sid=call_sid, recording_url=recording_url)
-                db_session.add(response_data)
-            else:
-                # Update the existing record with the new URL
-                response_data.recording_url = recording_url
-            db_session.commit()
+        if await asyncio.to_thread(save_answer, call_sid, "recording_url", recording_url, create=True):
             logging.info(f"Recording URL saved to database for CallSid={call_sid}: {recording_url}")
-        except Exception as e:
-            logging.error(f"Database error for CallSid={call_sid}: {e}")
-            db_session.rollback()
-        finally:
-            db_session.close()
+        else:
+            logging.error(f"Recording URL for CallSid={call_sid} not saved; it is still queued: {recording_url}")
 
-        # Save to the text file
+        # Queue the recording for transcription and wake a worker; the webhook
+        # returns straight away and the transcript follows in the background
         try:
-            with open("recording_urls.txt", "a") as file:
-                file.write(recording_url + "\n")
-            logging.info(f"Recording URL appended to recording_urls.txt: {recording_url}")
+            await asyncio.to_thread(job_queue.enqueue, recording_url, call_sid=call_sid,
+                                    recording_sid=request.form.get("RecordingSid"))
+            worker = get_transcription_worker()
+            if worker and not worker.notify():
+                logging.warning(f"Transcription workers are busy; CallSid={call_sid} waits in the queue")
         except Exception as e:
-            logging.error(f"Error writing to recording_urls.txt for CallSid={call_sid}: {e}")
+            logging.error(f"Error queueing recording for CallSid={call_sid}: {e}")
 
     else:
         logging.warning("Missing CallSid or RecordingUrl in webhook payload.")
 
     return Response("", status=200)
 
+if sock is not None:
+    @sock.route("/media-stream")
+    def media_stream_route(ws):
+        """Twilio Media Stream for a call in progress, transcribed live into its row."""
+        media_stream.handle_media_stream(ws)
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus scrape endpoint for route, database and OpenAI timings."""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """In-process metrics, e.g. GPT time-to-first-audio percentiles and cache hit rate."""
+    return jsonify(dict(metrics.snapshot(), gpt_response_cache=gpt_response_cache.stats(),
+                        rate_limits=rate_limit.stats()))
+
+
+@app.route("/call-status", methods=["POST"])
+async def call_status():
+    """Twilio status callback: flush answers from calls that ended early."""
+    call_sid = request.form.get("CallSid")
+    call_status = request.form.get("CallStatus")
+    logging.info(f"Call status for CallSid={call_sid}: {call_status}")
+
+    if call_sid and call_status in ("completed", "busy", "failed", "no-answer", "canceled"):
+        state = call_state.pop(call_sid)
+        if state:
+            await asyncio.to_thread(flush_call_state, call_sid, state)
+
+    return Response("", status=200)
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Views are async (requires flask[async]); the threaded server keeps many
+    # calls in flight while each awaits the database or OpenAI.
+    app.run(debug=True, host="0.0.0.0", port=8000, threaded=True)
\ No newline at end of file
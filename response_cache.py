@@ -0,0 +1,123 @@
+import hashlib
+import json
+import re
+import threading
+
+import metrics
+from ttl_cache import TTLCache
+
+# Cache of GPT replies keyed by a hash of the normalized prompt and the model.
+# Optionally, a miss on the exact key falls back to a second key built from
+# the prompt's content words in order, so a paraphrase that only differs in
+# filler ("I'm" for "I am", "and I live" for "and live") hits. Prompts carry
+# the caller's answers, so one different name, age or town is always a miss.
+# Both lookups are a single dict access, whatever the size of the cache.
+
+RESPONSE_CACHE_TTL_SECONDS = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+
+_WORD = re.compile(r"[a-z0-9']+")
+# Words a paraphrase may add, drop or change; everything else must match exactly and in order
+FILLER_WORDS = frozenset(
+    "a an the and or but so i i'm im me my am is are was were be been in on at of to for with from by "
+    "please just well um uh".split()
+)
+
+
+def normalize_text(text):
+    """Lowercase and drop punctuation and extra whitespace."""
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def _hash(model, messages):
+    encoded = json.dumps([model, messages], separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def prompt_key(messages, model):
+    return _hash(model, [(message["role"], normalize_text(message["content"])) for message in messages])
+
+
+def content_words(text):
+    """The words of ``text`` other than FILLER_WORDS, in order."""
+    return [word for word in _WORD.findall(text.lower()) if word not in FILLER_WORDS]
+
+
+def content_key(messages, model):
+    """Key shared by prompts that only differ in filler words."""
+    return _hash(model, [(message["role"], content_words(message["content"])) for message in messages])
+
+
+class ResponseCache:
+    """TTL + LRU cache of GPT replies, with optional paraphrase (content-word) lookups.
+
+    Every entry remembers how long the original OpenAI call took, so hits can
+    report the latency they saved.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL_SECONDS, semantic=False):
+        self.semantic = semantic
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl, on_evict=self._forget)
+        self._content_keys = {}  # content_key -> prompt_key of the entry cached last under it
+        self._entry_content_keys = {}  # prompt_key -> its content_key
+
+    def get(self, messages, model):
+        """Return the cached reply for this prompt, or None."""
+        key = prompt_key(messages, model)
+        entry = self._entries.get(key)
+        semantic_hit = False
+        if entry is None and self.semantic:
+            with self._lock:
+                key = self._content_keys.get(content_key(messages, model))
+            entry = self._entries.get(key) if key else None
+            semantic_hit = entry is not None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.semantic_hits += semantic_hit
+                self.saved_seconds += entry["latency"]
+        if entry is None:
+            metrics.inc("gpt_cache_misses_total")
+            return None
+        metrics.inc("gpt_cache_hits_total")
+        if semantic_hit:
+            metrics.inc("gpt_cache_semantic_hits_total")
+        metrics.inc("gpt_cache_saved_seconds_total", entry["latency"])
+        return entry["reply"]
+
+    def put(self, messages, model, reply, latency=0.0):
+        """Cache a reply; ``latency`` is how long the OpenAI call took."""
+        key = prompt_key(messages, model)
+        self._entries.set(key, {"reply": reply, "latency": latency, "model": model})
+        if self.semantic:
+            paraphrase_key = content_key(messages, model)
+            with self._lock:
+                self._content_keys[paraphrase_key] = key
+                self._entry_content_keys[key] = paraphrase_key
+
+    def _forget(self, key, entry):
+        if not self.semantic:
+            return
+        with self._lock:
+            paraphrase_key = self._entry_content_keys.pop(key, None)
+            if self._content_keys.get(paraphrase_key) == key:
+                del self._content_keys[paraphrase_key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "entries": len(self._entries),
+            }
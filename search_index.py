@@ -0,0 +1,280 @@
+import argparse
+import json
+import logging
+
+from sqlalchemy import select, text
+
+import metrics
+from diarized_transcript import turns_from_json
+from models import ResponseData, get_session
+
+# Full-text search over stored transcripts, in an SQLite FTS5 table with one
+# row per speaker turn. A turn's rowid is its response row's id shifted left
+# by TURN_BITS plus the turn's position, so a transcript's entries are
+# replaced with a rowid range delete instead of a scan of the index. The
+# pipeline updates the index in the same transaction that stores a
+# transcript, so search never sees one without the other. Caller fields are
+# not copied into the index; they are filtered on the responses row itself
+# (through its lower() indexes), so answers flushed after the transcript
+# still match. Databases without FTS5 (e.g. PostgreSQL) get no index and
+# search reports that it is unavailable.
+
+INDEX_TABLE = "transcript_search"
+TOKENIZER = "porter unicode61 remove_diacritics 2"  # Case-, accent- and word-ending-insensitive
+TURN_BITS = 20             # Room for about a million turns per transcript
+REBUILD_BATCH_SIZE = 1000  # Transcripts read per batch when (re)building the index
+SEARCH_LIMIT = 20
+TURNS_PER_CALL = 3         # Best-matching turns returned with each call
+
+_fts5 = None
+
+
+def available(connection):
+    """Whether the database can hold the index: SQLite compiled with FTS5."""
+    global _fts5
+    if _fts5 is None:
+        _fts5 = connection.dialect.name == "sqlite" and bool(
+            connection.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+    return _fts5
+
+
+def create(connection):
+    """Create the index and fill it from the transcripts already stored."""
+    if not available(connection):
+        logging.warning("Transcript search needs SQLite with FTS5; not creating the index")
+        return
+    connection.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} "
+        f"USING fts5(speaker UNINDEXED, text, tokenize='{TOKENIZER}')"
+    ))
+    rebuild(connection)
+
+
+def _entries(row_id, transcript_turns, transcription):
+    """Index rows for one transcript; one without turns is indexed as a single entry."""
+    if transcript_turns:
+        turns = turns_from_json(transcript_turns)
+    elif transcription:
+        turns = [{"speaker": None, "text": transcription}]
+    else:
+        turns = []
+    return [{"rowid": (row_id << TURN_BITS) + index, "speaker": turn["speaker"], "text": turn["text"]}
+            for index, turn in enumerate(turns)]
+
+
+def _replace(connection, rows):
+    """Replace the entries of each (id, transcript_turns, transcription) row; returns the entries written."""
+    if not rows:
+        return 0
+    connection.execute(text(f"DELETE FROM {INDEX_TABLE} WHERE rowid BETWEEN :low AND :high"), [
+        {"low": row_id << TURN_BITS, "high": ((row_id + 1) << TURN_BITS) - 1} for row_id, _, _ in rows
+    ])
+    entries = [entry for row in rows for entry in _entries(*row)]
+    if entries:
+        connection.execute(
+            text(f"INSERT INTO {INDEX_TABLE} (rowid, speaker, text) VALUES (:rowid, :speaker, :text)"), entries)
+    return len(entries)
+
+
+def update_index(db_session, condition):
+    """Re-index the transcripts of the responses rows matching ``condition``.
+
+    Called by the pipeline before it commits a transcript, with the same
+    session, e.g. ``update_index(db_session, ResponseData.id.in_(ids))``.
+    """
+    if not available(db_session.connection()):
+        return 0
+    with metrics.timer("search_index_seconds", operation="update"):
+        rows = db_session.execute(
+            select(ResponseData.id, ResponseData.transcript_turns, ResponseData.transcription).where(condition)
+        ).all()
+        return _replace(db_session, rows)
+
+
+def rebuild(connection):
+    """Re-index every stored transcript, in keyset-paginated batches; returns how many."""
+    connection.execute(text(f"DELETE FROM {INDEX_TABLE}"))
+    indexed = 0
+    after_id = 0
+    while True:
+        rows = connection.execute(
+            select(ResponseData.id, ResponseData.transcript_turns, ResponseData.transcription)
+            .where(ResponseData.id > after_id, ResponseData.transcription != None)
+            .order_by(ResponseData.id).limit(REBUILD_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        _replace(connection, rows)
+        indexed += len(rows)
+        after_id = rows[-1][0]
+    # Merge the per-batch segments so queries read one b-tree per term
+    connection.execute(text(f"INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}) VALUES ('optimize')"))
+    logging.info(f"Indexed {indexed} transcripts for search")
+    return indexed
+
+
+def match_expression(query, phrase=True):
+    """FTS5 query for the user's text: the exact phrase, or all of its words in any order.
+
+    Words are quoted, so punctuation and FTS5 operators in the text are searched for, not parsed.
+    """
+    if phrase:
+        return '"' + query.replace('"', '""') + '"'
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def _caller_filters(first_name, residency, params):
+    clauses = []
+    if first_name:
+        clauses.append("lower(responses.first_name) = lower(:first_name)")
+        params["first_name"] = first_name
+    if residency:
+        clauses.append("lower(responses.residency) = lower(:residency)")
+        params["residency"] = residency
+    return clauses
+
+
+def _matching_turns(db_session, params, speaker_clause, row_ids, turns_per_call):
+    """The best ``turns_per_call`` matching turns of each of ``row_ids``, with the matches highlighted."""
+    rows = db_session.execute(text(
+        f"SELECT rowid, speaker, highlight({INDEX_TABLE}, 1, '[', ']') FROM {INDEX_TABLE} "
+        f"WHERE {INDEX_TABLE} MATCH :query AND (rowid >> {TURN_BITS}) IN ({', '.join(map(str, row_ids))})"
+        f"{speaker_clause} ORDER BY rank"
+    ), params).all()
+    turns = {row_id: [] for row_id in row_ids}
+    for rowid, speaker, highlighted in rows:
+        call_turns = turns[rowid >> TURN_BITS]
+        if len(call_turns) < turns_per_call:
+            call_turns.append({"turn": rowid & ((1 << TURN_BITS) - 1), "speaker": speaker, "text": highlighted})
+    return turns
+
+
+def search(query=None, speaker=None, first_name=None, residency=None, phrase=True, limit=SEARCH_LIMIT,
+           turns_per_call=TURNS_PER_CALL):
+    """Find calls by what was said and who said it, and by the caller's answers.
+
+    ``query`` is matched against single speaker turns (as a phrase, or as
+    all-of-these-words with ``phrase=False``), optionally only turns by
+    ``speaker``; ``first_name`` and ``residency`` match the caller's answers
+    case-insensitively. Calls are ranked by the summed BM25 score of their
+    matching turns. Returns up to ``limit`` dicts with call_sid, first_name,
+    residency, score and the best-matching turns (turn number, speaker,
+    start, end and the text with matches in brackets); None if search is
+    unavailable or failed.
+    """
+    if not query and (speaker is not None or not (first_name or residency)):
+        raise ValueError("Search needs a query, or a first name or residency to match")
+    db_session = get_session()
+    try:
+        if not available(db_session.connection()):
+            logging.error("Transcript search needs SQLite with FTS5")
+            return None
+        with metrics.timer("search_index_seconds", operation="query"):
+            params = {"limit": limit}
+            filters = _caller_filters(first_name, residency, params)
+            if not query:
+                calls = db_session.execute(text(
+                    "SELECT id, call_sid, first_name, residency, NULL FROM responses "
+                    f"WHERE {' AND '.join(filters)} ORDER BY id DESC LIMIT :limit"
+                ), params).all()
+                return [{"call_sid": call_sid, "first_name": first, "residency": home, "score": None, "turns": []}
+                        for _, call_sid, first, home, _ in calls]
+
+            params["query"] = match_expression(query, phrase)
+            speaker_clause = ""
+            if speaker is not None:
+                speaker_clause = " AND speaker = :speaker"
+                params["speaker"] = speaker
+            # Materialized so SQLite doesn't flatten bm25() out of the full-text query it scores
+            calls = db_session.execute(text(
+                f"WITH hits AS MATERIALIZED (SELECT rowid >> {TURN_BITS} AS response_id, "
+                f"bm25({INDEX_TABLE}) AS score FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH :query{speaker_clause}) "
+                "SELECT responses.id, responses.call_sid, responses.first_name, responses.residency, "
+                "SUM(hits.score) AS score FROM hits "
+                "JOIN responses ON responses.id = hits.response_id "
+                + "".join(f"AND {clause} " for clause in filters) +
+                "GROUP BY responses.id ORDER BY score LIMIT :limit"
+            ), params).all()
+            if not calls:
+                return []
+
+            row_ids = [row[0] for row in calls]
+            turns = _matching_turns(db_session, params, speaker_clause, row_ids, turns_per_call)
+            # Turn times come from the stored transcript rather than being duplicated in the index
+            documents = dict(db_session.execute(
+                select(ResponseData.id, ResponseData.transcript_turns).where(ResponseData.id.in_(row_ids))
+            ).all())
+            results = []
+            for row_id, call_sid, first, home, score in calls:
+                timed = turns_from_json(documents[row_id]) if documents.get(row_id) else []
+                for turn in turns[row_id]:
+                    if turn["turn"] < len(timed):
+                        turn["start"] = timed[turn["turn"]]["start"]
+                        turn["end"] = timed[turn["turn"]]["end"]
+                # BM25 scores are negative, lower being better; flipped so higher is better
+                results.append({"call_sid": call_sid, "first_name": first, "residency": home,
+                                "score": round(-score, 3), "turns": turns[row_id]})
+            return results
+    except Exception as e:
+        logging.error(f"Error searching transcripts: {e}")
+        return None
+    finally:
+        db_session.close()
+
+
+def rebuild_index():
+    """Rebuild the whole index, e.g. after restoring transcripts written without it."""
+    db_session = get_session()
+    try:
+        if not available(db_session.connection()):
+            logging.error("Transcript search needs SQLite with FTS5")
+            return None
+        indexed = rebuild(db_session)
+        db_session.commit()
+        return indexed
+    except Exception as e:
+        logging.error(f"Error rebuilding the search index: {e}")
+        db_session.rollback()
+        return None
+    finally:
+        db_session.close()
+
+
+def format_result(result):
+    caller = " ".join(str(field) for field in (result["first_name"], result["residency"]) if field)
+    score = f"  score {result['score']:.2f}" if result["score"] is not None else ""
+    lines = [f"{result['call_sid']}{score}  {caller}".rstrip()]
+    for turn in result["turns"]:
+        at = f"[{turn['start']:.1f}s] " if turn.get("start") is not None else ""
+        speaker = f"Speaker {turn['speaker']}: " if turn["speaker"] is not None else ""
+        lines.append(f"  {at}{speaker}{turn['text']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Search stored call transcripts.")
+    parser.add_argument("query", nargs="?", help="Phrase said in the call (within one speaker turn)")
+    parser.add_argument("--words", action="store_true", help="Match all of the words in any order, not the phrase")
+    parser.add_argument("--speaker", type=int, default=None, help="Only turns by this speaker tag")
+    parser.add_argument("--first-name", help="Caller's first name (case-insensitive)")
+    parser.add_argument("--residency", help="Caller's residency (case-insensitive)")
+    parser.add_argument("--limit", type=int, default=SEARCH_LIMIT, help="Most calls to return")
+    parser.add_argument("--turns", type=int, default=TURNS_PER_CALL, help="Matching turns shown per call")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index from the stored transcripts")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print(f"Indexed {rebuild_index()} transcripts")
+    if args.query or args.first_name or args.residency:
+        found = search(args.query, speaker=args.speaker, first_name=args.first_name, residency=args.residency,
+                       phrase=not args.words, limit=args.limit, turns_per_call=args.turns)
+        if found is None:
+            raise SystemExit(1)
+        if args.json:
+            print(json.dumps(found, indent=2))
+        else:
+            print("\n".join(format_result(result) for result in found) or "No matching calls")
+    elif not args.rebuild:
+        parser.error("give a query, --first-name or --residency, or --rebuild")
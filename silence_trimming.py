@@ -0,0 +1,103 @@
+import bisect
+import logging
+
+try:
+    import numpy as np
+except ImportError:  # Trimming is skipped without numpy
+    np = None
+
+# Energy-based voice activity detection for mono PCM16. Long silent spans
+# (Gather timeouts, hold time, dead air) are compressed to a short pause
+# before the audio is sent to Speech, and an OffsetMap translates times in
+# the trimmed audio back to the original recording.
+
+FRAME_SECONDS = 0.02
+SILENCE_THRESHOLD_DBFS = -45.0   # Frames quieter than this count as silence
+MIN_SILENCE_SECONDS = 1.0        # Shorter pauses are left alone
+KEEP_SILENCE_SECONDS = 0.3       # What remains of a longer pause, split across both ends
+
+
+class OffsetMap:
+    """Maps times in trimmed audio back to the original recording.
+
+    ``segments`` are the ``(start, end)`` sample ranges of the original audio
+    that were kept, in order; the trimmed audio is their concatenation.
+    """
+
+    def __init__(self, segments, sample_rate, original_samples):
+        self.segments = segments
+        self.sample_rate = sample_rate
+        self.original_samples = original_samples
+        self._trimmed_starts = []
+        position = 0
+        for start, end in segments:
+            self._trimmed_starts.append(position)
+            position += end - start
+        self.kept_samples = position
+
+    @property
+    def original_seconds(self):
+        return self.original_samples / float(self.sample_rate)
+
+    @property
+    def removed_seconds(self):
+        return (self.original_samples - self.kept_samples) / float(self.sample_rate)
+
+    @property
+    def removed_fraction(self):
+        return 1.0 - self.kept_samples / float(self.original_samples) if self.original_samples else 0.0
+
+    def to_original(self, seconds):
+        """Original-recording time for a time in the trimmed audio."""
+        if not self.segments:
+            return seconds
+        sample = int(round(seconds * self.sample_rate))
+        index = max(0, bisect.bisect_right(self._trimmed_starts, sample) - 1)
+        return (self.segments[index][0] + sample - self._trimmed_starts[index]) / float(self.sample_rate)
+
+    def restore_words(self, words):
+        """Copy of ``words`` (dicts with start and end seconds) in original-recording time."""
+        return [dict(word, start=self.to_original(word["start"]), end=self.to_original(word["end"]))
+                for word in words]
+
+
+def _runs(mask):
+    """``(start, end)`` index pairs of the runs of True in a boolean array."""
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return edges.reshape(-1, 2)
+
+
+def trim_silence(pcm, sample_rate, threshold_dbfs=SILENCE_THRESHOLD_DBFS,
+                 min_silence_seconds=MIN_SILENCE_SECONDS, keep_silence_seconds=KEEP_SILENCE_SECONDS):
+    """Compress long silences in mono PCM16; returns ``(trimmed_pcm, offset_map)``."""
+    total = len(pcm) // 2
+    if np is None:
+        logging.warning("numpy is not installed; silence trimming is disabled")
+        return pcm, OffsetMap([(0, total)], sample_rate, total)
+
+    frame = max(1, int(FRAME_SECONDS * sample_rate))
+    frame_count = total // frame
+    samples = np.frombuffer(pcm, dtype="<i2", count=total)
+    frames = samples[:frame_count * frame].astype(np.float32).reshape(-1, frame)
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / frame)
+    loudness = 20 * np.log10(rms / 32768.0 + 1e-10)
+
+    keep = np.ones(frame_count, dtype=bool)
+    min_silence = int(min_silence_seconds / FRAME_SECONDS)
+    pad = int(keep_silence_seconds / FRAME_SECONDS / 2)
+    for start, end in _runs(loudness < threshold_dbfs):
+        if end - start >= max(min_silence, 2 * pad + 1):
+            keep[start + pad:end - pad] = False
+
+    segments = [(int(start) * frame, int(end) * frame) for start, end in _runs(keep)]
+    if frame_count * frame < total:
+        # The partial frame at the end is always kept
+        if segments and segments[-1][1] == frame_count * frame:
+            segments[-1] = (segments[-1][0], total)
+        else:
+            segments.append((frame_count * frame, total))
+    offset_map = OffsetMap(segments, sample_rate, total)
+    if len(segments) == 1 and segments[0] == (0, total):
+        return pcm, offset_map
+    trimmed = np.concatenate([samples[start:end] for start, end in segments]) if segments else samples[:0]
+    return trimmed.astype("<i2", copy=False).tobytes(), offset_map
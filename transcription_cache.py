@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# Content-addressed cache of finished transcriptions.
+# Entries are keyed by the audio hash plus the recognition parameters, so the
+# same audio transcribed with a different language or speaker count is a miss.
+
+CACHE_DIR = "transcription_cache"
+MAX_CACHE_BYTES = 256 * 1024 * 1024  # Least recently used entries are evicted past this size
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as audio_file:
+        for chunk in iter(lambda: audio_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(audio_hash, params):
+    """Combine an audio hash and recognition parameters into a cache key."""
+    encoded = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{audio_hash}:{encoded}".encode("utf-8")).hexdigest()
+
+
+class TranscriptionCache:
+    """On-disk transcription cache with size-based LRU eviction.
+
+    Each entry is a text file named after its key; the file's mtime is bumped
+    on every hit and is used as the recency order for eviction. Safe to share
+    between threads.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def get(self, key):
+        """Return the cached transcription for ``key``, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as cached_file:
+                transcription = cached_file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return transcription
+
+    def put(self, key, transcription):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as cached_file:
+                cached_file.write(transcription)
+            with self._lock:
+                previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+                os.replace(tmp_path, path)
+                self._size += os.path.getsize(path) - previous_size
+                if self._size > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            logging.error(f"Error writing transcription cache entry {key}: {e}")
+
+    def _evict(self):
+        """Remove least recently used entries until under the size limit. Caller holds the lock."""
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name.endswith(".txt")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size_bytes": self._size,
+            }
@@ -1,13 +1,29 @@
 import os
-import requests
+import argparse
+import hashlib
+import struct
+import threading
+import time
 import subprocess
-import wave
 import logging
-from google.cloud import speech, storage
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine, Column, String, Integer
-from sqlalchemy.ext.declarative import declarative_base
+from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import all_access_keys
+import clients
+import job_queue
+import metrics
+import rate_limit
+import search_index
+from sqlalchemy import bindparam, update
+from models import ResponseData, get_session
+from diarized_transcript import (
+    extract_words, build_turns, render_turns, turns_to_json, turns_from_json, TRANSCRIPT_FORMAT_VERSION,
+)
+from transcription_cache import TranscriptionCache, hash_file, cache_key
+
+# The Speech SDK, requests, numpy and the chunking/trimming stages are imported
+# where they are used, so short cron runs and --help start quickly.
 
 # Set up logging configuration
 logging.basicConfig(
@@ -28,26 +44,50 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = all_access_keys.GOOGLE_APPLICATIO
 
 
 
-# Google Cloud and database setup
-DATABASE_URL = "sqlite:///transcriptions.db"  # Replace with your DB connection string
+# Google Cloud setup (the database is configured in models.py)
 GCS_BUCKET_NAME = 'audiofilesprankcall'
 
-# Database setup
-Base = declarative_base()
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
+# Recognition settings (also part of the transcription cache key)
+LANGUAGE_CODE = "en-US"
+MIN_SPEAKER_COUNT = 1
+MAX_SPEAKER_COUNT = 2  # Adjust based on expected number of speakers
+
+# Concurrency settings
+MAX_WORKERS = 4          # Threads for download and recognize (I/O bound)
+MAX_CONVERT_WORKERS = 2  # Processes for ffmpeg conversion (CPU bound)
+
+# Streaming mode pipes the download through ffmpeg into memory instead of temp files
+STREAMING_MODE = False
+SAMPLE_RATE_HERTZ = 16000
+BYTES_PER_SECOND = SAMPLE_RATE_HERTZ * 2  # Mono PCM16
+
+# Chunked mode recognizes long audio as parallel sub-minute windows with the
+# synchronous API, instead of uploading it for long_running_recognize
+CHUNKED_RECOGNITION = False
+MAX_SYNC_SECONDS = 60
+
+# Compress long silences before recognition; word times are mapped back to the recording
+TRIM_SILENCE = False
 
+UNPROCESSED_BATCH_SIZE = 500  # Rows read per query when scanning for untranscribed recordings
 
-# Database Model
-class ResponseData(Base):
-    __tablename__ = 'responses'
-    id = Column(Integer, primary_key=True, index=True)
-    call_sid = Column(String, unique=True, index=True)
-    recording_url = Column(String, nullable=True)
-    transcription = Column(String, nullable=True)
+WAV_PROBE_BYTES = 4096  # Enough to reach the fmt and data chunk headers
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
 
+# Created on first use, so importing the module (e.g. from the webhook) never touches the disk
+_transcription_cache = None
+_transcription_cache_lock = threading.Lock()
 
-Base.metadata.create_all(engine)  # Create tables if they don't exist
+
+def get_transcription_cache():
+    """The on-disk transcription cache, created (and its directory scanned) on first use."""
+    global _transcription_cache
+    if _transcription_cache is None:
+        with _transcription_cache_lock:
+            if _transcription_cache is None:
+                _transcription_cache = TranscriptionCache()
+    return _transcription_cache
 
 
 # Helper Functions
@@ -60,12 +100,18 @@ def read_recording_urls(file_path="recording_urls.txt"):
         return []
 
 
-def get_unprocessed_recordings():
-    """Fetch unprocessed recording URLs from the database."""
-    db_session = SessionLocal()
+def get_unprocessed_batch(after_id=0, batch_size=UNPROCESSED_BATCH_SIZE):
+    """The next ``batch_size`` untranscribed recordings with an id above ``after_id``.
+
+    Rows are ``(id, recording_url, call_sid)`` in id order, so the last id of
+    one batch is the cursor for the next (keyset pagination: every page costs
+    the same however deep into the table it is).
+    """
+    db_session = get_session()
     try:
-        recordings = db_session.query(ResponseData).filter(ResponseData.transcription == None).all()
-        return recordings
+        return db_session.query(ResponseData.id, ResponseData.recording_url, ResponseData.call_sid).filter(
+            ResponseData.id > after_id, ResponseData.transcription == None, ResponseData.recording_url != None
+        ).order_by(ResponseData.id).limit(batch_size).all()
     except Exception as e:
         logging.error(f"Error fetching recordings from database: {e}")
         return []
@@ -73,29 +119,118 @@ def get_unprocessed_recordings():
         db_session.close()
 
 
+def get_unprocessed_recordings(batch_size=UNPROCESSED_BATCH_SIZE):
+    """Yield every unprocessed recording, reading the database one batch at a time."""
+    after_id = 0
+    while True:
+        batch = get_unprocessed_batch(after_id, batch_size)
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        after_id = batch[-1].id
+
+
+def record_download(size, seconds):
+    metrics.inc("pipeline_download_bytes_total", size)
+    metrics.observe("pipeline_stage_seconds", seconds, stage="download")
+    if seconds > 0:
+        metrics.observe("pipeline_download_bytes_per_second", size / seconds)
+
+
 def download_recording(recording_url, filename="recording.wav"):
+    import requests
     try:
-        response = requests.get(recording_url, stream=True)
+        start = time.perf_counter()
+        size = 0
+        response = clients.http_session().get(recording_url, stream=True, timeout=clients.HTTP_TIMEOUT_SECONDS)
         response.raise_for_status()
         with open(filename, "wb") as audio_file:
             for chunk in response.iter_content(chunk_size=4096):
                 audio_file.write(chunk)
-        logging.info(f"Recording saved as {filename}")
+                size += len(chunk)
+        record_download(size, time.perf_counter() - start)
+        logging.info(f"Recording saved as {filename} ({size} bytes)")
         return filename
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to download recording: {e}")
         return None
 
 
-def is_valid_wav(file_path):
+def parse_wav_header(header):
+    """Parse the RIFF/fmt/data chunk headers from the first bytes of a WAV file.
+
+    Only the chunk headers are walked; the sample data is never read.
+    Returns a dict with format_tag, channels, sample_rate, bits_per_sample,
+    data_offset and data_size, or None if the bytes are not a WAV header.
+    """
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+
+    info = {}
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", header, offset)
+        body = offset + 8
+        if chunk_id == b"fmt " and body + 16 <= len(header):
+            format_tag, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", header, body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40 and body + 26 <= len(header):
+                # The real format is the first two bytes of the SubFormat GUID
+                format_tag = struct.unpack_from("<H", header, body + 24)[0]
+            info.update(format_tag=format_tag, channels=channels, sample_rate=sample_rate,
+                        bits_per_sample=bits_per_sample)
+        elif chunk_id == b"data":
+            info.update(data_offset=body, data_size=chunk_size)
+            break
+        offset = body + chunk_size + (chunk_size & 1)  # Chunks are word aligned
+
+    if "format_tag" not in info or "data_offset" not in info:
+        return None
+    return info
+
+
+def probe_wav_file(file_path):
+    """Read just the header of a WAV file and return ``parse_wav_header`` info."""
     try:
-        with wave.open(file_path, "rb") as wav_file:
-            sample_rate = wav_file.getframerate()
-            channels = wav_file.getnchannels()
-            return sample_rate == 16000 and channels == 1
-    except wave.Error as e:
-        logging.error(f"Error checking WAV file: {e}")
-        return False
+        with open(file_path, "rb") as wav_file:
+            info = parse_wav_header(wav_file.read(WAV_PROBE_BYTES))
+        if info:
+            # Streaming writers leave the data size as 0 or 0xFFFFFFFF
+            available = os.path.getsize(file_path) - info["data_offset"]
+            if not info["data_size"] or info["data_size"] > available:
+                info["data_size"] = available
+        return info
+    except OSError as e:
+        logging.error(f"Error probing WAV file: {e}")
+        return None
+
+
+def is_compliant_wav(info):
+    """True if the header describes 16 kHz mono PCM16, which Speech accepts as-is."""
+    return bool(info) and (
+        info["format_tag"] == WAVE_FORMAT_PCM
+        and info["channels"] == 1
+        and info["sample_rate"] == SAMPLE_RATE_HERTZ
+        and info["bits_per_sample"] == 16
+    )
+
+
+def is_valid_wav(file_path):
+    return is_compliant_wav(probe_wav_file(file_path))
+
+
+def read_wav_pcm(file_path, info=None):
+    """Read just the sample data of a WAV file, skipping its header."""
+    info = info or probe_wav_file(file_path)
+    if not info:
+        return None
+    with open(file_path, "rb") as audio_file:
+        audio_file.seek(info["data_offset"])
+        return audio_file.read(info["data_size"])
+
+
+def record_conversion(skipped):
+    """Count recordings that skipped ffmpeg because they were already compliant."""
+    metrics.inc("pipeline_conversions_total", result="skipped" if skipped else "transcoded")
 
 
 def convert_to_wav(input_file, output_file="converted_recording.wav"):
@@ -111,73 +246,237 @@ def convert_to_wav(input_file, output_file="converted_recording.wav"):
         return None
 
 
-def upload_to_gcs(file_path, destination_blob_name):
+def stream_recording_to_pcm(recording_url):
+    """Download a recording and transcode it to 16 kHz mono PCM16 entirely in memory.
+
+    The HTTP body is piped straight into ffmpeg's stdin while its raw PCM output
+    is read from stdout into a single buffer, so nothing touches the disk.
+    Bodies that are already 16 kHz mono PCM16 WAV are kept as-is without ffmpeg.
+    Returns ``(pcm_bytes, sha256_of_download)`` or ``(None, None)`` on failure.
+    """
+    import requests
+    start = time.perf_counter()
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
+        response = clients.http_session().get(recording_url, stream=True, timeout=clients.HTTP_TIMEOUT_SECONDS)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to download recording: {e}")
+        return None, None
+
+    digest = hashlib.sha256()
+    downloaded = [0, 0.0]  # Bytes received and when the body ended
+    chunks = response.iter_content(chunk_size=64 * 1024)
+
+    # Peek at the header: already-compliant WAV audio skips ffmpeg entirely
+    head = b""
+    try:
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= WAV_PROBE_BYTES:
+                break
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to download recording: {e}")
+        return None, None
+    digest.update(head)
+    downloaded[0] = len(head)
+
+    info = parse_wav_header(head)
+    if is_compliant_wav(info):
+        try:
+            parts = [head[info["data_offset"]:]]
+            for chunk in chunks:
+                digest.update(chunk)
+                parts.append(chunk)
+                downloaded[0] += len(chunk)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to download recording: {e}")
+            return None, None
+        finally:
+            response.close()
+        pcm = b"".join(parts)
+        if info["data_size"] and len(pcm) > info["data_size"]:
+            pcm = pcm[:info["data_size"]]  # Drop trailing metadata chunks
+        record_download(downloaded[0], time.perf_counter() - start)
+        record_conversion(skipped=True)
+        logging.info(f"Streamed {recording_url} without conversion ({len(pcm)} bytes of PCM)")
+        return pcm, digest.hexdigest()
+
+    process = subprocess.Popen([
+        "ffmpeg", "-loglevel", "error", "-i", "pipe:0",
+        "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(SAMPLE_RATE_HERTZ), "pipe:1"
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    feed_errors = []
+
+    def feed_ffmpeg():
+        try:
+            process.stdin.write(head)
+            for chunk in chunks:
+                digest.update(chunk)
+                process.stdin.write(chunk)
+                downloaded[0] += len(chunk)
+            downloaded[1] = time.perf_counter()
+        except (BrokenPipeError, requests.exceptions.RequestException) as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            response.close()
+
+    # Feed stdin from a separate thread so ffmpeg never blocks on a full stdout pipe
+    feeder = threading.Thread(target=feed_ffmpeg, daemon=True)
+    feeder.start()
+    pcm = process.stdout.read()
+    errors = process.stderr.read()
+    process.wait()
+    feeder.join()
+
+    if feed_errors:
+        logging.error(f"Failed to stream recording {recording_url}: {feed_errors[0]}")
+        return None, None
+    if process.returncode != 0:
+        logging.error(f"Error converting stream from {recording_url}: {errors.decode(errors='replace').strip()}")
+        return None, None
+    # The download and ffmpeg overlap; ffmpeg time is what remains after the body ended
+    finished = time.perf_counter()
+    record_download(downloaded[0], (downloaded[1] or finished) - start)
+    metrics.observe("pipeline_stage_seconds", finished - (downloaded[1] or start), stage="ffmpeg")
+    record_conversion(skipped=False)
+    logging.info(f"Streamed and converted {recording_url} ({len(pcm)} bytes of PCM)")
+    return pcm, digest.hexdigest()
+
+
+def upload_to_gcs(content, destination_blob_name):
+    """Upload audio bytes for long_running_recognize; returns the gs:// URI, or None."""
+    try:
+        bucket = clients.storage_client().bucket(GCS_BUCKET_NAME)
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(file_path)
+        with metrics.timer("pipeline_stage_seconds", stage="gcs_upload"):
+            rate_limit.limiter("gcs").call(blob.upload_from_string, content, content_type="application/octet-stream")
         gcs_uri = f"gs://{GCS_BUCKET_NAME}/{destination_blob_name}"
-        logging.info(f"Uploaded {file_path} to {gcs_uri}")
+        logging.info(f"Uploaded {len(content)} bytes to {gcs_uri}")
         return gcs_uri
+    except rate_limit.CircuitOpenError:
+        raise
     except Exception as e:
         logging.error(f"Error uploading to GCS: {e}")
         return None
 
 
-from google.cloud import speech
-
-def transcribe_audio_with_diarization(file_path):
-    try:
-        client = speech.SpeechClient()
-
-        # Get audio duration
-        with wave.open(file_path, "rb") as wav_file:
-            frames = wav_file.getnframes()
-            rate = wav_file.getframerate()
-            duration = frames / float(rate)
-            logging.info(f"Audio duration: {duration} seconds")
-
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=16000,
-            language_code="en-US",
-            enable_automatic_punctuation=True,
-            diarization_config=speech.SpeakerDiarizationConfig(
-                enable_speaker_diarization=True,
-                min_speaker_count=1,
-                max_speaker_count=2  # Adjust based on expected number of speakers
-            )
+def build_recognition_config():
+    from google.cloud import speech
+    return speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        sample_rate_hertz=SAMPLE_RATE_HERTZ,
+        language_code=LANGUAGE_CODE,
+        enable_automatic_punctuation=True,
+        enable_word_confidence=True,
+        diarization_config=speech.SpeakerDiarizationConfig(
+            enable_speaker_diarization=True,
+            min_speaker_count=MIN_SPEAKER_COUNT,
+            max_speaker_count=MAX_SPEAKER_COUNT
         )
-
-        if duration <= 60:
-            with open(file_path, "rb") as audio_file:
-                content = audio_file.read()
-            audio = speech.RecognitionAudio(content=content)
-            response = client.recognize(config=config, audio=audio)
+    )
+
+
+def response_turns(response, offset_map=None):
+    """Speaker turns from a diarized response, in original-recording time."""
+    words = extract_words(response)
+    if offset_map is not None:
+        words = offset_map.restore_words(words)
+    return build_turns(words)
+
+
+def trim_pcm(pcm):
+    """Run the silence-trimming stage if enabled; returns ``(pcm, offset_map or None)``."""
+    if not TRIM_SILENCE:
+        return pcm, None
+    from silence_trimming import trim_silence
+    with metrics.timer("pipeline_stage_seconds", stage="trim_silence"):
+        trimmed, offset_map = trim_silence(pcm, SAMPLE_RATE_HERTZ)
+    metrics.inc("pipeline_trim_input_seconds_total", offset_map.original_seconds)
+    metrics.inc("pipeline_trim_removed_seconds_total", offset_map.removed_seconds)
+    logging.info(f"Trimmed {offset_map.removed_fraction:.1%} of the audio as silence "
+                 f"({offset_map.removed_seconds:.1f}s of {offset_map.original_seconds:.1f}s)")
+    return trimmed, offset_map
+
+
+def transcribe_pcm_in_windows(client, config, pcm, offset_map=None):
+    """Recognize PCM longer than a minute as parallel windows; returns speaker turns."""
+    from google.cloud import speech
+    from chunked_recognition import recognize_in_windows
+
+    def recognize(window):
+        with metrics.timer("pipeline_stage_seconds", stage="recognize_window"):
+            return rate_limit.limiter("speech").call(
+                client.recognize, config=config, audio=speech.RecognitionAudio(content=window))
+
+    with metrics.timer("pipeline_stage_seconds", stage="recognize_chunked"):
+        words = recognize_in_windows(recognize, pcm, SAMPLE_RATE_HERTZ)
+    if offset_map is not None:
+        words = offset_map.restore_words(words)
+    return build_turns(words)
+
+
+def transcribe_pcm_with_diarization(pcm, blob_name, offset_map=None):
+    """Transcribe raw 16 kHz mono PCM16 held in memory.
+
+    Every recording takes this path, whether the buffer came from
+    ``stream_recording_to_pcm`` or from a WAV file. It is passed to the
+    Recognize request as-is, and the duration comes from its length.
+    ``offset_map`` relates trimmed audio back to the original recording.
+    Returns the speaker turns, or None on failure. Raises
+    ``rate_limit.CircuitOpenError`` if Speech or GCS is refusing calls.
+    """
+    from google.cloud import speech
+    try:
+        client = clients.speech_client()
+        duration = len(pcm) / float(BYTES_PER_SECOND)
+        logging.info(f"Audio duration: {duration} seconds")
+        config = build_recognition_config()
+
+        if duration <= MAX_SYNC_SECONDS:
+            audio = speech.RecognitionAudio(content=pcm)
+            with metrics.timer("pipeline_stage_seconds", stage="recognize"):
+                response = rate_limit.limiter("speech").call(client.recognize, config=config, audio=audio)
+        elif CHUNKED_RECOGNITION:
+            turns = transcribe_pcm_in_windows(client, config, pcm, offset_map)
+            metrics.inc("pipeline_audio_seconds_total", duration)
+            logging.info("Transcription completed.")
+            return turns
         else:
-            destination_blob_name = os.path.basename(file_path)
-            gcs_uri = upload_to_gcs(file_path, destination_blob_name)
+            gcs_uri = upload_to_gcs(pcm, blob_name)
             if not gcs_uri:
                 return None
             audio = speech.RecognitionAudio(uri=gcs_uri)
-            operation = client.long_running_recognize(config=config, audio=audio)
-            logging.info("Waiting for operation to complete...")
-            response = operation.result(timeout=900)
-
-        transcription = ""
-        for result in response.results:
-            words_info = result.alternatives[0].words
-            for word_info in words_info:
-                transcription += f"Speaker {word_info.speaker_tag}: {word_info.word} "
+            with metrics.timer("pipeline_stage_seconds", stage="long_running_recognize"):
+                operation = rate_limit.limiter("speech").call(client.long_running_recognize, config=config, audio=audio)
+                logging.info("Waiting for operation to complete...")
+                response = operation.result(timeout=900)
 
+        metrics.inc("pipeline_audio_seconds_total", duration)
         logging.info("Transcription completed.")
-        return transcription.strip()
+        return response_turns(response, offset_map)
+    except rate_limit.CircuitOpenError:
+        raise  # Not this recording's fault; run_job defers it
     except Exception as e:
         logging.error(f"Error transcribing audio with diarization: {e}")
         return None
 
 
+def transcribe_audio_with_diarization(file_path):
+    """Transcribe a 16 kHz mono PCM16 WAV file; returns the speaker turns, or None.
+
+    The samples are read past the header and go through ``transcribe_pcm_with_diarization``.
+    """
+    info = probe_wav_file(file_path)
+    if not is_compliant_wav(info):
+        logging.error(f"Not a 16 kHz mono PCM16 WAV file: {file_path}")
+        return None
+    return transcribe_pcm_with_diarization(read_wav_pcm(file_path, info), f"{os.path.basename(file_path)}.pcm")
+
 
 def save_transcription(transcription, output_file):
     try:
@@ -188,43 +487,369 @@ def save_transcription(transcription, output_file):
         logging.error(f"Error saving transcription: {e}")
 
 
-def process_recording(recording_url):
+def save_transcription_to_db(recording_url, transcription, call_sid=None, transcript_turns=None):
+    """Store the transcription on the recording's row so it is not picked up again.
+
+    ``transcript_turns`` is the structured JSON kept next to the text view.
+    The row's search index entries are updated in the same transaction.
+    Returns False if the write failed, so the caller can retry the recording.
+    """
+    db_session = get_session()
+    try:
+        updated = db_session.query(ResponseData).filter_by(recording_url=recording_url).update(
+            {ResponseData.transcription: transcription, ResponseData.transcript_turns: transcript_turns},
+            synchronize_session=False
+        )
+        if not updated and call_sid:
+            response_data = db_session.query(ResponseData).filter_by(call_sid=call_sid).first()
+            if not response_data:
+                response_data = ResponseData(call_sid=call_sid)
+                db_session.add(response_data)
+            response_data.recording_url = recording_url
+            response_data.transcription = transcription
+            response_data.transcript_turns = transcript_turns
+        search_index.update_index(db_session, ResponseData.recording_url == recording_url)
+        db_session.commit()
+        logging.info(f"Transcription saved to database for {recording_url}")
+        return True
+    except Exception as e:
+        logging.error(f"Error saving transcription to database for {recording_url}: {e}")
+        db_session.rollback()
+        return False
+    finally:
+        db_session.close()
+
+
+def save_transcriptions_to_db(documents):
+    """Store many transcripts with one executemany UPDATE.
+
+    ``documents`` maps ResponseData ids to ``turns_to_json`` output. Rows that
+    were transcribed in the meantime (e.g. by a live worker) are left alone.
+    The rows are re-indexed for search in the same transaction.
+    Returns the number of rows updated, or None if the write failed.
+    """
+    if not documents:
+        return 0
+    statement = update(ResponseData.__table__).where(
+        ResponseData.id == bindparam("row_id"), ResponseData.transcription == None
+    ).values(transcription=bindparam("text"), transcript_turns=bindparam("turns"))
+    rows = [{"row_id": row_id, "text": render_turns(turns_from_json(document)), "turns": document}
+            for row_id, document in documents.items()]
+    db_session = get_session()
+    try:
+        updated = db_session.execute(statement, rows).rowcount
+        search_index.update_index(db_session, ResponseData.id.in_(list(documents)))
+        db_session.commit()
+        return updated
+    except Exception as e:
+        logging.error(f"Error saving {len(rows)} transcriptions to database: {e}")
+        db_session.rollback()
+        return None
+    finally:
+        db_session.close()
+
+
+def recognition_params():
+    """Recognition settings that affect the transcript, used in the cache key."""
+    params = {
+        "language_code": LANGUAGE_CODE,
+        "min_speaker_count": MIN_SPEAKER_COUNT,
+        "max_speaker_count": MAX_SPEAKER_COUNT,
+        "sample_rate_hertz": SAMPLE_RATE_HERTZ,
+        "enable_automatic_punctuation": True,
+        "enable_word_confidence": True,
+        "transcript_format": TRANSCRIPT_FORMAT_VERSION,
+    }
+    if CHUNKED_RECOGNITION:
+        # Stitched windows can differ slightly from a single long-running result
+        params["chunked"] = True
+    if TRIM_SILENCE:
+        from silence_trimming import SILENCE_THRESHOLD_DBFS, MIN_SILENCE_SECONDS, KEEP_SILENCE_SECONDS
+        params["trim_silence"] = [SILENCE_THRESHOLD_DBFS, MIN_SILENCE_SECONDS, KEEP_SILENCE_SECONDS]
+    return params
+
+
+def store_transcript(recording_url, document, transcription_file, call_sid=None):
+    """Save a transcript (``turns_to_json`` output) to file and database.
+
+    Returns its text view, or None if it could not be stored in the database.
+    """
+    transcription = render_turns(turns_from_json(document))
+    save_transcription(transcription, transcription_file)
+    if not save_transcription_to_db(recording_url, transcription, call_sid, document):
+        return None
+    return transcription
+
+
+def transcribe_recording(recording_url, convert_executor=None):
+    """Download, convert and transcribe a single recording without storing it.
+
+    Audio whose hash and recognition settings match an earlier run is served
+    from the transcription cache without converting or calling Speech.
+    When ``convert_executor`` is given the ffmpeg conversion is submitted to it
+    (a process pool) instead of running in the calling thread.
+    Returns the transcript as ``turns_to_json`` output, or None if any stage failed.
+    """
     recording_sid = recording_url.split("/")[-1]
     downloaded_file = f"{recording_sid}.wav"
     converted_file = f"converted_{recording_sid}.wav"
-    transcription_file = f"{recording_sid}_transcription.txt"
 
     if not download_recording(recording_url, downloaded_file):
-        return
+        return None
 
-    file_to_transcribe = converted_file if is_valid_wav(downloaded_file) else convert_to_wav(downloaded_file, converted_file)
+    key = cache_key(hash_file(downloaded_file), recognition_params())
+    document = get_transcription_cache().get(key)
+    if document is not None:
+        logging.info(f"Transcription cache hit for {recording_url}")
+        try:
+            os.remove(downloaded_file)
+        except Exception as e:
+            logging.error(f"Error cleaning up files: {e}")
+        return document
+
+    # Compliant audio goes straight to recognition; only the rest is transcoded
+    compliant = is_valid_wav(downloaded_file)
+    record_conversion(skipped=compliant)
+    if compliant:
+        file_to_transcribe = downloaded_file
+    else:
+        # Measured from this worker, so it includes any wait for a free process
+        with metrics.timer("pipeline_stage_seconds", stage="ffmpeg"):
+            if convert_executor is not None:
+                file_to_transcribe = convert_executor.submit(convert_to_wav, downloaded_file, converted_file).result()
+            else:
+                file_to_transcribe = convert_to_wav(downloaded_file, converted_file)
     if not file_to_transcribe:
-        return
-
-    transcription = transcribe_audio_with_diarization(file_to_transcribe)
-    if transcription:
-        save_transcription(transcription, transcription_file)
+        return None
 
     try:
-        os.remove(downloaded_file)
-        os.remove(converted_file)
-    except Exception as e:
-        logging.error(f"Error cleaning up files: {e}")
+        if TRIM_SILENCE:
+            pcm, offset_map = trim_pcm(read_wav_pcm(file_to_transcribe))
+            turns = transcribe_pcm_with_diarization(pcm, f"{recording_sid}.pcm", offset_map)
+        else:
+            turns = transcribe_audio_with_diarization(file_to_transcribe)
+    finally:
+        try:
+            os.remove(downloaded_file)
+            if not compliant:
+                os.remove(converted_file)
+        except Exception as e:
+            logging.error(f"Error cleaning up files: {e}")
+
+    document = None
+    if turns:
+        document = turns_to_json(turns)
+        get_transcription_cache().put(key, document)
+    return document
+
+
+def transcribe_recording_streaming(recording_url):
+    """Streaming variant of ``transcribe_recording`` that never writes temporary audio files."""
+    recording_sid = recording_url.split("/")[-1]
+
+    pcm, audio_hash = stream_recording_to_pcm(recording_url)
+    if pcm is None:
+        return None
+
+    key = cache_key(audio_hash, recognition_params())
+    document = get_transcription_cache().get(key)
+    if document is not None:
+        logging.info(f"Transcription cache hit for {recording_url}")
+    else:
+        pcm, offset_map = trim_pcm(pcm)
+        turns = transcribe_pcm_with_diarization(pcm, f"{recording_sid}.pcm", offset_map)
+        if turns:
+            document = turns_to_json(turns)
+            get_transcription_cache().put(key, document)
+    return document
+
+
+def process_recording(recording_url, convert_executor=None, call_sid=None, streaming=False):
+    """Transcribe a single recording and store the transcript in its file and database row.
+
+    Returns the transcription, or None if any stage failed.
+    """
+    if streaming:
+        document = transcribe_recording_streaming(recording_url)
+    else:
+        document = transcribe_recording(recording_url, convert_executor)
+    if document is None:
+        return None
+    transcription_file = f"{recording_url.split('/')[-1]}_transcription.txt"
+    return store_transcript(recording_url, document, transcription_file, call_sid)
+
+
+def process_recording_streaming(recording_url, call_sid=None):
+    """Streaming variant of ``process_recording`` that never writes temporary audio files."""
+    return process_recording(recording_url, call_sid=call_sid, streaming=True)
+
 
+def enqueue_pending_recordings():
+    """Queue recordings from the database and the legacy text file.
 
-def process_all_recordings():
-    # Process recordings from the database
-    recordings = get_unprocessed_recordings()
-    for record in recordings:
-        logging.info(f"Processing from database: {record.recording_url}")
-        process_recording(record.recording_url)
+    Enqueueing is idempotent on the recording SID, so recordings that were
+    already queued (or transcribed) by an earlier run are not picked up again.
+    """
+    queued = 0
+    for record in get_unprocessed_recordings():
+        if record.recording_url and job_queue.enqueue(record.recording_url, call_sid=record.call_sid):
+            queued += 1
+    for url in read_recording_urls():
+        if url and job_queue.enqueue(url):
+            queued += 1
+    logging.info(f"Queued {queued} new recordings")
+    return queued
 
-    # Process recordings from the text file
-    urls = read_recording_urls()
-    for url in urls:
-        logging.info(f"Processing from text file: {url}")
-        process_recording(url)
+
+def run_job(job, convert_executor=None, streaming=False):
+    """Process a claimed job and record the outcome in the queue."""
+    try:
+        with metrics.timer("pipeline_stage_seconds", stage="total"):
+            if streaming:
+                transcription = process_recording_streaming(job.recording_url, call_sid=job.call_sid)
+            else:
+                transcription = process_recording(job.recording_url, convert_executor, call_sid=job.call_sid)
+    except rate_limit.CircuitOpenError as e:
+        # The provider is down, not the recording; try again once the circuit lets requests through
+        metrics.inc("pipeline_recordings_total", result="deferred")
+        job_queue.defer_job(job.id, e.retry_in, e)
+        return None
+    except Exception as e:
+        metrics.inc("pipeline_recordings_total", result="error")
+        job_queue.fail_job(job.id, e)
+        raise
+    if transcription:
+        metrics.inc("pipeline_recordings_total", result="transcribed")
+        # From the recording webhook (or batch scan) queueing it to the transcript being in the database
+        metrics.observe("pipeline_enqueue_to_transcript_seconds", (datetime.utcnow() - job.created_at).total_seconds())
+        job_queue.complete_job(job.id)
+    else:
+        metrics.inc("pipeline_recordings_total", result="failed")
+        job_queue.fail_job(job.id, "No transcription produced")
+    return transcription
+
+
+def pipeline_summary(wall_seconds, audio_seconds_before=0.0):
+    """Human-readable summary of the stage metrics collected in this process.
+
+    Audio seconds per wall second covers only the run that took ``wall_seconds``.
+    """
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    summaries = snapshot["summaries"]
+    lines = ["Pipeline summary:"]
+    for stage in ("download", "ffmpeg", "gcs_upload", "recognize", "long_running_recognize",
+                  "trim_silence", "recognize_chunked", "recognize_window", "total"):
+        summary = summaries.get(f"pipeline_stage_seconds{{stage={stage}}}")
+        if summary:
+            lines.append(f"  {stage:<24} n={summary['count']:<5} p50={summary['p50']:.2f}s "
+                         f"p95={summary['p95']:.2f}s total={summary['sum']:.1f}s")
+    latency = summaries.get("pipeline_enqueue_to_transcript_seconds")
+    if latency:
+        lines.append(f"  enqueue to transcript    p50={latency['p50']:.2f}s p95={latency['p95']:.2f}s")
+    throughput = summaries.get("pipeline_download_bytes_per_second")
+    if throughput:
+        lines.append(f"  download throughput      p50={throughput['p50'] / 1e6:.2f} MB/s")
+    lines.append(f"  conversions              {counters.get('pipeline_conversions_total{result=skipped}', 0):.0f} skipped, "
+                 f"{counters.get('pipeline_conversions_total{result=transcoded}', 0):.0f} transcoded")
+    trim_input = counters.get("pipeline_trim_input_seconds_total", 0.0)
+    if trim_input:
+        trim_removed = counters.get("pipeline_trim_removed_seconds_total", 0.0)
+        lines.append(f"  silence trimmed          {trim_removed / trim_input:.1%} "
+                     f"({trim_removed:.0f}s of {trim_input:.0f}s)")
+    for service in ("speech", "gcs"):
+        retries = counters.get(f"rate_limit_retries_total{{service={service}}}", 0)
+        fast_failed = counters.get(f"rate_limit_calls_total{{result=circuit_open,service={service}}}", 0)
+        if retries or fast_failed:
+            lines.append(f"  {service:<24} {retries:.0f} retries, {fast_failed:.0f} failed fast with the circuit open")
+    audio_seconds = counters.get("pipeline_audio_seconds_total", 0.0) - audio_seconds_before
+    if wall_seconds > 0:
+        lines.append(f"  audio seconds per wall second: {audio_seconds / wall_seconds:.2f} "
+                     f"({audio_seconds:.0f}s of audio in {wall_seconds:.1f}s)")
+    return "\n".join(lines)
+
+
+def process_all_recordings(max_workers=MAX_WORKERS, convert_workers=MAX_CONVERT_WORKERS, worker_id=None,
+                           streaming=STREAMING_MODE):
+    """Drain the job queue with a bounded pool of workers.
+
+    Downloads and Speech calls run on a thread pool, ffmpeg conversions on a
+    process pool (or, in streaming mode, in each worker's own ffmpeg pipe with
+    no temp files). Jobs are claimed only as workers free up, so leases are
+    not burned while work waits in the pool, and several pipeline processes can
+    drain the same queue without double-transcribing. A failure in one
+    recording never affects the others, and results are logged as each
+    recording finishes.
+    Returns a dict mapping recording URL to its transcription (or None).
+    """
+    started_at = time.perf_counter()
+    audio_seconds_before = metrics.snapshot()["counters"].get("pipeline_audio_seconds_total", 0.0)
+    enqueue_pending_recordings()
+    worker_id = worker_id or job_queue.default_worker_id()
+
+    results = {}
+    convert_pool_context = nullcontext() if streaming else ProcessPoolExecutor(max_workers=convert_workers)
+    with convert_pool_context as convert_pool, \
+            ThreadPoolExecutor(max_workers=max_workers) as io_pool:
+        futures = {}
+        while True:
+            free_workers = max_workers - len(futures)
+            # While Speech or GCS is failing, leave the rest queued rather than claiming them just to defer them
+            if free_workers > 0 and not rate_limit.circuit_open("speech", "gcs"):
+                for job in job_queue.claim_jobs(worker_id, limit=free_workers):
+                    logging.info(f"Processing recording {job.recording_sid} (attempt {job.attempts})")
+                    futures[io_pool.submit(run_job, job, convert_pool, streaming)] = job
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                try:
+                    results[job.recording_url] = future.result()
+                except Exception as e:
+                    logging.error(f"Unexpected error processing {job.recording_url}: {e}")
+                    results[job.recording_url] = None
+                    continue
+                if results[job.recording_url]:
+                    logging.info(f"Finished processing {job.recording_url}")
+                else:
+                    logging.warning(f"No transcription produced for {job.recording_url}")
+    clients.close_finished_sessions()  # The pool's threads have exited
+
+    completed = sum(1 for transcription in results.values() if transcription)
+    logging.info(f"Processed {len(results)} recordings, {completed} transcribed; queue: {job_queue.queue_counts()}")
+    logging.info(f"Transcription cache: {get_transcription_cache().stats()}")
+    logging.info(pipeline_summary(time.perf_counter() - started_at, audio_seconds_before))
+    return results
 
 
 if __name__ == "__main__":
-    process_all_recordings()
+    parser = argparse.ArgumentParser(description="Transcribe pending call recordings.")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="Number of concurrent download/recognize workers")
+    parser.add_argument("--convert-workers", type=int, default=MAX_CONVERT_WORKERS,
+                        help="Number of concurrent ffmpeg conversion processes")
+    parser.add_argument("--stream", action="store_true", default=STREAMING_MODE,
+                        help="Pipe downloads through ffmpeg in memory instead of using temp files")
+    parser.add_argument("--chunked", action="store_true", default=CHUNKED_RECOGNITION,
+                        help="Recognize long recordings as parallel windows instead of via GCS")
+    parser.add_argument("--trim-silence", action="store_true", default=TRIM_SILENCE,
+                        help="Compress long silences before sending audio to Speech")
+    parser.add_argument("--worker", action="store_true",
+                        help="Keep running and transcribe recordings as the webhook queues them")
+    parser.add_argument("--quota-share", type=float, default=None,
+                        help="Fraction of every API quota to use, instead of RATE_LIMIT_SHARES['worker']")
+    args = parser.parse_args()
+    rate_limit.use_share("worker", share=args.quota_share)
+    CHUNKED_RECOGNITION = args.chunked
+    TRIM_SILENCE = args.trim_silence
+    if args.worker:
+        # Sidecar to a webhook server running with TRANSCRIPTION_WORKER = "sidecar"
+        from transcription_worker import TranscriptionWorker
+        enqueue_pending_recordings()
+        TranscriptionWorker(threads=args.workers,
+                            process_job=lambda job: run_job(job, streaming=args.stream)).run_forever()
+    else:
+        process_all_recordings(max_workers=args.workers, convert_workers=args.convert_workers,
+                               streaming=args.stream)
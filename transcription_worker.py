@@ -0,0 +1,101 @@
+import logging
+import queue
+import threading
+
+import job_queue
+import metrics
+import rate_limit
+
+# Event-driven transcription. The recording webhook adds a durable job to the
+# job queue and then notifies a worker, which claims it straight away instead
+# of waiting for the next batch run. Notifications are only wake-ups: the job
+# lives in the database, so a notification that is dropped because the
+# workers are saturated (or sent to a process that then restarts) only means
+# the job is picked up on the next poll. The same loop runs as a sidecar
+# process with `transcription_pipeline.py --worker`, where it polls instead.
+
+WORKER_THREADS = 2
+MAX_PENDING_NOTIFICATIONS = 50  # Beyond this the webhook stops waking workers and leaves jobs queued
+POLL_SECONDS = 2.0              # Picks up retries, other processes' jobs and dropped notifications
+
+
+def _run_pipeline_job(job):
+    # Imported on first job so the webhook server starts without the Speech SDK
+    import transcription_pipeline
+    return transcription_pipeline.run_job(job, streaming=transcription_pipeline.STREAMING_MODE)
+
+
+class TranscriptionWorker:
+    """Threads that claim jobs from the job queue and transcribe them.
+
+    ``process_job(job)`` runs one claimed job and records its outcome in the
+    queue; by default it is ``transcription_pipeline.run_job``.
+    """
+
+    def __init__(self, threads=WORKER_THREADS, max_pending=MAX_PENDING_NOTIFICATIONS, poll_seconds=POLL_SECONDS,
+                 process_job=None, worker_id=None):
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.process_job = process_job or _run_pipeline_job
+        self.worker_id = worker_id or job_queue.default_worker_id()
+        self._notifications = queue.Queue(maxsize=max_pending)
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.threads):
+            thread = threading.Thread(target=self._run, name=f"transcription-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Started {self.threads} transcription worker threads")
+        return self
+
+    def notify(self):
+        """Wake a worker for a newly queued job without blocking.
+
+        Returns False when the workers already have ``max_pending`` wake-ups
+        outstanding; the job then waits in the queue for the next poll.
+        """
+        try:
+            self._notifications.put_nowait(None)
+        except queue.Full:
+            metrics.inc("transcription_notifications_total", result="dropped")
+            return False
+        metrics.inc("transcription_notifications_total", result="queued")
+        return True
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_forever(self):
+        """Run the worker threads until interrupted, e.g. as a sidecar process."""
+        self.start()
+        try:
+            while not self._stopping.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            logging.info("Stopping transcription workers after their current jobs")
+            self.stop()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.drain()
+            try:
+                self._notifications.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                pass
+
+    def drain(self):
+        """Process jobs one at a time until none are runnable or a provider's circuit opens."""
+        while not self._stopping.is_set() and not rate_limit.circuit_open("speech", "gcs"):
+            jobs = job_queue.claim_jobs(self.worker_id, limit=1)
+            if not jobs:
+                return
+            job = jobs[0]
+            logging.info(f"Processing recording {job.recording_sid} (attempt {job.attempts})")
+            try:
+                self.process_job(job)
+            except Exception as e:
+                logging.error(f"Unexpected error processing {job.recording_url}: {e}")
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries also expire after ``ttl`` seconds.
+
+    ``on_evict(key, value)`` is called for every entry dropped because it
+    expired or because the cache was full, but not for entries removed with
+    ``pop``. It runs after the lock is released, so it may call back in.
+    """
+
+    SWEEP_INTERVAL = 1.0  # Seconds between full expiry scans triggered by set()
+
+    def __init__(self, maxsize=1024, ttl=600, on_evict=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.clock = clock
+        self._next_sweep = 0.0
+        self._data = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= self.clock():
+                del self._data[key]
+                evicted = [(key, value)]
+            else:
+                self._data.move_to_end(key)
+                return value
+        self._notify(evicted)
+        return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl, value)
+            self._data.move_to_end(key)
+            evicted = self._collect_expired() if self.clock() >= self._next_sweep else []
+            while len(self._data) > self.maxsize:
+                evicted.append(self._pop_oldest())
+        self._notify(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def expire(self):
+        """Drop every expired entry now; returns the evicted (key, value) pairs."""
+        with self._lock:
+            evicted = self._collect_expired()
+        self._notify(evicted)
+        return evicted
+
+    def drain(self):
+        """Remove every entry, expired or not, without calling ``on_evict``; returns the (key, value) pairs."""
+        with self._lock:
+            items = [(key, value) for key, (_, value) in self._data.items()]
+            self._data.clear()
+        return items
+
+    def _pop_oldest(self):
+        key, (_, value) = self._data.popitem(last=False)
+        return key, value
+
+    def _collect_expired(self):
+        # get() refreshes recency but not expiry, so LRU order is not expiry
+        # order and a full scan is needed; set() rate-limits it to SWEEP_INTERVAL.
+        now = self.clock()
+        self._next_sweep = now + self.SWEEP_INTERVAL
+        expired = [key for key, (expires_at, _) in self._data.items() if expires_at <= now]
+        return [(key, self._data.pop(key)[1]) for key in expired]
+
+    def _notify(self, evicted):
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)